@@ -89,8 +89,7 @@ https://libytm.mujay.app .
 
 
 def run_server_static():
-    from flask import Flask, request, Response, send_file
-    from flask_caching import Cache
+    from flask import Flask, request, Response, send_file, stream_with_context, make_response
     from flask_cors import CORS
     from ytmusicapi import YTMusic
     import requests
@@ -99,13 +98,40 @@ def run_server_static():
     from dotenv import load_dotenv
     import signal
     import threading
-    from werkzeug.serving import make_server
+    import hashlib
+    import tempfile
+    import time
+    import gc
+    from collections import OrderedDict
+    from concurrent.futures import ThreadPoolExecutor
+    from werkzeug.serving import BaseWSGIServer
     server = None
-    
+
+    class PooledWSGIServer(BaseWSGIServer):
+        """
+        Handles each connection on a fixed pool of threads, so the player's metadata and art
+        requests don't wait behind an audio stream, and a burst of requests can't start an
+        unbounded number of threads. Connections past the pool size queue until a thread is free.
+        """
+        def __init__(self, host, port, app, threads):
+            super().__init__(host, port, app)
+            self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="server")
+
+        def process_request(self, request, client_address):
+            self.pool.submit(self.process_request_pooled, request, client_address)
+
+        def process_request_pooled(self, request, client_address):
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
     class ServerThread(threading.Thread):
         def __init__(self, app):
             threading.Thread.__init__(self, daemon=True)
-            self.server = make_server('0.0.0.0', 5000, app)
+            self.server = PooledWSGIServer('0.0.0.0', 5000, app, SERVER_THREADS)
             self.ctx = app.app_context()
             self.ctx.push()
 
@@ -120,42 +146,275 @@ def run_server_static():
     from dotenv import load_dotenv
     if os.path.exists('.env'):
         load_dotenv()
+    CACHE_DIR = "/data/data/app.mujay.libytm.libytm/files/cacheytm"
+    # Audio and images together; least recently used files are deleted past this
+    CACHE_MAX_BYTES = int(os.environ.get("CACHE_MAX_BYTES", 512 * 1024 * 1024))
     try:
-        os.makedirs("/data/data/app.mujay.libytm.libytm/files/cacheytm", exist_ok=True)
+        os.makedirs(os.path.join(CACHE_DIR, "img"), exist_ok=True)
     except Exception as e:
         print(f"Error creating cache directory: {e}")
+    SERVER_THREADS = int(os.environ.get("SERVER_THREADS", 8))
+    # In-memory cache for metadata responses and images
+    MEMORY_CACHE_BYTES = int(os.environ.get("MEMORY_CACHE_BYTES", 16 * 1024 * 1024))
+    # Resident memory the server aims to stay under; past it the memory cache is shrunk
+    RSS_BUDGET_BYTES = int(os.environ.get("RSS_BUDGET_BYTES", 160 * 1024 * 1024))
     ytmusic = YTMusic()
-    config = {
-        "CACHE_TYPE": "SimpleCache",
-        "CACHE_DEFAULT_TIMEOUT": 120
-    }
     app = Flask(__name__)
-    app.config.from_mapping(config)
     CORS(app)
-    cache = Cache(app)
+
+    class MemoryLRU:
+        """Bytes values with expiry, evicting the least recently used past max_bytes."""
+        def __init__(self, max_bytes):
+            self.max_bytes = max_bytes
+            self.entries = OrderedDict() # key -> (expires, value, size)
+            self.bytes = 0
+            self.lock = threading.Lock()
+
+        def get(self, key):
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry is None:
+                    return None
+                if entry[0] < time.time():
+                    self.bytes -= self.entries.pop(key)[2]
+                    return None
+                self.entries.move_to_end(key)
+                return entry[1]
+
+        def set(self, key, value, timeout):
+            size = len(key) + len(value[0]) + 100 # Rough per-entry overhead
+            if size > self.max_bytes // 8:
+                return # One big playlist shouldn't flush everything else
+            with self.lock:
+                if key in self.entries:
+                    self.bytes -= self.entries.pop(key)[2]
+                self.entries[key] = (time.time() + timeout, value, size)
+                self.bytes += size
+                self.trim(self.max_bytes)
+
+        def trim(self, max_bytes):
+            """Evicts down to max_bytes (callers outside the class don't hold the lock)."""
+            while self.bytes > max_bytes and self.entries:
+                self.bytes -= self.entries.popitem(last=False)[1][2]
+
+        def shrink(self, fraction):
+            with self.lock:
+                self.trim(int(self.bytes * fraction))
+
+    memory_cache = MemoryLRU(MEMORY_CACHE_BYTES)
+
+    def cached(timeout):
+        """Caches a view's successful responses by path and query string (put it under @app.route)."""
+        def decorator(view):
+            def wrapper(*args, **kwargs):
+                key = request.full_path
+                hit = memory_cache.get(key)
+                if hit is not None:
+                    return Response(hit[0], 200, mimetype=hit[1])
+                response = make_response(view(*args, **kwargs))
+                if response.status_code == 200 and not response.is_streamed:
+                    memory_cache.set(key, (response.get_data(), response.mimetype), timeout)
+                return response
+            wrapper.__name__ = view.__name__
+            return wrapper
+        return decorator
+
+    def rss_bytes():
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError):
+            return 0
+    rss_checked = [0.0]
+    @app.after_request
+    def enforce_rss_budget(response):
+        # Measured at most once a second; over budget, drop half the memory cache and collect,
+        # so the server gives memory back instead of growing until Android kills it
+        now = time.time()
+        if now - rss_checked[0] >= 1:
+            rss_checked[0] = now
+            if rss_bytes() > RSS_BUDGET_BYTES:
+                memory_cache.shrink(0.5)
+                gc.collect()
+        return response
+
+    # fields=a,b.c keeps only the listed (dotted) paths, profile=compact keeps the
+    # fields the Mujay player actually uses; same semantics as the main server.
+    SONG_COMPACT_FIELDS = "videoId,title,author,channelId,lengthSeconds,thumbnail"
+    PLAYLIST_COMPACT_FIELDS = "id,title,author,trackCount,duration,thumbnails,tracks.videoId,tracks.title,tracks.artists.name,tracks.artists.id,tracks.album.name,tracks.album.id,tracks.duration,tracks.duration_seconds,tracks.thumbnail,tracks.thumbnails"
+    RADIO_COMPACT_FIELDS = "playlistId,lyrics,tracks.videoId,tracks.title,tracks.length,tracks.artists.name,tracks.artists.id,tracks.album.name,tracks.album.id,tracks.thumbnail"
+    SEARCH_COMPACT_FIELDS = "videoId,title,artists.name,artists.id,album.name,album.id,duration,duration_seconds,thumbnail,thumbnails"
+    def project(obj, compact_fields):
+        fields = request.args.get("fields")
+        if not fields and request.args.get("profile") == "compact":
+            fields = compact_fields
+        if not fields:
+            return obj
+        tree = {}
+        for path in fields.split(","):
+            node = tree
+            for part in path.strip().split("."):
+                node = node.setdefault(part, {})
+        def walk(o, t):
+            if not t:
+                return o
+            if isinstance(o, list):
+                return [walk(i, t) for i in o]
+            if isinstance(o, dict):
+                return {k: walk(o[k], sub) for k, sub in t.items() if k in o}
+            return o
+        return walk(obj, tree)
     
-    def get_audio(video_url, id):
-        print(f"Proxying audio for {id} from libytm.mujay.app to bypass yt-dlp issues")
-        response = requests.get(f"https://libytm.mujay.app/song/{id}/stream", stream=True)
+
+    # On-device file cache. The index maps a key ("audio/<id>", "img/<sha1 of url>") to
+    # (path, size) in least-recently-used order; it's rebuilt from the directory at startup,
+    # oldest files first, so the size bound survives restarts.
+    EXTENSIONS = {"audio/mpeg": "mp3", "audio/mp4": "m4a", "audio/webm": "webm", "audio/ogg": "ogg",
+                  "audio/opus": "opus", "audio/aac": "aac",
+                  "image/jpeg": "jpg", "image/png": "png", "image/webp": "webp", "image/gif": "gif"}
+    MIMETYPES = {ext: mimetype for mimetype, ext in EXTENSIONS.items()}
+    cache_index = OrderedDict()
+    cache_lock = threading.Lock()
+    cache_bytes = 0
+    def scan_cache():
+        nonlocal cache_bytes
+        files = []
+        for folder, prefix in ((CACHE_DIR, "audio/"), (os.path.join(CACHE_DIR, "img"), "img/")):
+            for entry in os.scandir(folder):
+                if not entry.is_file():
+                    continue
+                if entry.name.endswith(".part"):
+                    os.remove(entry.path) # Left over from a download that was cut off
+                    continue
+                stat = entry.stat()
+                files.append((stat.st_mtime, prefix + entry.name.rsplit(".", 1)[0], entry.path, stat.st_size))
+        for _, key, path, size in sorted(files):
+            cache_index[key] = (path, size)
+            cache_bytes += size
+    try:
+        scan_cache()
+    except Exception as e:
+        print(f"Error scanning cache directory: {e}")
+    def cache_lookup(key):
+        with cache_lock:
+            if key not in cache_index:
+                return None
+            cache_index.move_to_end(key)
+            path = cache_index[key][0]
+        try:
+            os.utime(path) # Keeps the LRU order across restarts
+        except OSError:
+            return None
+        return path
+    def cache_add(key, path):
+        nonlocal cache_bytes
+        size = os.path.getsize(path)
+        with cache_lock:
+            if key in cache_index:
+                cache_bytes -= cache_index.pop(key)[1]
+            cache_index[key] = (path, size)
+            cache_bytes += size
+            evicted = []
+            while cache_bytes > CACHE_MAX_BYTES and len(cache_index) > 1:
+                _, (old_path, old_size) = cache_index.popitem(last=False)
+                cache_bytes -= old_size
+                evicted.append(old_path)
+        for old_path in evicted:
+            try:
+                os.remove(old_path)
+            except OSError:
+                pass
+    def cache_mimetype(path):
+        return MIMETYPES.get(path.rsplit(".", 1)[-1], "application/octet-stream")
+
+    # Audio comes from libytm.mujay.app to bypass yt-dlp issues on the phone. The first full
+    # request for a song streams to the player while it's written to {id}.part, which becomes
+    # the cache file once complete; later requests (including Range ones) are served from it.
+    audio_downloads = set()
+    audio_downloads_lock = threading.Lock()
+    def stream_audio(id):
+        print(f"Proxying audio for {id} from libytm.mujay.app")
+        byte_range = request.headers.get("Range")
+        # "bytes=0-" is the whole file; ask for it plainly so it can be cached
+        headers = {"Range": byte_range} if byte_range and byte_range != "bytes=0-" else {}
+        response = requests.get(f"https://libytm.mujay.app/song/{id}/stream", headers=headers, stream=True, timeout=30)
         response.raise_for_status()
-        cache_path = f"/data/data/app.mujay.libytm.libytm/files/cacheytm/{id}.mp3"
-        with open(cache_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)   
-        return cache_path
+        mimetype = response.headers.get("Content-Type", "audio/mpeg").split(";")[0]
+        passthrough = {k: response.headers[k] for k in ("Content-Length", "Content-Range", "Accept-Ranges") if k in response.headers}
+        with audio_downloads_lock:
+            # Only a whole-file response can become the cache file, and only one per song at a time
+            # (and of a type we can label again when replaying it)
+            write_through = response.status_code == 200 and mimetype in EXTENSIONS and id not in audio_downloads
+            if write_through:
+                audio_downloads.add(id)
+        def generate():
+            part_path = os.path.join(CACHE_DIR, f"{id}.part")
+            f = open(part_path, "wb") if write_through else None
+            complete = False
+            try:
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    if f:
+                        f.write(chunk)
+                    yield chunk
+                complete = True
+            finally:
+                # Also runs when the player disconnects (skipped track): the rest isn't downloaded
+                response.close()
+                if f:
+                    f.close()
+                    if complete:
+                        path = os.path.join(CACHE_DIR, f"{id}.{EXTENSIONS[mimetype]}")
+                        os.replace(part_path, path)
+                        cache_add(f"audio/{id}", path)
+                    else:
+                        os.remove(part_path)
+                    with audio_downloads_lock:
+                        audio_downloads.discard(id)
+        return Response(stream_with_context(generate()), response.status_code, passthrough, mimetype=mimetype)
     @app.route("/")
     def hi():
         print("hi")
         return {"hello":"this is a libytm instance"}
+    @app.route("/health")
+    def health():
+        return {"rssBytes": rss_bytes(), "rssBudgetBytes": RSS_BUDGET_BYTES,
+                "memoryCacheBytes": memory_cache.bytes, "memoryCacheEntries": len(memory_cache.entries),
+                "diskCacheBytes": cache_bytes, "serverThreads": SERVER_THREADS}
     @app.route("/lh3Proxy/<path:url>")
     def lh3(url):
         print(f"lh3Proxy {url}")
         if "googleusercontent.com" not in url and "ytimg.com" not in url and "googlevideo.com" not in url:
             return {"error":"no"},422
-        res = requests.get(url)
-        return Response(res.content,200,{"Content-Type":res.headers["Content-Type"]})
-    @cache.cached(timeout=300)
+        key = "img/" + hashlib.sha1(url.encode()).hexdigest()
+        hit = memory_cache.get(key) # Album art is requested over and over while browsing
+        if hit is not None:
+            return Response(hit[0], 200, {"Content-Type": hit[1], "Cache-Control": "public, max-age=86400"})
+        path = cache_lookup(key)
+        if path:
+            try:
+                with open(path, "rb") as f:
+                    body = f.read()
+                memory_cache.set(key, (body, cache_mimetype(path)), 86400)
+                return Response(body, 200, {"Content-Type": cache_mimetype(path), "Cache-Control": "public, max-age=86400"})
+            except FileNotFoundError:
+                pass # Evicted by a cache_add since the lookup: fetch it again
+        res = requests.get(url, stream=True, timeout=30)
+        content_type = res.headers.get("Content-Type", "application/octet-stream")
+        if res.status_code != 200 or content_type.split(";")[0] not in EXTENSIONS:
+            # Not a cacheable image (e.g. a googlevideo.com stream): pass it through as it comes
+            return Response(stream_with_context(res.iter_content(chunk_size=64 * 1024)), res.status_code, {"Content-Type": content_type})
+        body = res.content
+        path = os.path.join(CACHE_DIR, key + "." + EXTENSIONS[content_type.split(";")[0]])
+        # A private temp file: overlapping requests for the same image each rename their own
+        fd, part_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".part")
+        with os.fdopen(fd, "wb") as f:
+            f.write(body)
+        os.replace(part_path, path)
+        cache_add(key, path)
+        memory_cache.set(key, (body, content_type), 86400)
+        return Response(body, 200, {"Content-Type": content_type, "Cache-Control": "public, max-age=86400"})
     @app.route("/song/<id>")
+    @cached(timeout=300)
     def getSong(id):
         print(f"getSong {id}")
         tries = 0
@@ -165,37 +424,40 @@ def run_server_static():
                 break
             tries += 1
         try:
-            return song["videoDetails"]
+            return project(song["videoDetails"], SONG_COMPACT_FIELDS)
         except KeyError:
             return {"error":"could not find song (if the song exists then this is a youtube bug; ask the hoster to provide cookies)"}, 404
         except Exception as e:
             return {"error":"Internal Server Error","errorDetails":e}, 500
-    @cache.cached(timeout=300)
     @app.route("/playlist/<id>")
+    @cached(timeout=300)
     def getPlaylist(id):
         print(f"getPlaylist {id}")
         pl = ytmusic.get_playlist(playlistId=id)
         try:
-            return pl
+            return project(pl, PLAYLIST_COMPACT_FIELDS)
         except KeyError:
             return {"error":"could not find playlist"}, 404
         except Exception as e:
             return {"error":"Internal Server Error","errorDetails":e}, 500
-    @cache.cached(timeout=14400)
     @app.route("/song/<id>/streamHLS.m3u8")
     def getstream_experimental(id):
         return Response(f"https://libytm.mujay.app/song/{id}/streamHLS.m3u8",200,{"Content-Type":"text/plain"})
-    @cache.cached(timeout=14400)
     @app.route("/song/<id>/stream")
     def getAudio(id):
         print(f"getAudio {id}")
         try:
-            audio = get_audio(f"https://youtube.com/watch?v={id}",id=id)
-            return send_file(audio, mimetype="audio/mpeg")
+            path = cache_lookup(f"audio/{id}")
+            if path:
+                try:
+                    return send_file(path, mimetype=cache_mimetype(path), conditional=True)
+                except FileNotFoundError:
+                    pass # Evicted since the lookup, same as lh3
+            return stream_audio(id)
         except Exception as e:
             return {"error": f"could not get audio: {str(e)}"},500
-    @cache.cached(timeout=300)
     @app.route("/song/<id>/lyrics")
+    @cached(timeout=300)
     def getLyrics(id):
         print(f"getLyrics {id}")
         song = ytmusic.get_song(videoId=id)
@@ -208,8 +470,8 @@ def run_server_static():
             return {"error":"Internal Server Error","errorDetails":e}, 500
         lyrics=requests.get(f"https://lrclib.net/api/get?artist_name={songDetails["author"]}&track_name={songDetails["title"]}")
         return lyrics.json()
-    @cache.cached(timeout=300)
     @app.route("/song/<id>/ytmLyrics")
+    @cached(timeout=300)
     def getYTMLyrics(id):
         print(f"getYTMLyrics {id}")
         song = ytmusic.get_song(videoId=id)
@@ -221,24 +483,24 @@ def run_server_static():
             return {"error":"could not find song"}, 404
         except Exception as e:
             return {"error":"Internal Server Error","errorDetails":e}, 500
-    @cache.cached(timeout=300)
     @app.route("/song/<id>/radio")
+    @cached(timeout=300)
     def getRadio(id):
         print(f"getRadio {id}")
         song = ytmusic.get_song(videoId=id)
         try:
             radio = ytmusic.get_watch_playlist(videoId=id,radio=True,limit=50)
-            return radio
+            return project(radio, RADIO_COMPACT_FIELDS)
         except KeyError:
             return {"error":"could not find song"}, 404
         except Exception as e:
             return {"error":"Internal Server Error","errorDetails":e}, 500
     @app.route("/search/<q>")
     @app.route("/search/<q>/songs")
-    @cache.cached(timeout=300)
+    @cached(timeout=300)
     def search(q):
         print(f"search {q}")
-        return ytmusic.search(query=q,filter="songs",limit=32)
+        return project(ytmusic.search(query=q,filter="songs",limit=32), SEARCH_COMPACT_FIELDS)
     try:
         # Use threaded server instead of app.run directly
         print("Starting server in thread mode")
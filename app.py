@@ -1,32 +1,168 @@
-from flask import Flask, request, Response, send_file
+import time
+import_started = time.perf_counter() # For the startup log line and libytm_import_seconds
+
+from flask import Flask, request, Response, send_file, g, has_request_context
 from flask_caching import Cache
 from flask_cors import CORS
-from ytmusicapi import YTMusic
 import requests
 import subprocess
 import os
 import sys
 import io
 import urllib.parse
-import yt_dlp
 import threading
-import time
 import uuid
-from concurrent.futures import ThreadPoolExecutor
+import gzip
+import functools
+import hashlib
+import random
+import re
+import copy
+import json
+import math
+import tempfile
+import pickle
+import queue
+import atexit
+import logging
+import logging.handlers
+import hmac
+import collections
+import bisect
+import sqlite3
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor, Future
+from contextlib import contextmanager
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.wsgi import wrap_file
 from dotenv import load_dotenv
 
+# Optional fast JSON encoders and brotli; the stdlib is used when they're missing
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 # Load environment variables from .env file
 if os.path.exists('.env'):
     load_dotenv()
 
-# Ensure cache directories exist
-os.makedirs("cache", exist_ok=True)
-os.makedirs("cache/segments", exist_ok=True)
-
-# Initialize yt-dlp and ytmusicapi
-# yt_dlp.YoutubeDL() instance isn't strictly needed globally if only used in subprocess.run
-# ytdlp = yt_dlp.YoutubeDL() # Keep for reference, but not used directly below
-ytmusic = YTMusic()
+# --- LOGGING ---
+# Records are handed to a queue and written by a background listener thread, so request
+# threads never block on stdout. LOG_FORMAT=json (default) writes one JSON object per line
+# with the request id and any extra= fields; LOG_FORMAT=text is easier to read locally.
+# Per-segment and per-image events go through log_sampled, which keeps LOG_SAMPLE_RATE of them.
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json')
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', 0.01))
+
+# Attributes every LogRecord has; anything else came in through extra= and is logged as a field
+STANDARD_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+class RequestContextFilter(logging.Filter):
+    """Tags records with the current request's id. Runs in the calling thread, before queueing."""
+    def filter(self, record):
+        if not hasattr(record, "request_id"):
+            record.request_id = g.get("request_id", "-") if has_request_context() else "-"
+        return True
+
+
+class StructuredQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Unlike QueueHandler.prepare, keep the traceback in exc_text instead of pasting it into msg
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {"ts": round(record.created, 3), "level": record.levelname, "msg": record.getMessage(), "thread": record.threadName}
+        entry.update((k, v) for k, v in vars(record).items() if k not in STANDARD_RECORD_ATTRS)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        line = super().format(record)
+        fields = " ".join(f"{k}={v}" for k, v in vars(record).items() if k not in STANDARD_RECORD_ATTRS and k != "request_id")
+        return f"{line} {fields}" if fields else line
+
+
+def log_sampled(level, msg, *args, extra=None):
+    """Logs only LOG_SAMPLE_RATE of the calls; for events that happen per segment or per image."""
+    if logger.isEnabledFor(level) and random.random() < LOG_SAMPLE_RATE:
+        logger.log(level, msg, *args, extra=dict(extra or {}, sampled=LOG_SAMPLE_RATE))
+
+
+log_queue = queue.SimpleQueue()
+log_output_handler = logging.StreamHandler(sys.stdout)
+log_output_handler.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else
+                                TextFormatter("%(asctime)s %(levelname)s [%(request_id)s] %(message)s"))
+log_listener = logging.handlers.QueueListener(log_queue, log_output_handler)
+log_queue_handler = StructuredQueueHandler(log_queue)
+log_queue_handler.addFilter(RequestContextFilter())
+
+logger = logging.getLogger("libytm")
+logger.setLevel(LOG_LEVEL)
+logger.addHandler(log_queue_handler)
+logger.propagate = False
+log_listener.start()
+
+def restart_log_listener():
+    # Threads don't survive fork(), so a worker forked from a --preload master needs its own writer
+    global log_listener
+    log_listener = logging.handlers.QueueListener(log_queue, log_output_handler)
+    log_listener.start()
+
+
+def stop_log_listener():
+    log_listener.stop() # Flushes whatever is still queued
+
+os.register_at_fork(after_in_child=restart_log_listener)
+atexit.register(stop_log_listener)
+# --- END LOGGING ---
+
+# yt-dlp only ever runs as a subprocess (python -m yt_dlp), so it isn't imported here.
+# The ytmusicapi client is built on first use rather than at import: importing and
+# constructing it is most of this module's import time, and a client built in a --preload
+# master would share its HTTP connections with every forked worker. There's one client per
+# identity, see IDENTITY POOL.
+class LazyClient:
+    """Stands in for a client that's expensive to build, building it on first attribute access."""
+    def __init__(self, factory):
+        self.factory = factory
+        self.client = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        if self.client is None:
+            with self.lock:
+                if self.client is None:
+                    self.client = self.factory()
+        return self.client
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+
+def make_ytmusic(auth=None, proxies=None):
+    from ytmusicapi import YTMusic
+    return YTMusic(auth, proxies=proxies)
 
 # Flask app configuration for caching
 config = {
@@ -36,6 +172,99 @@ config = {
 app = Flask(__name__)
 app.config.from_mapping(config)
 
+# --- REQUEST LOGGING ---
+# Every request gets an id (the caller's X-Request-ID if it sent one), attached to every log
+# record made while handling it and echoed back in the response. One access record per
+# request carries the duration; segment and image requests are sampled.
+SAMPLED_ENDPOINTS = ("/song/<id>/segment/<segment_filename>", "/lh3Proxy/<path:url>")
+
+@app.before_request
+def assign_request_id():
+    g.request_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex[:16]
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def log_request(response):
+    response.headers["X-Request-ID"] = g.get("request_id", "-")
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    fields = {
+        "method": request.method,
+        "path": request.path,
+        "endpoint": endpoint,
+        "status": response.status_code,
+        "duration_ms": round((time.perf_counter() - g.request_start) * 1000, 2) if "request_start" in g else None,
+    }
+    if endpoint in SAMPLED_ENDPOINTS:
+        log_sampled(logging.INFO, "request", extra=fields)
+    else:
+        logger.info("request", extra=fields)
+    return response
+# --- END REQUEST LOGGING ---
+
+# --- JSON SERIALIZATION ---
+# Playlist/radio/search payloads can run to megabytes, so the stdlib json module
+# is swapped for orjson or msgspec when one of them is installed.
+# JSON_PROVIDER can be "auto" (default), "orjson", "msgspec" or "stdlib".
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON provider backed by orjson."""
+    def dumps(self, obj, **kwargs):
+        if kwargs: # Callers asking for stdlib options (indent, sort_keys...) get the stdlib
+            return super().dumps(obj, **kwargs)
+        return self.dumps_bytes(obj).decode()
+
+    def dumps_bytes(self, obj):
+        # OPT_NON_STR_KEYS matches the stdlib, which accepts int keys in dicts
+        return orjson.dumps(obj, default=self.default, option=orjson.OPT_NON_STR_KEYS)
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(self.dumps_bytes(obj), mimetype=self.mimetype)
+
+
+class MsgspecProvider(DefaultJSONProvider):
+    """JSON provider backed by msgspec."""
+    def dumps(self, obj, **kwargs):
+        if kwargs:
+            return super().dumps(obj, **kwargs)
+        return self.dumps_bytes(obj).decode()
+
+    def dumps_bytes(self, obj):
+        return msgspec.json.encode(obj, enc_hook=self.default)
+
+    def loads(self, s, **kwargs):
+        return msgspec.json.decode(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(self.dumps_bytes(obj), mimetype=self.mimetype)
+
+
+class StdlibProvider(DefaultJSONProvider):
+    """Flask's default provider, with the bytes helper the response cache relies on."""
+    def dumps_bytes(self, obj):
+        return self.dumps(obj).encode()
+
+
+def select_json_provider(name):
+    """Picks the JSON provider class for the JSON_PROVIDER setting."""
+    name = (name or "auto").lower()
+    if name in ("auto", "orjson") and orjson is not None:
+        return OrjsonProvider
+    if name in ("auto", "msgspec") and msgspec is not None:
+        return MsgspecProvider
+    if name not in ("auto", "stdlib"):
+        logger.warning(f"JSON provider '{name}' is not installed, falling back to the stdlib json module.")
+    return StdlibProvider
+
+app.json_provider_class = select_json_provider(os.environ.get('JSON_PROVIDER'))
+app.json = app.json_provider_class(app)
+logger.info(f"Using JSON provider: {app.json_provider_class.__name__}")
+# --- END JSON SERIALIZATION ---
+
 # --- UPDATED CORS CONFIGURATION ---
 # List of allowed origins, including common local dev addresses and both production forms
 allowed_origins = [
@@ -55,49 +284,1299 @@ CORS(app, resources={r"/*": {"origins": allowed_origins}})
 
 cache = Cache(app)
 
+# --- METRICS ---
+# A small Prometheus-compatible registry (text exposition format, served at /metrics) so
+# there's no extra dependency. Each gunicorn worker keeps its own numbers; scrape every
+# worker or let the scraper sum them.
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') != '0'
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+metrics_registry = []
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in labels)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + "}"
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {} # {sorted label tuple: value}
+        self.lock = threading.Lock()
+        metrics_registry.append(self)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            items = list(self.values.items())
+        lines += [f"{self.name}{format_labels(labels)} {value}" for labels, value in items]
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """A gauge whose value(s) are computed at scrape time by `callback`, returning a number or {labels tuple: number}."""
+    kind = "gauge"
+
+    def __init__(self, name, help, callback):
+        super().__init__(name, help)
+        self.callback = callback
+
+    def render(self):
+        try:
+            values = self.callback()
+        except Exception as e:
+            logger.exception(f"error computing gauge {self.name}: {str(e)}")
+            return []
+        with self.lock:
+            self.values = values if isinstance(values, dict) else {(): values}
+        return super().render()
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.values.get(key)
+            if series is None:
+                series = self.values[key] = {"buckets": [0] * len(self.buckets), "sum": 0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["buckets"][i] += 1
+                    break
+            series["sum"] += value
+            series["count"] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            items = [(labels, dict(series, buckets=list(series["buckets"]))) for labels, series in self.values.items()]
+        for labels, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, series["buckets"]):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{format_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{self.name}_bucket{format_labels(labels + (('le', '+Inf'),))} {series['count']}")
+            lines.append(f"{self.name}_sum{format_labels(labels)} {series['sum']}")
+            lines.append(f"{self.name}_count{format_labels(labels)} {series['count']}")
+        return lines
+
+
+def dir_usage_bytes(path):
+    total = 0
+    with os.scandir(path) as entries:
+        for entry in entries:
+            try:
+                total += dir_usage_bytes(entry.path) if entry.is_dir(follow_symlinks=False) else entry.stat().st_size
+            except OSError:
+                pass # Purged while we were scanning
+    return total
+
+
+http_requests_total = Counter("libytm_http_requests_total", "HTTP requests by endpoint and status code.")
+http_request_seconds = Histogram("libytm_http_request_seconds", "HTTP request duration by endpoint.")
+stage_seconds = Histogram("libytm_stage_seconds", "Duration of streaming pipeline stages (resolve, manifest_fetch, queue_wait, segment_download, segment_wait, audio_download).")
+segment_downloads_total = Counter("libytm_segment_downloads_total", "Finished segment downloads by outcome.")
+segment_download_bytes_total = Counter("libytm_segment_download_bytes_total", "Bytes of segments downloaded from upstream.")
+cache_requests_total = Counter("libytm_cache_requests_total", "Cache lookups by cache and result (hit, miss, stale).")
+upstream_calls_total = Counter("libytm_upstream_calls_total", "Upstream calls by upstream and outcome (ok, error, throttled, rejected, coalesced).")
+upstream_call_seconds = Histogram("libytm_upstream_call_seconds", "Upstream call duration by upstream.")
+
+def segment_cache_status_counts():
+    with segment_cache_lock:
+        statuses = [info['status'] for info in segment_cache.values()]
+    return {(("status", status),): statuses.count(status) for status in set(statuses)}
+
+Gauge("libytm_segment_cache_entries", "Segments tracked in segment_cache by status.", segment_cache_status_counts)
+Gauge("libytm_segment_executor_queue_depth", "Segment downloads waiting for a worker.",
+      lambda: segment_download_executor._work_queue.qsize())
+Gauge("libytm_stream_url_cache_entries", "Resolved stream URLs cached.", lambda: len(stream_url_cache))
+Gauge("libytm_segment_packs", "Songs with a segment pack (SEGMENT_STORAGE=packed).", lambda: len(segment_packs))
+Gauge("libytm_manifest_cache_entries", "Rewritten HLS manifests cached.", lambda: len(manifest_cache))
+Gauge("libytm_cache_disk_bytes", "Bytes used under the cache directory.",
+      lambda: dir_usage_bytes(os.path.join(os.getcwd(), "cache")))
+Gauge("libytm_upstream_rate_limit", "Current adaptive rate limit (calls/s) per upstream.",
+      lambda: {(("upstream", u.name),): u.current_rate() for u in upstreams})
+cluster_requests_total = Counter("libytm_cluster_requests_total", "Sharded requests by action (local, forwarded, redirected, fallback).")
+identity_calls_total = Counter("libytm_identity_calls_total", "Upstream calls by identity, upstream and outcome (ok, error, throttled).")
+prefetch_tracks_total = Counter("libytm_prefetch_tracks_total", "Prefetched tracks by result (done, cached, failed, skipped, delegated, cancelled).")
+Gauge("libytm_prefetch_queue_depth", "Prefetch downloads waiting for a worker.", lambda: prefetch_executor._work_queue.qsize())
+Gauge("libytm_identity_benched", "1 while an identity is benched after being throttled.",
+      lambda: {(("identity", i.name),): int(i.is_benched()) for i in identity_pool.identities})
+Gauge("libytm_import_seconds", "Time it took to import app.py in this worker.", lambda: app_import_seconds)
+Gauge("libytm_upstream_circuit_open", "1 while an upstream's circuit breaker is open.",
+      lambda: {(("upstream", u.name),): int(u.breaker.is_open()) for u in upstreams})
+
+@app.after_request
+def record_request_metrics(response):
+    # request.url_rule keeps label cardinality bounded (one series per route, not per id)
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    http_requests_total.inc(endpoint=endpoint, status=response.status_code)
+    if "request_start" in g:
+        http_request_seconds.observe(time.perf_counter() - g.request_start, endpoint=endpoint)
+    return response
+
+
+@app.route("/metrics")
+def metrics():
+    if not METRICS_ENABLED:
+        return {"error": "metrics are disabled"}, 404
+    lines = []
+    for metric in metrics_registry:
+        lines += metric.render()
+    return Response("\n".join(lines) + "\n", 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+def note_stage(stage, seconds):
+    """Adds a stage timing to the current request's breakdown (used by slow-request capture)."""
+    if has_request_context() and "stage_timings" in g:
+        g.stage_timings.append((stage, round(seconds * 1000, 2)))
+
+
+def observe_stage(stage, seconds):
+    stage_seconds.observe(seconds, stage=stage)
+    note_stage(stage, seconds)
+
+
+@contextmanager
+def timed_stage(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - start)
+# --- END METRICS ---
+
+# --- PROFILING ---
+# Opt-in, per-worker profiling, driven through the /admin endpoints (which need ADMIN_TOKEN):
+#  - a sampling profiler that snapshots every thread's stack (request threads, segment
+#    downloads, purge, warm-up...) and reports them in collapsed-stack format, which
+#    flamegraph.pl, speedscope and inferno read directly;
+#  - slow-request capture: while SLOW_REQUEST_THRESHOLD > 0, in-flight requests have their
+#    stacks sampled, and any request slower than the threshold is kept (with its stage
+#    timings and collapsed stacks) in a ring buffer of the last SLOW_REQUEST_LOG_SIZE.
+# Each gunicorn worker profiles itself; responses carry its pid.
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+PROFILER_INTERVAL = float(os.environ.get('PROFILER_INTERVAL', 0.01))
+SLOW_REQUEST_THRESHOLD = float(os.environ.get('SLOW_REQUEST_THRESHOLD', 0)) # Seconds; 0 disables capture
+SLOW_REQUEST_SAMPLE_INTERVAL = float(os.environ.get('SLOW_REQUEST_SAMPLE_INTERVAL', 0.05))
+SLOW_REQUEST_LOG_SIZE = int(os.environ.get('SLOW_REQUEST_LOG_SIZE', 50))
+
+def collapse_stack(frame, thread_name):
+    """Renders a frame's stack root-first as "thread;func (file);func (file)"."""
+    parts = []
+    while frame is not None:
+        code = frame.f_code
+        parts.append(f"{code.co_name} ({os.path.basename(code.co_filename)})".replace(";", ":"))
+        frame = frame.f_back
+    parts.append(thread_name.replace(";", ":"))
+    return ";".join(reversed(parts))
+
+
+class SamplingProfiler:
+    """Samples the stacks of all threads every `interval` seconds into collapsed-stack counts."""
+    def __init__(self):
+        self.counts = collections.Counter()
+        self.samples = 0
+        self.thread = None
+        self.running = False
+        self.stopping = threading.Event() # Wakes the sampler out of its sleep
+        self.lock = threading.Lock()
+        self.control_lock = threading.Lock() # Serializes start/stop, so there's never more than one sampler
+
+    def start(self, interval=PROFILER_INTERVAL):
+        with self.control_lock:
+            if self.running:
+                return
+            self.running = True
+            self.stopping.clear()
+            self.thread = threading.Thread(target=self._run, args=(interval,), name="profiler", daemon=True)
+            self.thread.start()
+        logger.info(f"sampling profiler started, interval {interval}s")
+
+    def stop(self):
+        with self.control_lock:
+            if not self.running:
+                return
+            self.running = False
+            self.stopping.set()
+            self.thread.join() # So a quick stop-start can't leave the old sampler counting too
+        logger.info("sampling profiler stopped")
+
+    def reset(self):
+        with self.lock:
+            self.counts.clear()
+            self.samples = 0
+
+    def _run(self, interval):
+        own_ident = threading.get_ident()
+        while not self.stopping.is_set():
+            names = {t.ident: t.name for t in threading.enumerate()}
+            stacks = [collapse_stack(frame, names.get(ident, str(ident)))
+                      for ident, frame in sys._current_frames().items() if ident != own_ident]
+            with self.lock:
+                self.counts.update(stacks)
+                self.samples += 1
+            self.stopping.wait(interval)
+
+    def collapsed(self):
+        with self.lock:
+            return "\n".join(f"{stack} {count}" for stack, count in self.counts.most_common()) + "\n"
+
+
+profiler = SamplingProfiler()
+
+# {thread ident: {"request_id", "path", "start", "stacks": Counter}} for requests being handled right now
+inflight_requests = {}
+inflight_requests_lock = threading.Lock()
+slow_requests = collections.deque(maxlen=SLOW_REQUEST_LOG_SIZE)
+slow_request_sampler = None
+
+def sample_inflight_requests():
+    """Background task sampling the stacks of in-flight requests while capture is on."""
+    while SLOW_REQUEST_THRESHOLD > 0:
+        frames = sys._current_frames()
+        with inflight_requests_lock:
+            for ident, record in inflight_requests.items():
+                frame = frames.get(ident)
+                if frame is not None:
+                    record["stacks"][collapse_stack(frame, "request")] += 1
+        time.sleep(SLOW_REQUEST_SAMPLE_INTERVAL)
+
+
+def set_slow_request_threshold(threshold):
+    global SLOW_REQUEST_THRESHOLD, slow_request_sampler
+    SLOW_REQUEST_THRESHOLD = threshold
+    if threshold > 0 and (slow_request_sampler is None or not slow_request_sampler.is_alive()):
+        slow_request_sampler = threading.Thread(target=sample_inflight_requests, name="slow-request-sampler", daemon=True)
+        slow_request_sampler.start()
+
+
+@app.before_request
+def track_inflight_request():
+    if SLOW_REQUEST_THRESHOLD <= 0:
+        return
+    g.stage_timings = []
+    with inflight_requests_lock:
+        inflight_requests[threading.get_ident()] = {
+            "request_id": g.get("request_id"),
+            "path": request.full_path.rstrip("?"),
+            "start": time.perf_counter(),
+            "stacks": collections.Counter(),
+        }
+
+
+@app.teardown_request
+def capture_slow_request(exc):
+    with inflight_requests_lock:
+        record = inflight_requests.pop(threading.get_ident(), None)
+    if record is None:
+        return
+    duration = time.perf_counter() - record["start"]
+    if SLOW_REQUEST_THRESHOLD <= 0 or duration < SLOW_REQUEST_THRESHOLD:
+        return
+    entry = {
+        "request_id": record["request_id"],
+        "path": record["path"],
+        "duration_ms": round(duration * 1000, 2),
+        "at": time.time(),
+        "error": repr(exc) if exc else None,
+        "stages": g.get("stage_timings", []),
+        "stacks": "\n".join(f"{stack} {count}" for stack, count in record["stacks"].most_common()),
+    }
+    slow_requests.append(entry)
+    logger.warning("slow request", extra={k: entry[k] for k in ("path", "duration_ms", "stages")})
+
+
+def require_admin(f):
+    """Guards an admin route with the ADMIN_TOKEN header; the routes don't exist without one."""
+    @functools.wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not ADMIN_TOKEN:
+            return {"error": "Not Found"}, 404
+        if not hmac.compare_digest(request.headers.get("X-Admin-Token", ""), ADMIN_TOKEN):
+            return {"error": "Forbidden"}, 403
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+@app.route("/admin/profiler", methods=["GET"])
+@require_admin
+def profiler_report():
+    """Collapsed stacks so far (?reset=1 clears them after reading)."""
+    report, samples = profiler.collapsed(), profiler.samples
+    if request.args.get("reset"):
+        profiler.reset()
+    return Response(report, 200, {"Content-Type": "text/plain", "X-Worker-Pid": str(os.getpid()),
+                                  "X-Profiler-Samples": str(samples)})
+
+
+def float_arg(name, default):
+    """A float query argument, or None if it doesn't parse (or isn't finite)."""
+    try:
+        value = float(request.args.get(name, default))
+    except ValueError:
+        return None
+    return value if math.isfinite(value) else None
+
+
+@app.route("/admin/profiler/start", methods=["POST"])
+@require_admin
+def profiler_start():
+    interval = float_arg("interval", PROFILER_INTERVAL)
+    if interval is None or interval <= 0:
+        return {"error": "interval must be a number of seconds greater than 0"}, 400
+    profiler.start(interval)
+    return {"running": True, "pid": os.getpid()}
+
+
+@app.route("/admin/profiler/stop", methods=["POST"])
+@require_admin
+def profiler_stop():
+    profiler.stop()
+    return {"running": False, "pid": os.getpid(), "samples": profiler.samples}
+
+
+@app.route("/admin/slow-requests", methods=["GET", "POST"])
+@require_admin
+def slow_request_log():
+    """GET lists captured slow requests; POST ?threshold=<seconds> changes the threshold (0 turns capture off)."""
+    if request.method == "POST":
+        threshold = float_arg("threshold", 0)
+        if threshold is None or threshold < 0:
+            return {"error": "threshold must be a number of seconds (0 turns capture off)"}, 400
+        set_slow_request_threshold(threshold)
+    return {"pid": os.getpid(), "threshold": SLOW_REQUEST_THRESHOLD, "requests": list(slow_requests)}
+# --- END PROFILING ---
+
+# --- SERIALIZED RESPONSE CACHE ---
+# Metadata routes cache the final JSON bytes (plus gzip/brotli variants compressed once
+# at store time) instead of Python objects. SimpleCache still pickles every entry, but a hit
+# only unpickles a few bytes strings, rather than the response's whole object tree followed
+# by a re-serialization and a re-compression.
+CACHE_SERIALIZED_RESPONSES = os.environ.get('CACHE_SERIALIZED_RESPONSES', '1') != '0'
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', 1024)) # Bodies smaller than this aren't worth compressing
+GZIP_LEVEL = int(os.environ.get('GZIP_LEVEL', 6))
+BROTLI_QUALITY = int(os.environ.get('BROTLI_QUALITY', 5))
+STALE_TTL = int(os.environ.get('STALE_TTL', 60 * 60)) # How long past expiry an entry may be served while it's revalidated
+NEGATIVE_CACHE_TTL = int(os.environ.get('NEGATIVE_CACHE_TTL', 60)) # How long "not found" results are cached
+NEGATIVE_CACHE_STATUSES = (404,)
+
+def encode_json_body(obj):
+    """Serializes obj once and pre-compresses it, returning {encoding: bytes}."""
+    body = app.json.dumps_bytes(obj)
+    entry = {"identity": body}
+    if len(body) >= COMPRESSION_MIN_SIZE:
+        entry["gzip"] = gzip.compress(body, compresslevel=GZIP_LEVEL)
+        if brotli is not None:
+            entry["br"] = brotli.compress(body, quality=BROTLI_QUALITY)
+    return entry
+
+
+def negotiate_encoding(available):
+    """Picks the best content encoding out of `available` that the client accepts."""
+    for encoding in ("br", "gzip"):
+        if encoding in available and request.accept_encodings.quality(encoding) > 0:
+            return encoding
+    return "identity"
+
+
+def json_body_response(bodies, status=200):
+    """Builds a response from pre-encoded bodies ({encoding: bytes}), picking the negotiated encoding."""
+    encoding = negotiate_encoding(bodies)
+    response = app.response_class(bodies[encoding], status=status, mimetype=app.json.mimetype)
+    if encoding != "identity":
+        response.headers["Content-Encoding"] = encoding
+    if len(bodies) > 1:
+        response.vary.add("Accept-Encoding")
+    return response
+
+
+def store_json_entry(cache_key, obj, timeout, status=200):
+    """Encodes obj and caches it, recording when it expires so hot entries can be refreshed ahead."""
+    if timeout is None:
+        timeout = app.config["CACHE_DEFAULT_TIMEOUT"]
+    entry = {"bodies": encode_json_body(obj), "expires": time.time() + timeout, "status": status}
+    # Successful entries are kept STALE_TTL past their expiry so they can be served while revalidating
+    cache.set(cache_key, entry, timeout=timeout + STALE_TTL if status == 200 else timeout)
+    return entry
+
+
+def is_negative_result(rv):
+    """True for view results worth caching as a miss (e.g. a removed or region-blocked video)."""
+    return isinstance(rv, tuple) and len(rv) >= 2 and isinstance(rv[0], dict) and rv[1] in NEGATIVE_CACHE_STATUSES
+
+
+def cached_json(timeout=None, compact_fields=None):
+    """
+    Drop-in for @cache.cached on JSON routes that caches serialized, pre-compressed bytes.
+    Successful dict/list results are cached for `timeout`, then served stale for up to
+    STALE_TTL while they're revalidated in the background. 404s are cached for
+    NEGATIVE_CACHE_TTL; other error tuples pass through untouched.
+    The result is projected through `fields=` / `profile=compact` (see RESPONSE PROJECTION)
+    before it's encoded, with compact_fields as the route's compact profile.
+    Hot entries are re-fetched in the background shortly before they expire (see REFRESH-AHEAD).
+    Like cache.cached, the undecorated view stays reachable as `.uncached`.
+    """
+    def decorator(f):
+        @functools.wraps(f)
+        def decorated_function(*args, **kwargs):
+            fields = requested_fields(compact_fields)
+            if not CACHE_SERIALIZED_RESPONSES:
+                rv = f(*args, **kwargs)
+                return project_fields(rv, fields) if isinstance(rv, (dict, list)) else rv
+            # url_root is part of the key because thumbnail URLs are rewritten to point at it.
+            # Only the projection goes in the key so unrelated query params can't bust the cache.
+            cache_key = f"json/{request.url_root}{request.path}?fields={fields or ''}"
+            record_access(cache_key)
+            entry = cache.get(cache_key)
+            if entry is None:
+                cache_requests_total.inc(cache="response", result="miss")
+                rv = f(*args, **kwargs)
+                if isinstance(rv, (dict, list)):
+                    entry = store_json_entry(cache_key, project_fields(rv, fields), timeout)
+                elif is_negative_result(rv):
+                    entry = store_json_entry(cache_key, rv[0], NEGATIVE_CACHE_TTL, status=rv[1])
+                else:
+                    return rv
+            elif entry["status"] == 200 and entry["expires"] <= time.time():
+                # Stale: serve it anyway and revalidate in the background
+                cache_requests_total.inc(cache="response", result="stale")
+                schedule_refresh(cache_key, f, args, kwargs, fields, timeout)
+            else:
+                cache_requests_total.inc(cache="response", result="hit")
+                if entry["status"] == 200 and needs_refresh(cache_key, entry["expires"]):
+                    schedule_refresh(cache_key, f, args, kwargs, fields, timeout)
+            return json_body_response(entry["bodies"], entry["status"])
+        decorated_function.uncached = f
+        return decorated_function
+    return decorator
+# --- END SERIALIZED RESPONSE CACHE ---
+
+# --- REFRESH-AHEAD ---
+# Every cache key (and every song whose stream is requested) has a hit counter that is
+# halved every WARMUP_INTERVAL, so it tracks recent popularity. A cached_json entry whose
+# counter reaches REFRESH_AHEAD_MIN_HITS is re-fetched in the background once it's within
+# REFRESH_AHEAD_WINDOW seconds of expiring, so popular metadata never serves a cold miss.
+REFRESH_AHEAD_WINDOW = int(os.environ.get('REFRESH_AHEAD_WINDOW', 60))
+REFRESH_AHEAD_MIN_HITS = float(os.environ.get('REFRESH_AHEAD_MIN_HITS', 3))
+
+# {key: decayed hit count}
+access_counts = {}
+access_counts_lock = threading.Lock()
+# Background refreshes run here so they never hold up a request
+# Like segment_download_executor, this only starts threads on its first submit(), so creating
+# it at import is free and a --preload master never ends up with pool threads before fork.
+refresh_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="refresh-ahead")
+refreshing_keys = set() # Keys with a refresh already queued or running
+
+def record_access(key):
+    with access_counts_lock:
+        access_counts[key] = access_counts.get(key, 0) + 1
+
+
+def decay_access_counts():
+    """Halves every hit counter, dropping the ones that have gone cold."""
+    with access_counts_lock:
+        for key in list(access_counts):
+            access_counts[key] /= 2
+            if access_counts[key] < 0.5:
+                del access_counts[key]
+
+
+def hottest_keys(prefix, limit):
+    """Returns up to `limit` keys starting with prefix, most requested first."""
+    with access_counts_lock:
+        keys = [k for k in access_counts if k.startswith(prefix)]
+        keys.sort(key=access_counts.get, reverse=True)
+    return keys[:limit]
+
+
+def needs_refresh(cache_key, expires):
+    if expires - time.time() > REFRESH_AHEAD_WINDOW:
+        return False
+    with access_counts_lock:
+        return access_counts.get(cache_key, 0) >= REFRESH_AHEAD_MIN_HITS and cache_key not in refreshing_keys
+
+
+def schedule_refresh(cache_key, f, args, kwargs, fields, timeout):
+    """Queues a background re-fetch of a cached_json entry, replaying the current request's URL."""
+    with access_counts_lock:
+        if cache_key in refreshing_keys:
+            return
+        refreshing_keys.add(cache_key)
+    refresh_executor.submit(refresh_json_entry, cache_key, f, args, kwargs, fields, timeout,
+                            request.url_root, request.full_path)
+
+
+def refresh_json_entry(cache_key, f, args, kwargs, fields, timeout, base_url, path):
+    priority_context.value = BACKGROUND
+    try:
+        # The views read request.url_root to rewrite thumbnail URLs, so give them a request
+        with app.test_request_context(path, base_url=base_url):
+            rv = f(*args, **kwargs)
+        if isinstance(rv, (dict, list)):
+            store_json_entry(cache_key, project_fields(rv, fields), timeout)
+        elif is_negative_result(rv):
+            # The item is gone upstream now, stop serving the stale copy
+            store_json_entry(cache_key, rv[0], NEGATIVE_CACHE_TTL, status=rv[1])
+        else:
+            logger.warning(f"refresh for {cache_key} got an error response, keeping the old entry")
+    except Exception as e:
+        logger.warning(f"refresh for {cache_key} failed: {str(e)}")
+    finally:
+        with access_counts_lock:
+            refreshing_keys.discard(cache_key)
+# --- END REFRESH-AHEAD ---
+
+# --- UPSTREAM RESILIENCE ---
+# Each upstream (YouTube Music API, yt-dlp, lrclib) has a circuit breaker: after
+# BREAKER_FAILURE_THRESHOLD consecutive failures, calls fail fast with CircuitOpenError
+# for BREAKER_RESET_TIMEOUT seconds instead of tying up workers on a struggling upstream.
+# Only transport errors, 5xx responses and throttling count as failures: an error about
+# one item (a video that always fails to parse) says nothing about the upstream's health.
+# Retries use exponential backoff with full jitter instead of fixed sleeps.
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get('BREAKER_FAILURE_THRESHOLD', 5))
+BREAKER_RESET_TIMEOUT = float(os.environ.get('BREAKER_RESET_TIMEOUT', 30))
+RETRY_BASE_DELAY = float(os.environ.get('RETRY_BASE_DELAY', 0.25))
+RETRY_MAX_DELAY = float(os.environ.get('RETRY_MAX_DELAY', 2))
+
+TRANSPORT_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout, subprocess.TimeoutExpired,
+                    ConnectionError, TimeoutError)
+# Exception messages (yt-dlp's stderr, ytmusicapi's "Server returned HTTP 503") that mean the
+# upstream itself is failing
+TRANSPORT_MARKERS = ("timed out", "connection reset", "connection refused", "remote end closed", "name resolution")
+SERVER_ERROR_PATTERN = re.compile(r"\bhttp(?: error)? 5\d\d\b")
+
+# Set by callers that retry a failed call themselves, for every attempt but the last, so
+# one logical request counts as at most one failure
+retry_context = threading.local()
+
+
+def is_upstream_failure(e):
+    """True if `e` says the upstream is struggling (transport error, 5xx, throttling), not that one item failed."""
+    if isinstance(e, TRANSPORT_ERRORS):
+        return True
+    status = getattr(getattr(e, "response", None), "status_code", None)
+    if status is not None:
+        return status >= 500 or status == 429
+    message = f"{e} {getattr(e, 'stderr', None) or ''}".lower() # stderr for yt-dlp's CalledProcessError
+    return (any(marker in message for marker in THROTTLE_MARKERS + TRANSPORT_MARKERS)
+            or SERVER_ERROR_PATTERN.search(message) is not None)
+
+class UpstreamUnavailableError(Exception):
+    """Raised instead of calling an upstream that can't take the call right now."""
+
+
+class CircuitOpenError(UpstreamUnavailableError):
+    """Raised instead of calling an upstream whose circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """
+    Tracks consecutive failures of one upstream. Once the circuit opens, calls are refused
+    until reset_timeout has passed; then a single trial call goes through (half-open) and
+    its outcome closes the circuit or opens it again.
+    """
+    def __init__(self, name, threshold=BREAKER_FAILURE_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    def is_open(self):
+        """True while calls would be refused (without claiming the half-open trial call)."""
+        with self.lock:
+            return self.opened_at is not None and (self.trial_running or time.time() - self.opened_at < self.reset_timeout)
+
+    def before_call(self):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if self.trial_running or time.time() - self.opened_at < self.reset_timeout:
+                raise CircuitOpenError(f"{self.name} is unavailable (circuit open), try again later")
+            self.trial_running = True # Half-open: let this one call through
+
+    def record_success(self):
+        with self.lock:
+            if self.opened_at is not None:
+                logger.info(f"circuit for {self.name} closed again")
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self, counted=True):
+        """A failed call; one the caller will retry isn't `counted`, unless it was the half-open trial."""
+        with self.lock:
+            self.trial_running = False
+            if self.opened_at is None and not counted:
+                return
+            self.failures += 1
+            if self.opened_at is not None or self.failures >= self.threshold:
+                if self.opened_at is None:
+                    logger.warning(f"circuit for {self.name} opened after {self.failures} consecutive failures")
+                self.opened_at = time.time()
+
+    def call(self, fn, *args, **kwargs):
+        self.before_call()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            if is_upstream_failure(e):
+                self.record_failure(counted=not getattr(retry_context, "value", False))
+            else:
+                self.record_success() # The upstream answered; the problem is with this item
+            raise
+        self.record_success()
+        return result
+
+
+SONG_FETCH_ATTEMPTS = int(os.environ.get('SONG_FETCH_ATTEMPTS', 3))
+
+def upstream_unavailable_response(e):
+    """The error response routes return when an upstream's circuit is open."""
+    logger.warning(f"Refusing request: {str(e)}")
+    return {"error": str(e)}, 503, {"Retry-After": str(int(BREAKER_RESET_TIMEOUT))}
+
+
+def fetch_checked(url, **kwargs):
+    """requests.get that raises on 4xx/5xx, so a breaker sees HTTP errors as failures."""
+    response = requests.get(url, **kwargs)
+    response.raise_for_status() # Raise HTTPError for bad responses (4xx or 5xx)
+    return response
+
+
+def backoff_delay(attempt):
+    """Full-jitter exponential backoff: a random delay in [0, min(max, base * 2^attempt)]."""
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+# --- END UPSTREAM RESILIENCE ---
+
+# --- UPSTREAM RATE LIMITING ---
+# Every YouTube Music, yt-dlp and lrclib call goes through an Upstream, which:
+#  - coalesces identical in-flight calls, so a burst for one song costs one upstream call,
+#  - paces calls with a token bucket whose rate adapts AIMD-style: each success raises it
+#    by LIMITER_RATE_STEP calls/s up to the max, each throttling response (429, captcha,
+#    bot check) halves it, so we hover at the highest rate YouTube tolerates,
+#  - serves INTERACTIVE callers (song, stream, search, playlist) before BACKGROUND ones
+#    (radio, lyrics, refresh-ahead, warm-up),
+#  - and finally goes through the upstream's circuit breaker.
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+LIMITER_RATE_STEP = float(os.environ.get('LIMITER_RATE_STEP', 0.1))
+LIMITER_MIN_RATE = float(os.environ.get('LIMITER_MIN_RATE', 0.2))
+INTERACTIVE_MAX_WAIT = float(os.environ.get('INTERACTIVE_MAX_WAIT', 10)) # Seconds before giving up with a 503
+BACKGROUND_MAX_WAIT = float(os.environ.get('BACKGROUND_MAX_WAIT', 60))
+
+# Exception messages that mean the upstream is throttling us
+THROTTLE_MARKERS = ("429", "too many requests", "captcha", "confirm you're not a bot", "rate limit")
+
+# Background threads (and background routes, see background_priority) set this to BACKGROUND
+priority_context = threading.local()
+
+def current_priority():
+    return getattr(priority_context, "value", INTERACTIVE)
+
+# Callers with their own time budget (lyrics lookups) set this to a time.monotonic() deadline;
+# their upstream calls then wait for a token no longer than that
+wait_deadline_context = threading.local()
+
+
+def background_priority(f):
+    """Runs a view's upstream calls in the BACKGROUND lane."""
+    @functools.wraps(f)
+    def decorated_function(*args, **kwargs):
+        previous = current_priority()
+        priority_context.value = BACKGROUND
+        try:
+            return f(*args, **kwargs)
+        finally:
+            priority_context.value = previous
+    return decorated_function
+
+
+class AdaptiveRateLimiter:
+    """Token bucket with an AIMD-adjusted refill rate and an interactive-first queue."""
+    def __init__(self, name, rate, max_rate, burst):
+        self.name = name
+        self.rate = rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.last_decrease = 0
+        self.interactive_waiting = 0
+        self.cond = threading.Condition()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, priority):
+        max_wait = INTERACTIVE_MAX_WAIT if priority == INTERACTIVE else BACKGROUND_MAX_WAIT
+        deadline = time.monotonic() + max_wait
+        caller_deadline = getattr(wait_deadline_context, "value", None)
+        if caller_deadline is not None:
+            deadline = min(deadline, caller_deadline)
+        with self.cond:
+            if priority == INTERACTIVE:
+                self.interactive_waiting += 1
+            try:
+                while True:
+                    self._refill()
+                    # Background callers only get a token when no interactive caller is queued
+                    if self.tokens >= 1 and (priority == INTERACTIVE or not self.interactive_waiting):
+                        self.tokens -= 1
+                        return
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise UpstreamUnavailableError(f"{self.name} is busy, try again later")
+                    self.cond.wait(min(remaining, max(0.01, (1 - self.tokens) / self.rate)))
+            finally:
+                if priority == INTERACTIVE:
+                    self.interactive_waiting -= 1
+                    self.cond.notify_all()
+
+    def available(self):
+        """Tokens in the bucket right now."""
+        with self.cond:
+            self._refill()
+            return self.tokens
+
+    def on_success(self):
+        with self.cond:
+            self.rate = min(self.max_rate, self.rate + LIMITER_RATE_STEP)
+
+    def on_throttle(self):
+        with self.cond:
+            now = time.monotonic()
+            if now - self.last_decrease < 1: # One burst of throttled calls counts as one signal
+                return
+            self.last_decrease = now
+            self.rate = max(LIMITER_MIN_RATE, self.rate / 2)
+            self.tokens = 0
+            logger.warning(f"{self.name} is throttling us, slowing down to {self.rate:.2f} calls/s")
+
+
+class Upstream:
+    """
+    Coalescing, rate limiting and circuit breaking for calls to one upstream service.
+    A pooled upstream spreads its calls over identity_pool, with one rate limiter per identity.
+    """
+    def __init__(self, name, rate, max_rate, burst, pooled=False):
+        self.name = name
+        self.breaker = CircuitBreaker(name)
+        self.limiter = AdaptiveRateLimiter(name, rate, max_rate, burst)
+        self.pooled = pooled
+        self.inflight = {} # {call key: {"future": Future, "followers": int}}
+        self.lock = threading.Lock()
+
+    def current_rate(self):
+        if self.pooled:
+            return sum(i.limiter_for(self).rate for i in identity_pool.identities)
+        return self.limiter.rate
+
+    def call(self, fn, *args, **kwargs):
+        key = repr((getattr(fn, "__qualname__", fn), args, sorted(kwargs.items())))
+        with self.lock:
+            inflight = self.inflight.get(key)
+            if inflight is None:
+                inflight = self.inflight[key] = {"future": Future(), "followers": 0}
+                leader = True
+            else:
+                inflight["followers"] += 1
+                leader = False
+        if not leader:
+            # Same call already running: share its result. Views mutate what they get back
+            # (thumbnail rewriting), so each follower gets its own copy.
+            upstream_calls_total.inc(upstream=self.name, outcome="coalesced")
+            return copy.deepcopy(inflight["future"].result())
+        try:
+            result = self._call(fn, *args, **kwargs)
+        except BaseException as e:
+            inflight["future"].set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.inflight[key]
+        inflight["future"].set_result(result)
+        # Followers copy from the original, so the leader mustn't mutate it under them
+        return copy.deepcopy(result) if inflight["followers"] else result
+
+    def _call(self, fn, *args, **kwargs):
+        identity = identity_pool.choose(self) if self.pooled else None
+        limiter = identity.limiter_for(self) if identity else self.limiter
+        try:
+            if self.breaker.is_open(): # Don't queue for a token just to be refused
+                raise CircuitOpenError(f"{self.name} is unavailable (circuit open), try again later")
+            limiter.acquire(current_priority())
+        except UpstreamUnavailableError:
+            upstream_calls_total.inc(upstream=self.name, outcome="rejected")
+            raise
+        start = time.perf_counter()
+        previous_identity = getattr(identity_context, "value", None)
+        identity_context.value = identity
+        try:
+            result = self.breaker.call(fn, *args, **kwargs)
+        except UpstreamUnavailableError:
+            upstream_calls_total.inc(upstream=self.name, outcome="rejected")
+            raise
+        except Exception as e:
+            message = f"{e} {getattr(e, 'stderr', None) or ''}".lower()
+            outcome = "throttled" if any(marker in message for marker in THROTTLE_MARKERS) else "error"
+            upstream_calls_total.inc(upstream=self.name, outcome=outcome)
+            if identity:
+                identity.record(self, outcome)
+            if outcome == "throttled":
+                limiter.on_throttle()
+            raise
+        finally:
+            identity_context.value = previous_identity
+            elapsed = time.perf_counter() - start
+            upstream_call_seconds.observe(elapsed, upstream=self.name)
+            note_stage(f"upstream:{self.name}", elapsed)
+        upstream_calls_total.inc(upstream=self.name, outcome="ok")
+        if identity:
+            identity.record(self, "ok")
+        limiter.on_success()
+        return result
+
+
+ytmusic_upstream = Upstream("YouTube Music",
+                            rate=float(os.environ.get('YTMUSIC_RATE', 5)),
+                            max_rate=float(os.environ.get('YTMUSIC_MAX_RATE', 20)),
+                            burst=int(os.environ.get('YTMUSIC_BURST', 10)),
+                            pooled=True)
+ytdlp_upstream = Upstream("yt-dlp",
+                          rate=float(os.environ.get('YTDLP_RATE', 2)),
+                          max_rate=float(os.environ.get('YTDLP_MAX_RATE', 5)),
+                          burst=int(os.environ.get('YTDLP_BURST', 4)),
+                          pooled=True)
+lrclib_upstream = Upstream("lrclib", rate=5, max_rate=10, burst=10)
+upstreams = (ytmusic_upstream, ytdlp_upstream, lrclib_upstream)
+# --- END UPSTREAM RATE LIMITING ---
+
+# --- IDENTITY POOL ---
+# YouTube throttles per identity (cookies / account, and IP), so YouTube Music and yt-dlp
+# calls are spread over a pool of identities, each with its own rate limiters: the default
+# one (anonymous, or the COOKIES file for yt-dlp) plus any listed in IDENTITIES, e.g.
+#   IDENTITIES="cookies=/app/a.txt,auth=/app/a.json;cookies=/app/b.txt,proxy=socks5://10.0.0.2:1080"
+# `cookies` is a cookies.txt for yt-dlp, `auth` a ytmusicapi browser/oauth JSON file, `proxy`
+# is used by both, `name` labels the identity in logs and metrics. Each call goes to the
+# identity with the most rate limit headroom. An identity that gets throttled is benched for
+# IDENTITY_BENCH_TIME seconds, doubling on each consecutive throttle up to IDENTITY_BENCH_MAX.
+IDENTITIES = os.environ.get('IDENTITIES', '')
+IDENTITY_BENCH_TIME = float(os.environ.get('IDENTITY_BENCH_TIME', 60))
+IDENTITY_BENCH_MAX = float(os.environ.get('IDENTITY_BENCH_MAX', 15 * 60))
+
+# Upstream._call sets this to the identity the current call runs as
+identity_context = threading.local()
+
+class Identity:
+    def __init__(self, name, cookies=None, auth=None, proxy=None):
+        self.name = name
+        self.cookies = cookies if cookies and os.path.exists(cookies) else None
+        if cookies and not self.cookies:
+            logger.warning(f"cookies file {cookies} for identity {name} not found, using it without cookies")
+        self.auth = auth
+        self.proxy = proxy
+        self.ytmusic = LazyClient(lambda: make_ytmusic(auth, {"http": proxy, "https": proxy} if proxy else None))
+        self.limiters = {} # {upstream name: AdaptiveRateLimiter}
+        self.benched_until = 0
+        self.strikes = 0 # Consecutive throttles
+        self.lock = threading.Lock()
+
+    def limiter_for(self, upstream):
+        with self.lock:
+            limiter = self.limiters.get(upstream.name)
+            if limiter is None:
+                template = upstream.limiter
+                limiter = self.limiters[upstream.name] = AdaptiveRateLimiter(
+                    f"{upstream.name} ({self.name})", template.rate, template.max_rate, template.burst)
+            return limiter
+
+    def is_benched(self):
+        return self.benched_until > time.time()
+
+    def record(self, upstream, outcome):
+        identity_calls_total.inc(identity=self.name, upstream=upstream.name, outcome=outcome)
+        with self.lock:
+            if outcome == "ok":
+                self.strikes = 0
+            elif outcome == "throttled":
+                self.strikes += 1
+                bench_time = min(IDENTITY_BENCH_MAX, IDENTITY_BENCH_TIME * 2 ** (self.strikes - 1))
+                self.benched_until = time.time() + bench_time
+                logger.warning(f"identity {self.name} throttled by {upstream.name}, benched for {bench_time:.0f}s")
+
+    def ytdlp_args(self):
+        args = []
+        if self.cookies:
+            args += ["--cookies", self.cookies]
+        if self.proxy:
+            args += ["--proxy", self.proxy]
+        return args
+
+
+class IdentityPool:
+    def __init__(self, identities):
+        self.identities = identities
+        self.turn = 0
+        self.lock = threading.Lock()
+
+    def choose(self, upstream):
+        """The unbenched identity with the most tokens left for `upstream` (round robin on ties)."""
+        with self.lock:
+            available = [i for i in self.identities if not i.is_benched()]
+            if not available: # Everyone's benched: use whoever comes off the bench first
+                available = [min(self.identities, key=lambda i: i.benched_until)]
+            self.turn += 1
+            rotated = available[self.turn % len(available):] + available[:self.turn % len(available)]
+            return max(rotated, key=lambda i: i.limiter_for(upstream).available())
+
+
+def parse_identities(spec):
+    identities = [Identity("default", cookies=os.environ.get('COOKIES'))]
+    for n, entry in enumerate(filter(None, (e.strip() for e in spec.split(";"))), start=1):
+        options = dict(option.split("=", 1) for option in entry.split(",") if "=" in option)
+        identities.append(Identity(options.get("name", f"identity{n}"), cookies=options.get("cookies"),
+                                   auth=options.get("auth"), proxy=options.get("proxy")))
+    return identities
+
+
+def current_identity():
+    return getattr(identity_context, "value", None) or identity_pool.identities[0]
+
+
+class PooledYTMusic:
+    """
+    Module-level `ytmusic`: ytmusic.get_song(...) runs on the identity of the current upstream
+    call. Methods are looked up lazily so `ytmusic_upstream.call(ytmusic.get_song, ...)` can
+    pick the identity after the method was named.
+    """
+    def __getattr__(self, name):
+        def pooled_method(*args, **kwargs):
+            return getattr(current_identity().ytmusic, name)(*args, **kwargs)
+        pooled_method.__qualname__ = f"YTMusic.{name}" # Part of Upstream's coalescing key
+        return pooled_method
+
+
+def run_ytdlp(cmd, **kwargs):
+    """subprocess.run for a yt-dlp command, with the current identity's cookies and proxy."""
+    identity = current_identity()
+    logger.debug("Running yt-dlp as identity %s", identity.name)
+    return subprocess.run(cmd + identity.ytdlp_args(), **kwargs)
+
+identity_pool = IdentityPool(parse_identities(IDENTITIES))
+ytmusic = PooledYTMusic()
+logger.info(f"Identity pool: {', '.join(i.name for i in identity_pool.identities)}")
+# --- END IDENTITY POOL ---
+
+# --- RESPONSE PROJECTION ---
+# Clients only use a handful of fields out of the ytmusicapi structures. `?fields=a,b.c`
+# keeps only the listed (dotted) paths; lists are projected element by element, so
+# `tracks.videoId` keeps the videoId of every track. `?profile=compact` uses the route's
+# compact field set below, and DEFAULT_RESPONSE_PROFILE=compact makes that the default.
+DEFAULT_RESPONSE_PROFILE = os.environ.get('DEFAULT_RESPONSE_PROFILE', 'full')
+
+SONG_COMPACT_FIELDS = "videoId,title,author,channelId,lengthSeconds,thumbnail"
+PLAYLIST_COMPACT_FIELDS = ("id,title,author,trackCount,duration,thumbnails,"
+                           "tracks.videoId,tracks.title,tracks.artists.name,tracks.artists.id,"
+                           "tracks.album.name,tracks.album.id,tracks.duration,tracks.duration_seconds,"
+                           "tracks.thumbnail,tracks.thumbnails")
+RADIO_COMPACT_FIELDS = ("playlistId,lyrics,tracks.videoId,tracks.title,tracks.length,"
+                        "tracks.artists.name,tracks.artists.id,tracks.album.name,tracks.album.id,"
+                        "tracks.thumbnail")
+SEARCH_COMPACT_FIELDS = ("videoId,title,artists.name,artists.id,album.name,album.id,"
+                         "duration,duration_seconds,thumbnail,thumbnails")
+
+def requested_fields(compact_fields=None):
+    """Returns the normalized field list asked for by the request, or None for the full payload."""
+    fields = request.args.get('fields')
+    if fields:
+        # Sorted so that equivalent projections share a cache entry
+        return ",".join(sorted({f.strip() for f in fields.split(",") if f.strip()}))
+    if compact_fields and request.args.get('profile', DEFAULT_RESPONSE_PROFILE) == 'compact':
+        return compact_fields
+    return None
+
+
+@functools.lru_cache(maxsize=64)
+def parse_fields(fields):
+    """Turns "a,b.c,b.d" into the tree {"a": {}, "b": {"c": {}, "d": {}}}."""
+    tree = {}
+    for path in fields.split(","):
+        node = tree
+        for part in path.split("."):
+            node = node.setdefault(part, {})
+    return tree
+
+
+def project_fields(obj, fields):
+    """Keeps only the requested fields of obj (see RESPONSE PROJECTION)."""
+    if not fields:
+        return obj
+    return _project(obj, parse_fields(fields))
+
+
+def _project(obj, tree):
+    if not tree: # Leaf: keep the whole value
+        return obj
+    if isinstance(obj, list):
+        return [_project(item, tree) for item in obj]
+    if isinstance(obj, dict):
+        return {k: _project(obj[k], sub) for k, sub in tree.items() if k in obj}
+    return obj
+# --- END RESPONSE PROJECTION ---
+
+# --- RESPONSE COMPRESSION ---
+# Everything cached_json serves is already compressed; this covers the remaining JSON
+# and manifest responses (errors, uncached routes, HLS playlists).
+RESPONSE_COMPRESSION = os.environ.get('RESPONSE_COMPRESSION', '1') != '0'
+COMPRESSIBLE_MIMETYPES = ("application/json", "application/x-mpegurl", "text/plain") # Compared lower-cased
+
+@app.after_request
+def compress_response(response):
+    if (not RESPONSE_COMPRESSION
+            or response.direct_passthrough # send_file and other streamed bodies
+            or response.is_streamed
+            or "Content-Encoding" in response.headers
+            or (response.mimetype or "").lower() not in COMPRESSIBLE_MIMETYPES): # Manifests go out as application/x-mpegURL
+        return response
+    body = response.get_data()
+    if len(body) < COMPRESSION_MIN_SIZE:
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = negotiate_encoding(("br", "gzip") if brotli is not None else ("gzip",))
+    if encoding == "br":
+        response.set_data(brotli.compress(body, quality=BROTLI_QUALITY))
+    elif encoding == "gzip":
+        response.set_data(gzip.compress(body, compresslevel=GZIP_LEVEL))
+    else:
+        return response
+    response.headers["Content-Encoding"] = encoding
+    return response
+# --- END RESPONSE COMPRESSION ---
+
 # Dictionary to store segment information: {segment_filename: {original_url, temp_path, status, timestamp}}
 segment_cache = {}
 # Thread pool for downloading segments
-segment_download_executor = ThreadPoolExecutor(max_workers=4)
+segment_download_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="segment-download")
 # Lock for accessing segment_cache
 segment_cache_lock = threading.Lock()
 
-TEMP_SEGMENT_DIR = os.path.join("cache", "segments")
+TEMP_SEGMENT_DIR = os.path.join(os.getcwd(), "cache", "segments") # Absolute: send_file resolves relative paths against the app root, not the cwd
 SEGMENT_PURGE_INTERVAL = 60 * 30 # Purge every 30 minutes
 SEGMENT_LIFETIME = 60 * 60 * 3 # 3 hours
 
-def download_segment_task(segment_filename, original_url, temp_path):
+# SEGMENT_STORAGE=files (default) keeps one file per segment under cache/segments.
+# SEGMENT_STORAGE=packed appends each song's segments to one pack file under cache/packs
+# instead, with an in-memory {segment: (offset, length)} index; a segment is served straight
+# from its byte range of the pack (with sendfile under gunicorn, no copy in Python), and a
+# song is evicted by removing one file. Fewer inodes, fewer unlinks, and a song's segments
+# sit next to each other in the page cache.
+# Packs are opened per append or request, so idle songs don't hold file descriptors.
+SEGMENT_STORAGE = os.environ.get('SEGMENT_STORAGE', 'files')
+PACK_DIR = os.path.join(os.getcwd(), "cache", "packs")
+
+class FileRange(io.RawIOBase):
+    """
+    Bytes [offset, offset + length) of an unbuffered file, as a file of their own. The file's
+    position stays the absolute one, so a server's sendfile (gunicorn's wsgi.file_wrapper
+    lseeks the fileno and sends Content-Length bytes) starts at the range.
+    """
+    def __init__(self, f, offset, length):
+        self.f = f
+        self.start = offset
+        self.end = offset + length
+        self.length = length
+        f.seek(offset)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def fileno(self):
+        return self.f.fileno()
+
+    def tell(self):
+        return self.f.tell() - self.start
+
+    def seek(self, position, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: self.start, io.SEEK_CUR: self.f.tell(), io.SEEK_END: self.end}[whence]
+        return self.f.seek(min(max(base + position, self.start), self.end)) - self.start
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self.end - self.f.tell())
+        if size <= 0:
+            return 0
+        return self.f.readinto(memoryview(buffer)[:size])
+
+    def close(self):
+        self.f.close()
+        super().close()
+
+
+class SegmentPack:
+    """One song's downloaded segments, appended to a single file."""
+    def __init__(self, path):
+        self.path = path
+        self.index = {} # {segment_filename: (offset, length)}
+        self.deleted = False
+        self.last_access = time.time()
+        self.lock = threading.Lock()
+
+    def append(self, segment_filename, data):
+        with self.lock:
+            if self.deleted:
+                return
+            with open(self.path, "ab") as f:
+                offset = f.seek(0, os.SEEK_END)
+                f.write(data)
+            self.index[segment_filename] = (offset, len(data))
+            self.last_access = time.time()
+
+    def open(self, segment_filename):
+        """A FileRange over the segment's bytes (the caller closes it), or None if it isn't in this pack."""
+        with self.lock:
+            if segment_filename not in self.index or self.deleted:
+                return None
+            offset, length = self.index[segment_filename]
+            self.last_access = time.time()
+        try:
+            # Outside the lock: written ranges never change, so reads don't wait on appends
+            return FileRange(open(self.path, "rb", buffering=0), offset, length)
+        except FileNotFoundError: # Evicted meanwhile
+            return None
+
+    def delete(self):
+        with self.lock:
+            self.deleted = True
+            try:
+                os.remove(self.path)
+            except OSError as e:
+                logger.warning(f"error removing segment pack {self.path}: {str(e)}")
+
+
+# {video_id: SegmentPack}. Pack files carry the pid: gunicorn workers share cache/ but not
+# their indexes, so each worker appends to its own packs.
+segment_packs = {}
+segment_packs_lock = threading.Lock()
+
+def segment_pack(song_id):
+    with segment_packs_lock:
+        pack = segment_packs.get(song_id)
+        if pack is None:
+            os.makedirs(PACK_DIR, exist_ok=True)
+            pack = segment_packs[song_id] = SegmentPack(os.path.join(PACK_DIR, f"{song_id}-{os.getpid()}.pack"))
+        return pack
+
+
+def evict_idle_packs(now):
+    """Drops the packs (and their segment_cache entries) of songs not played for SEGMENT_LIFETIME."""
+    with segment_packs_lock:
+        idle = {song_id: pack for song_id, pack in segment_packs.items() if now - pack.last_access > SEGMENT_LIFETIME}
+        for song_id in idle:
+            del segment_packs[song_id]
+    if not idle:
+        return
+    with segment_cache_lock:
+        for segment_filename in [f for f, info in segment_cache.items() if info.get('song') in idle]:
+            del segment_cache[segment_filename]
+    for song_id, pack in idle.items():
+        pack.delete()
+        logger.debug("evicted segment pack of %s", song_id)
+
+def download_segment_task(segment_filename, original_url, temp_path, queued_at=None):
     """Downloads a single TS segment and updates the cache."""
-    # print(f"Starting download for segment {segment_filename} from {original_url}") # Uncomment for verbose segment logging
+    log_sampled(logging.DEBUG, "Starting download for segment %s from %s", segment_filename, original_url)
+    download_start = time.perf_counter()
+    if queued_at is not None:
+        observe_stage("queue_wait", download_start - queued_at)
+    with segment_cache_lock:
+        song_id = segment_cache.get(segment_filename, {}).get('song')
     try:
         # Add a timeout for fetching individual segments
         response = requests.get(original_url, stream=True, timeout=10)
         response.raise_for_status()
-        with open(temp_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
+        size = 0
+        if SEGMENT_STORAGE == "packed" and song_id:
+            data = response.content
+            size = len(data)
+            segment_pack(song_id).append(segment_filename, data)
+        else:
+            # Segment files are shared by all workers (named by URL), so write a private file and
+            # rename it into place: a file someone is serving is never truncated or half-written
+            fd, part_path = tempfile.mkstemp(dir=TEMP_SEGMENT_DIR, suffix=".part")
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    for chunk in response.iter_content(chunk_size=8192):
+                        f.write(chunk)
+                        size += len(chunk)
+                os.replace(part_path, temp_path)
+            except BaseException:
+                os.remove(part_path)
+                raise
+            song_id = None # Stored as a file
+        observe_stage("segment_download", time.perf_counter() - download_start)
+        segment_download_bytes_total.inc(size)
+        segment_downloads_total.inc(outcome="ok")
         with segment_cache_lock:
             if segment_filename in segment_cache:
                 segment_cache[segment_filename]['status'] = 'downloaded'
                 segment_cache[segment_filename]['timestamp'] = time.time()
-                # print(f"Segment {segment_filename} downloaded successfully.") # Uncomment for verbose segment logging
+                segment_cache[segment_filename]['packed'] = song_id is not None
+                log_sampled(logging.DEBUG, "Segment %s downloaded successfully.", segment_filename)
             else:
                  # This case should ideally not happen if logic is correct, but good to log
-                 print(f"warning: segment {segment_filename} finished download but was removed from cache?")
+                 logger.warning(f"segment {segment_filename} finished download but was removed from cache?")
                  # Clean up the downloaded file if its entry is gone
                  if os.path.exists(temp_path):
-                     try: os.remove(temp_path); print(f"cleaned up orphaned segment file {temp_path}")
-                     except OSError as e: print(f"error cleaning up orphaned segment file {temp_path}: {str(e)}")
+                     try: os.remove(temp_path); logger.debug("cleaned up orphaned segment file %s", temp_path)
+                     except OSError as e: logger.warning(f"error cleaning up orphaned segment file {temp_path}: {str(e)}")
 
     except requests.exceptions.RequestException as e:
-        print(f"error downloading segment {segment_filename} from {original_url}: {str(e)}")
+        logger.warning(f"error downloading segment {segment_filename} from {original_url}: {str(e)}")
+        segment_downloads_total.inc(outcome="failed")
         with segment_cache_lock:
             if segment_filename in segment_cache:
                 segment_cache[segment_filename]['status'] = 'failed'
                 segment_cache[segment_filename]['timestamp'] = time.time() # Update timestamp even on failure
 
     except Exception as e:
-         print(f"unexpected error in segment download task {segment_filename}: {str(e)}")
+         logger.exception(f"unexpected error in segment download task {segment_filename}: {str(e)}")
+         segment_downloads_total.inc(outcome="failed")
          with segment_cache_lock:
             if segment_filename in segment_cache:
                 segment_cache[segment_filename]['status'] = 'failed'
@@ -107,15 +1586,18 @@ def download_segment_task(segment_filename, original_url, temp_path):
 def start_segment_downloads(segments_info):
     """Submits segment download tasks to the thread pool."""
     for segment_filename, original_url, temp_path in segments_info:
-        segment_download_executor.submit(download_segment_task, segment_filename, original_url, temp_path)
-        # print(f"Submitted download task for {segment_filename}") # Uncomment for verbose segment logging
+        segment_download_executor.submit(download_segment_task, segment_filename, original_url, temp_path, time.perf_counter())
 
 
 def purge_old_segments():
     """Background task to periodically remove old segment files and cache entries."""
-    print("Starting segment purging thread...")
+    logger.info("Starting segment purging thread...")
     while True:
         current_time = time.time()
+        with manifest_cache_lock:
+            for id in [id for id, entry in manifest_cache.items() if entry["expires"] <= current_time]:
+                del manifest_cache[id]
+        evict_idle_packs(current_time) # Packed segments go a whole song at a time
         to_purge = []
         with segment_cache_lock:
             # Create a list of items to purge first, then modify the cache
@@ -123,36 +1605,35 @@ def purge_old_segments():
             segment_filenames_to_check = list(segment_cache.keys())
             for segment_filename in segment_filenames_to_check:
                  info = segment_cache.get(segment_filename) # Get the info again in case it changed
-                 if info and current_time - info.get('timestamp', 0) > SEGMENT_LIFETIME:
+                 if info and not info.get('packed') and current_time - info.get('timestamp', 0) > SEGMENT_LIFETIME:
                     to_purge.append((segment_filename, info['temp_path']))
                     # Remove from cache immediately inside the lock
                     del segment_cache[segment_filename]
 
 
-        # Now purge the files outside the lock
+        # Now purge the files outside the lock. Other workers share these files, so one that was
+        # written or served recently (its mtime) stays even though this worker is done with it.
         for segment_filename, temp_path in to_purge:
             try:
-                if os.path.exists(temp_path):
+                if current_time - os.path.getmtime(temp_path) > SEGMENT_LIFETIME:
                     os.remove(temp_path)
-                    print(f"purged old segment file: {temp_path}")
+                    logger.debug("purged old segment file: %s", temp_path)
+            except FileNotFoundError:
+                pass # Already purged by another worker
             except OSError as e:
-                print(f"error purging segment file {temp_path}: {str(e)}")
+                logger.warning(f"error purging segment file {temp_path}: {str(e)}")
             except Exception as e:
-                 print(f"unexpected error purging segment file {temp_path}: {str(e)}")
+                 logger.exception(f"unexpected error purging segment file {temp_path}: {str(e)}")
 
 
         time.sleep(SEGMENT_PURGE_INTERVAL)
 
-# Start the background purging thread
-purging_thread = threading.Thread(target=purge_old_segments, daemon=True)
-purging_thread.start()
-
 
-# Note: The original get_audio function using yt-dlp to download a single file (mp3/opus/m4a)
-# is kept, but the frontend is using the HLS streamHLS endpoint, so this route might not be used often.
+# get_audio downloads a single file (mp3/opus/m4a) with yt-dlp. /song/<id>/stream and prefetch
+# only use it when the parallel download can't (AUDIO_DOWNLOAD_CONCURRENCY=0, or no usable URL).
 def get_audio(video_url, id):
     """Downloads a single audio file using yt-dlp."""
-    print(f"Starting single audio download for {video_url} (ID: {id})")
+    logger.info(f"Starting single audio download for {video_url} (ID: {id})")
     cmd = [
         sys.executable, "-m", "yt_dlp",
         video_url,
@@ -162,19 +1643,14 @@ def get_audio(video_url, id):
         "--force-keyframes-at-chapters", # Might help with seeking
         "--output", f"{os.getcwd()}/cache/{id}.%(ext)s" # Output filename format
     ]
-    cookies_path = os.environ.get('COOKIES')
-    if cookies_path and os.path.exists(cookies_path): # Check if cookies file exists
-        cmd.extend(['--cookies', cookies_path])
-        print(f"Using cookies from: {cookies_path}")
-    else:
-        print("No valid COOKIES environment variable or file found, proceeding without cookies.")
 
-    print(f"Executing yt-dlp command: {' '.join(cmd)}")
+    logger.debug("Executing yt-dlp command: %s", cmd)
     # Added a timeout for the entire yt-dlp download process
-    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, timeout=120) # Increased timeout for download
+    # Through ytdlp_upstream for the identity's cookies/proxy (run_ytdlp adds them) and its rate limit
+    result = ytdlp_upstream.call(run_ytdlp, cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, timeout=120) # Increased timeout for download
 
-    print("yt-dlp stdout:", result.stdout)
-    print("yt-dlp stderr:", result.stderr)
+    logger.debug("yt-dlp stdout: %s", result.stdout)
+    logger.debug("yt-dlp stderr: %s", result.stderr)
 
 
     if result.returncode != 0:
@@ -190,19 +1666,19 @@ def get_audio(video_url, id):
              parts = line.split("Destination:")
              if len(parts) > 1:
                  downloaded_file = parts[1].strip()
-                 print(f"Parsed destination from stdout: {downloaded_file}")
+                 logger.debug("Parsed destination from stdout: %s", downloaded_file)
                  break
         if "[Merger]" in line and "Destination:" in line: # Sometimes Merged (e.g. video+audio or formats)
              parts = line.split("Destination:")
              if len(parts) > 1:
                  downloaded_file = parts[1].strip()
-                 print(f"Parsed destination from stdout (Merger): {downloaded_file}")
+                 logger.debug("Parsed destination from stdout (Merger): %s", downloaded_file)
                  break
 
 
     # Fallback if parsing stdout fails or file doesn't exist at reported path
     if not downloaded_file or not os.path.exists(downloaded_file):
-         print("Could not find downloaded file path from yt-dlp output or file doesn't exist. Searching cache dir...")
+         logger.debug("Could not find downloaded file path from yt-dlp output or file doesn't exist. Searching cache dir...")
          cache_dir = os.path.join(os.getcwd(), "cache")
          # List files starting with the ID and ending with common audio extensions
          potential_files = [f for f in os.listdir(cache_dir) if f.startswith(f"{id}.") and (f.endswith('.opus') or f.endswith('.m4a') or f.endswith('.mp3') or f.endswith('.aac') or f.endswith('.webm') or f.endswith('.ogg'))]
@@ -211,7 +1687,7 @@ def get_audio(video_url, id):
 
          if potential_files:
              downloaded_file = os.path.join(cache_dir, potential_files[0])
-             print(f"Found potential file in cache dir: {downloaded_file}")
+             logger.debug("Found potential file in cache dir: %s", downloaded_file)
 
          if not downloaded_file or not os.path.exists(downloaded_file):
               raise Exception(f"yt-dlp finished without error but could not find downloaded file for ID: {id}. Looked for {id}.* in cache. stdout: {result.stdout[:500]}, stderr: {result.stderr[:500]}")
@@ -220,6 +1696,245 @@ def get_audio(video_url, id):
     return downloaded_file # Return the path to the downloaded file
 
 
+# --- PARALLEL AUDIO DOWNLOAD ---
+# googlevideo throttles each connection for audio formats, so /song/<id>/stream fetches
+# the audio URL in AUDIO_CHUNK_SIZE byte ranges over AUDIO_DOWNLOAD_CONCURRENCY connections,
+# writing each range at its offset in cache/<id>.<ext>.part. Ranges are claimed in order, so
+# the start of the file fills in first, and requesters are streamed the contiguous prefix as
+# it grows instead of waiting for the whole file. Concurrent requesters of the same song
+# share one download. If the URL can't be resolved, or the server ignores Range, the
+# download falls back to a single connection or to get_audio (yt-dlp).
+# AUDIO_DOWNLOAD_CONCURRENCY=0 always uses get_audio.
+AUDIO_CHUNK_SIZE = int(os.environ.get('AUDIO_CHUNK_SIZE', 1024 * 1024))
+AUDIO_DOWNLOAD_CONCURRENCY = int(os.environ.get('AUDIO_DOWNLOAD_CONCURRENCY', 4))
+AUDIO_CHUNK_ATTEMPTS = 3
+AUDIO_CACHE_DIR = os.path.join(os.getcwd(), "cache")
+AUDIO_MIMETYPES = {".opus": "audio/opus", ".m4a": "audio/mp4", ".mp3": "audio/mpeg",
+                   ".aac": "audio/aac", ".webm": "audio/webm", ".ogg": "audio/ogg"}
+
+def audio_mimetype(path):
+    return AUDIO_MIMETYPES.get(os.path.splitext(path)[1], "audio/mpeg")
+
+
+def cached_audio_path(id):
+    """The song's complete audio file in the cache, or None."""
+    for ext in AUDIO_MIMETYPES:
+        path = os.path.join(AUDIO_CACHE_DIR, id + ext)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def resolve_audio_url(id):
+    """Returns (url, ext) of the song's best progressive (plain HTTP, rangeable) audio format."""
+    cmd = [
+        sys.executable, "-m", "yt_dlp",
+        f"https://youtube.com/watch?v={id}",
+        "-f", "bestaudio[ext=m4a][protocol=https]/bestaudio[protocol=https]/bestaudio[protocol=http]",
+        "--no-playlist",
+        "--print", "ext",
+        "--print", "url",
+    ]
+    with timed_stage("resolve"):
+        result = ytdlp_upstream.call(run_ytdlp, cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, timeout=15, check=True)
+    lines = result.stdout.strip().splitlines()
+    if len(lines) < 2 or not lines[-1].startswith("http"):
+        raise Exception(f"yt-dlp returned no audio URL: {result.stdout[:300]}")
+    return lines[-1], lines[-2]
+
+
+class AudioDownload:
+    """A ranged, multi-connection download of one song into the audio cache, readable while it's written."""
+    def __init__(self, id):
+        self.id = id
+        self.url = None
+        self.fd = None
+        self.path = None
+        self.part_path = None
+        self.size = None # Known once the first range answered
+        self.available = 0 # Bytes from the start of the file that are written
+        self.written = {} # {start: end} of written pieces past `available`
+        self.next_offset = 0
+        self.finished = False
+        self.error = None
+        self.cond = threading.Condition()
+
+    def run(self, priority=INTERACTIVE):
+        priority_context.value = priority # For resolving the URL
+        start = time.perf_counter()
+        fd = None
+        try:
+            self.url, ext = resolve_audio_url(self.id)
+            # A private part file: another worker process may be downloading the same song
+            fd, part_path = tempfile.mkstemp(dir=AUDIO_CACHE_DIR, suffix=".part")
+            os.fchmod(fd, 0o644)
+            with self.cond:
+                self.path = os.path.join(AUDIO_CACHE_DIR, f"{self.id}.{ext}")
+                self.fd, self.part_path = fd, part_path
+            first = requests.get(self.url, headers={"Range": f"bytes=0-{AUDIO_CHUNK_SIZE - 1}"}, stream=True, timeout=15)
+            first.raise_for_status()
+            content_range = first.headers.get("Content-Range", "")
+            if first.status_code == 206 and "/" in content_range and not content_range.endswith("*"):
+                with self.cond:
+                    self.size = int(content_range.rsplit("/", 1)[1])
+                    self.next_offset = AUDIO_CHUNK_SIZE
+                    self.cond.notify_all()
+                chunks = -(-self.size // AUDIO_CHUNK_SIZE)
+                workers = [threading.Thread(target=self.fetch_chunks, name=f"audio-{self.id}-{n}", daemon=True)
+                           for n in range(min(AUDIO_DOWNLOAD_CONCURRENCY, chunks) - 1)]
+                for worker in workers:
+                    worker.start()
+                self.write_body(first, 0)
+                self.fetch_chunks()
+                for worker in workers:
+                    worker.join()
+            else:
+                # No range support: a plain single-connection download, size unknown until it's done
+                logger.info(f"audio URL for {self.id} ignores Range, downloading over one connection")
+                with self.cond:
+                    self.cond.notify_all()
+                self.write_body(first, 0)
+                with self.cond:
+                    self.size = self.available
+            if self.error:
+                raise self.error
+            if self.available != self.size:
+                raise Exception(f"audio download of {self.id} incomplete: {self.available} of {self.size} bytes")
+            os.close(fd)
+            fd = None
+            os.replace(self.part_path, self.path)
+            observe_stage("audio_download", time.perf_counter() - start)
+            logger.info(f"Downloaded audio for {self.id} ({self.size} bytes) in {time.perf_counter() - start:.1f}s")
+            with self.cond:
+                self.finished = True
+                self.cond.notify_all()
+        except Exception as e:
+            logger.warning(f"parallel audio download of {self.id} failed: {str(e)}")
+            with self.cond:
+                self.error = self.error or e
+                self.cond.notify_all()
+            if fd is not None:
+                os.close(fd)
+            if self.part_path and os.path.exists(self.part_path):
+                os.remove(self.part_path)
+        finally:
+            with audio_downloads_lock:
+                audio_downloads.pop(self.id, None)
+
+    def claim_chunk(self):
+        with self.cond:
+            if self.error is not None or self.next_offset >= self.size:
+                return None
+            offset = self.next_offset
+            self.next_offset += AUDIO_CHUNK_SIZE
+            return offset
+
+    def fetch_chunks(self):
+        while True:
+            offset = self.claim_chunk()
+            if offset is None:
+                return
+            end = min(self.size, offset + AUDIO_CHUNK_SIZE)
+            position = offset
+            for attempt in range(AUDIO_CHUNK_ATTEMPTS):
+                try:
+                    response = requests.get(self.url, headers={"Range": f"bytes={position}-{end - 1}"}, stream=True, timeout=15)
+                    response.raise_for_status()
+                    if response.status_code != 206:
+                        raise Exception(f"expected 206 for a range request, got {response.status_code}")
+                    position = self.write_body(response, position)
+                    if position >= end:
+                        break
+                except Exception as e:
+                    if attempt == AUDIO_CHUNK_ATTEMPTS - 1:
+                        with self.cond:
+                            self.error = self.error or e
+                            self.cond.notify_all()
+                        return
+                    time.sleep(backoff_delay(attempt)) # Then resume from `position`
+
+    def write_body(self, response, position):
+        """Writes a response body at `position`, publishing each piece. Returns the position after it."""
+        for data in response.iter_content(chunk_size=64 * 1024):
+            os.pwrite(self.fd, data, position)
+            self.mark_written(position, position + len(data))
+            position += len(data)
+        return position
+
+    def mark_written(self, start, end):
+        with self.cond:
+            self.written[start] = end
+            while self.available in self.written:
+                self.available = self.written.pop(self.available)
+            self.cond.notify_all()
+
+    def wait_started(self, timeout=60):
+        """Waits until there's something to stream; False if the download failed before that."""
+        with self.cond:
+            self.cond.wait_for(lambda: self.size is not None or self.available or self.error is not None or self.finished, timeout)
+            return self.error is None and self.part_path is not None
+
+    def wait_finished(self, timeout=600):
+        """Waits for the whole file; False if the download failed or is still running after `timeout`."""
+        with self.cond:
+            self.cond.wait_for(lambda: self.finished or self.error is not None, timeout)
+            return self.finished
+
+    def stream(self):
+        """Generator over the file's bytes, following the download; opened now so it survives the final rename."""
+        with self.cond:
+            try:
+                f = open(self.path if self.finished else self.part_path, "rb")
+            except FileNotFoundError: # Renamed between the check and the open
+                f = open(self.path, "rb")
+        def generate():
+            position = 0
+            with f:
+                while True:
+                    with self.cond:
+                        self.cond.wait_for(lambda: self.available > position or self.finished or self.error is not None, 30)
+                        available, finished, error = self.available, self.finished, self.error
+                    if position >= available:
+                        if error is not None:
+                            logger.warning(f"stopped streaming {self.id} at byte {position}: {str(error)}")
+                        if finished or error is not None:
+                            return
+                        continue
+                    f.seek(position)
+                    data = f.read(min(64 * 1024, available - position))
+                    if not data: # The file is shorter than what was written to it
+                        logger.warning("stopped streaming %s at byte %s: part file truncated", self.id, position)
+                        return
+                    position += len(data)
+                    yield data
+        return generate()
+
+
+# {video_id: AudioDownload} for downloads in progress
+audio_downloads = {}
+audio_downloads_lock = threading.Lock()
+
+def audio_download(id, priority=INTERACTIVE):
+    """The song's in-progress download, starting one if there's none."""
+    with audio_downloads_lock:
+        download = audio_downloads.get(id)
+        if download is None:
+            download = audio_downloads[id] = AudioDownload(id)
+            threading.Thread(target=download.run, args=(priority,), name=f"audio-{id}", daemon=True).start()
+    return download
+
+
+def stream_audio_download(download):
+    """A streamed response following `download`, or None if the download failed before it started."""
+    if not download.wait_started():
+        return None
+    headers = {"Cache-Control": "no-cache"}
+    if download.size is not None:
+        headers["Content-Length"] = str(download.size)
+    return Response(download.stream(), 200, headers, mimetype=audio_mimetype(download.path), direct_passthrough=True)
+# --- END PARALLEL AUDIO DOWNLOAD ---
+
+
 @app.route("/")
 def hi():
     return {"hello":"this is a libytm instance"}
@@ -233,7 +1948,7 @@ def lh3(url:str):
 
     # Basic check if it looks like a full URL
     if not decoded_url.startswith("http://") and not decoded_url.startswith("https://"):
-         print(f"Attempted proxy access with non-absolute URL: {decoded_url}")
+         logger.warning(f"Attempted proxy access with non-absolute URL: {decoded_url}")
          return {"error":"Provided path is not a valid absolute URL."}, 422
 
 
@@ -244,14 +1959,14 @@ def lh3(url:str):
     try:
         parsed_url = urllib.parse.urlparse(decoded_url)
         if not parsed_url.hostname or not parsed_url.hostname.endswith(allowed_domains):
-             print(f"Attempted proxy access to disallowed domain: {parsed_url.hostname} (from {decoded_url})")
+             logger.warning(f"Attempted proxy access to disallowed domain: {parsed_url.hostname} (from {decoded_url})")
              return {"error":"Access to this external URL's domain is not allowed via proxy."}, 422
     except Exception as e:
-         print(f"Error parsing URL {decoded_url}: {str(e)}")
+         logger.warning(f"Error parsing URL {decoded_url}: {str(e)}")
          return {"error":"Invalid URL format."}, 422
 
 
-    print(f"Proxying request for: {decoded_url}")
+    log_sampled(logging.DEBUG, "Proxying request for: %s", decoded_url)
     headers = {
        "Accept":'*/*',
        # Identify your service, recommended for external requests
@@ -274,41 +1989,46 @@ def lh3(url:str):
         return Response(res.content, res.status_code, response_headers)
 
     except requests.exceptions.Timeout:
-        print(f"Timeout proxying URL {decoded_url}")
+        logger.warning(f"Timeout proxying URL {decoded_url}")
         return {"error": "Proxy request to external resource timed out."}, 504 # Gateway Timeout
 
     except requests.exceptions.RequestException as e:
-        print(f"Error proxying URL {decoded_url}: {str(e)}")
+        logger.warning(f"Error proxying URL {decoded_url}: {str(e)}")
         return {"error": f"Failed to fetch external resource: {str(e)}"}, 502 # Bad Gateway or Internal Server Error
 
     except Exception as e:
-        print(f"Unexpected error in proxy route for {decoded_url}: {str(e)}")
+        logger.exception(f"Unexpected error in proxy route for {decoded_url}: {str(e)}")
         return {"error": "Internal server error during proxy request."}, 500
 
 
-@cache.cached(timeout=300)
 @app.route("/song/<id>")
+@cached_json(timeout=300, compact_fields=SONG_COMPACT_FIELDS)
 def getSong(id):
-    # Increased retry logic and added more robust error handling
-    tries = 0
+    # Retries with jittered backoff; gives up early if the YouTube Music circuit is open
     song = None
-    while tries < 5:
-        try:
-            # Ensure signatureTimestamp is correctly obtained if necessary
-            # ytmusicapi v1.0.0+ handles this automatically, but keeping the call is safe
-            # sig_timestamp = ytmusic.get_signatureTimestamp() # Not needed in recent versions
-            song = ytmusic.get_song(videoId=id) # signatureTimestamp might not be needed
-            if song and song.get("videoDetails"):
-                break # Successfully got details
-            print(f"Attempt {tries+1}: get_song returned data but no videoDetails for ID {id}. Response keys: {song.keys() if song else 'None'}")
-        except Exception as e:
-            print(f"Attempt {tries+1}: Error fetching song {id}: {str(e)}")
-        tries += 1
-        time.sleep(0.5) # Wait a bit before retrying
+    error = None
+    try:
+        for attempt in range(SONG_FETCH_ATTEMPTS):
+            if attempt:
+                time.sleep(backoff_delay(attempt - 1))
+            retry_context.value = attempt < SONG_FETCH_ATTEMPTS - 1 # Only the last attempt counts toward the breaker
+            try:
+                song = ytmusic_upstream.call(ytmusic.get_song, videoId=id)
+                if song and song.get("videoDetails"):
+                    break # Successfully got details
+                logger.warning(f"Attempt {attempt+1}: get_song returned data but no videoDetails for ID {id}. Response keys: {song.keys() if song else 'None'}")
+            except UpstreamUnavailableError as e:
+                return upstream_unavailable_response(e)
+            except Exception as e:
+                error = e
+                logger.warning(f"Attempt {attempt+1}: Error fetching song {id}: {str(e)}")
+    finally:
+        retry_context.value = False
 
     if song and song.get("videoDetails"):
         # Add thumbnail proxying here
         video_details = song["videoDetails"]
+        cache.set(f"song_details/{id}", video_details, timeout=SONG_DETAILS_TTL) # Pickled now, before the rewriting below
         if video_details.get("thumbnail", {}).get("thumbnails"):
              # Assuming the best thumbnail is the last one in the list (often highest resolution)
              thumbnails = video_details["thumbnail"]["thumbnails"]
@@ -327,17 +2047,42 @@ def getSong(id):
     elif song is not None:
          # Got a response, but missing videoDetails (might indicate geo restriction or API change)
          return {"error":"Could not find song details (API response missing 'videoDetails'). The song might be unavailable or restricted."}, 404
+    elif error is not None and not is_upstream_failure(error):
+        # Fails for this video only: a 404, so cached_json caches it for NEGATIVE_CACHE_TTL
+        return {"error": f"Could not fetch song details for this video: {str(error)}"}, 404
     else:
         # Did not get any valid response after retries
         return {"error":"Could not fetch song details from API after multiple retries. Check logs for API errors."}, 500
 
 
-@cache.cached(timeout=300)
+SONG_DETAILS_TTL = 300 # As long as getSong's own response is cached
+
+def song_details(id):
+    """
+    The song's videoDetails (title, author, lengthSeconds...), from the copy getSong keeps in
+    the cache; on a miss, one upstream call. None if YouTube Music has no details for it.
+    """
+    details = cache.get(f"song_details/{id}")
+    if details is None:
+        song = ytmusic_upstream.call(ytmusic.get_song, videoId=id)
+        details = (song or {}).get("videoDetails")
+        if details:
+            cache.set(f"song_details/{id}", details, timeout=SONG_DETAILS_TTL)
+    return details
+
+
+def cached_song_or_error(id):
+    """The song's cached videoDetails, or getSong's result (details or its error response) on a miss."""
+    details = cache.get(f"song_details/{id}")
+    return details if details is not None else getSong.uncached(id)
+
+
 @app.route("/playlist/<id>")
+@cached_json(timeout=300, compact_fields=PLAYLIST_COMPACT_FIELDS)
 def getPlaylist(id):
     try:
         # ytmusic.get_playlist handles missing playlists by raising an exception
-        pl = ytmusic.get_playlist(playlistId=id)
+        pl = ytmusic_upstream.call(ytmusic.get_playlist, playlistId=id)
         if pl:
              # Optional: Proxy playlist thumbnails too
              if pl.get("thumbnails"):
@@ -362,8 +2107,10 @@ def getPlaylist(id):
         else:
             # Should not happen based on ytmusicapi behavior, but added for safety
             return {"error":"could not find playlist or playlist is empty"}, 404
+    except UpstreamUnavailableError as e:
+        return upstream_unavailable_response(e)
     except Exception as e:
-        print(f"Error fetching playlist {id}: {str(e)}")
+        logger.warning(f"Error fetching playlist {id}: {str(e)}")
         # Check if the exception is likely a "not found" from ytmusicapi
         error_str = str(e).lower()
         if "private or does not exist" in error_str or "invalid playlist id" in error_str or "404" in error_str:
@@ -374,9 +2121,34 @@ def getPlaylist(id):
 # HLS STREAMING ENDPOINTS
 # These are covered by the updated CORS configuration
 
-@app.route("/song/<id>/streamHLS.m3u8")
-def getstream_experimental(id):
-    """Fetches the m3u8 playlist for a song and rewrites segment URLs."""
+STREAM_URL_LIFETIME = 60 * 60 # Fallback lifetime of a resolved stream URL when it carries no expire= param
+STREAM_URL_EXPIRY_MARGIN = 60 * 5 # Stop reusing a resolved URL this long before googlevideo expires it
+
+# Resolved stream URLs: {video_id: (url, expires_at)}
+stream_url_cache = {}
+stream_url_cache_lock = threading.Lock()
+
+def stream_url_expiry(url):
+    """Returns when a resolved googlevideo URL stops being usable (its expire= query param)."""
+    query = urllib.parse.parse_qs(urllib.parse.urlparse(url).query)
+    try:
+        return int(query["expire"][0]) - STREAM_URL_EXPIRY_MARGIN
+    except (KeyError, IndexError, ValueError):
+        return time.time() + STREAM_URL_LIFETIME
+
+
+def resolve_stream_url(id):
+    """
+    Returns the best audio stream URL for a song, running yt-dlp only if there's no unexpired
+    URL cached for it. Raises subprocess.CalledProcessError / TimeoutExpired like subprocess.run.
+    """
+    with stream_url_cache_lock:
+        cached = stream_url_cache.get(id)
+    if cached and cached[1] > time.time():
+        cache_requests_total.inc(cache="stream_url", result="hit")
+        return cached[0]
+    cache_requests_total.inc(cache="stream_url", result="miss")
+
     # yt-dlp command to get the HLS playlist URL for the best audio stream
     cmd = [
         sys.executable, "-m", "yt_dlp",
@@ -385,132 +2157,231 @@ def getstream_experimental(id):
         "--no-playlist", # Ensure only the single video is processed
         "-g" # Print the direct URL
     ]
-    cookies_path = os.environ.get('COOKIES')
-    if cookies_path and os.path.exists(cookies_path): # Check if cookies file exists
-        cmd.extend(['--cookies', cookies_path])
-        print(f"Using cookies for yt-dlp stream URL fetch from: {cookies_path}")
-    else:
-        print("No valid COOKIES environment variable or file found for stream URL fetch.")
 
-    print(f"Executing yt-dlp command for stream URL: {' '.join(cmd)}")
+    logger.debug("Executing yt-dlp command for stream URL: %s", cmd)
     # Added timeout for yt-dlp execution itself
-    try:
-        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, timeout=15, check=True) # Added check=True to raise exception on non-zero exit
-        m3u8_url = result.stdout.strip()
-    except subprocess.CalledProcessError as e:
-         error_output = e.stderr or e.stdout or "Unknown yt-dlp error getting stream URL"
-         print(f"yt-dlp failed with exit code {e.returncode} for stream URL of {id}: {error_output}")
-         return {"error": f"Failed to get streaming URL for song (yt-dlp error): {error_output[:300]}..."}, 500
-    except subprocess.TimeoutExpired:
-         print(f"yt-dlp timed out getting stream URL for {id}.")
-         return {"error": "Timed out getting streaming URL."}, 504 # Gateway Timeout
-    except Exception as e:
-         print(f"Unexpected error running yt-dlp for stream URL of {id}: {str(e)}")
-         return {"error": f"Internal server error getting streaming URL: {str(e)}"}, 500
-
+    with timed_stage("resolve"):
+        result = ytdlp_upstream.call(run_ytdlp, cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, timeout=15, check=True) # Added check=True to raise exception on non-zero exit
+    m3u8_url = result.stdout.strip()
+    logger.debug("yt-dlp stdout (stream URL): %s", m3u8_url)
+    logger.debug("yt-dlp stderr (stream URL): %s", result.stderr)
 
-    print("yt-dlp stdout (stream URL):", m3u8_url)
-    # print("yt-dlp stderr (stream URL):", result.stderr) # Can be noisy, uncomment if needed
+    if m3u8_url.startswith("http"): # Only cache something usable; the caller reports the rest
+        with stream_url_cache_lock:
+            stream_url_cache[id] = (m3u8_url, stream_url_expiry(m3u8_url))
+    return m3u8_url
 
-    if not m3u8_url.startswith("http"):
-         print(f"Error: yt-dlp returned non-http URL: {m3u8_url}")
-         return {"error": "Failed to get a valid streaming URL from YouTube."}, 500
 
-    print(f"Fetching m3u8 playlist from: {m3u8_url}")
+def fetch_manifest(id, m3u8_url):
+    """Downloads the HLS manifest; raises requests exceptions on failure."""
+    logger.debug("Fetching m3u8 playlist from: %s", m3u8_url)
     headers = {
        # Use a more standard User-Agent for fetching the HLS manifest
        "User-Agent":"Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/108.0.0.0 Safari/537.36",
        "Accept":"application/x-mpegURL, application/vnd.apple.mpegurl, */*",
        "Referer": f"https://music.youtube.com/watch?v={id}" # Referer might be important
     }
+    # This request fetches the HLS manifest file from YouTube's servers
+    with timed_stage("manifest_fetch"):
+        m3u8_response = requests.get(m3u8_url, headers=headers, timeout=15)
+    m3u8_response.raise_for_status() # Raise HTTPError for bad responses (4xx or 5xx)
+    return m3u8_response.text
+
+
+def segment_filename_for(original_ts_url):
+    # Derived from the upstream URL, so every listener of the same manifest (and the
+    # warm-up thread) shares one download per segment
+    return hashlib.sha1(original_ts_url.encode()).hexdigest() + ".ts"
+
+
+def _register_segment_locked(segment_filename, original_ts_url, song_id):
+    """Tracks one segment; the caller holds segment_cache_lock. Returns (temp_path, needs_download)."""
+    info = segment_cache.get(segment_filename)
+    if info and info['status'] != 'failed':
+        info['timestamp'] = time.time() # Still in use, extend its life
+        cache_requests_total.inc(cache="segment", result="hit")
+        return info['temp_path'], False
+    cache_requests_total.inc(cache="segment", result="miss")
+    temp_path = os.path.join(TEMP_SEGMENT_DIR, segment_filename)
+    segment_cache[segment_filename] = {
+        'original_url': original_ts_url,
+        'song': song_id,
+        'temp_path': temp_path,
+        'status': 'pending', # 'pending', 'downloading', 'downloaded', 'failed'
+        'timestamp': time.time() # Timestamp when added/last accessed/status changed
+    }
+    return temp_path, True
 
-    try:
-        # --- FIX APPLIED HERE: Added timeout and specific exception handling ---
-        # This request fetches the HLS manifest file from YouTube's servers
-        m3u8_response = requests.get(m3u8_url, headers=headers, timeout=15) # ADDED TIMEOUT
-        m3u8_response.raise_for_status() # Raise HTTPError for bad responses (4xx or 5xx)
-        m3u8_content = m3u8_response.text
-        print(f"Successfully fetched m3u8 playlist for {id}.")
 
-    # --- Specific exception handling for Timeout ---
-    except requests.exceptions.Timeout:
-        print(f"Timeout while fetching m3u8 playlist from {m3u8_url}")
-        # Return a Gateway Timeout error as the external service (YouTube) didn't respond in time
-        return {"error": "Request to fetch streaming playlist timed out."}, 504
+def register_segments(song_id, segments):
+    """
+    Makes sure a manifest's [(segment_filename, original_ts_url)] are tracked in segment_cache,
+    in one lock round trip. Returns the (segment_filename, original_ts_url, temp_path) to download.
+    """
+    to_download = []
+    with segment_cache_lock:
+        for segment_filename, original_ts_url in segments:
+            temp_path, needs_download = _register_segment_locked(segment_filename, original_ts_url, song_id)
+            if needs_download:
+                to_download.append((segment_filename, original_ts_url, temp_path))
+    return to_download
 
-    except requests.exceptions.RequestException as e:
-        # This handles other requests errors like HTTPError, ConnectionError etc.
-        print(f"Failed to download m3u8 playlist from {m3u8_url}: {str(e)}")
-        return {"error": f"Failed to download streaming playlist: {str(e)}"}, 500
 
-    except Exception as e:
-        # Catch any other unexpected errors during the fetch or initial processing
-        print(f"Unexpected error processing m3u8 for {id}: {str(e)}")
-        return {"error": f"Internal server error processing playlist: {str(e)}"}, 500
-
-    # --- Parse and rewrite the playlist ---
-    new_m3u8_lines = []
-    segments_to_download = []
+def manifest_segment_urls(m3u8_url, m3u8_content):
+    """Yields (line, original_ts_url) for each manifest line; original_ts_url is None for non-segment lines."""
     # Use urljoin to robustly get the base URL of the manifest
     base_url = urllib.parse.urljoin(m3u8_url, '.')
-
     for line in m3u8_content.splitlines():
         line = line.strip()
         if line.startswith("#"):
-            new_m3u8_lines.append(line)
+            yield line, None
         elif line.endswith(".ts"):
             # Use urljoin to get the absolute URL of the segment
-            original_ts_url = urllib.parse.urljoin(base_url, line)
-
-            # Generate a unique filename for the cached segment
-            segment_filename_uuid = uuid.uuid4().hex
-            segment_filename = f"{segment_filename_uuid}.ts"
-            temp_path = os.path.join(TEMP_SEGMENT_DIR, segment_filename)
-
-            # Add segment info to the cache
-            with segment_cache_lock:
-                # Add a check to prevent adding if already exists (shouldn't happen with UUID)
-                # or if purge thread removed it recently.
-                if segment_filename not in segment_cache:
-                     segment_cache[segment_filename] = {
-                        'original_url': original_ts_url,
-                        'temp_path': temp_path,
-                        'status': 'pending', # 'pending', 'downloading', 'downloaded', 'failed'
-                        'timestamp': time.time() # Timestamp when added/last accessed/status changed
-                    }
-                     # print(f"Added {segment_filename} to cache (pending)") # Uncomment for verbose segment logging
-                else:
-                     print(f"warning: segment {segment_filename} already in cache when processing m3u8?")
+            yield line, urllib.parse.urljoin(base_url, line)
+
+
+# Parsed, rewritten manifests, reused until the stream URL they came from expires, so
+# re-plays and concurrent listeners of a song cost no yt-dlp run or manifest download.
+# {video_id: {"template", "segments": [(segment_filename, original_ts_url)], "durations",
+#  "target_duration", "expires"}}. The template holds segment paths behind MANIFEST_HOST, which
+# is replaced by the requesting host when served.
+MANIFEST_HOST = "\x00"
+manifest_cache = {}
+manifest_cache_lock = threading.Lock()
+# Striped locks, so concurrent first listeners of a song load its manifest once
+manifest_load_locks = [threading.Lock() for _ in range(64)]
+
+def build_manifest(id, m3u8_url, m3u8_content):
+    """Parses and rewrites a manifest into a manifest_cache entry."""
+    lines, segments, durations = [], [], []
+    target_duration = None
+    for line, original_ts_url in manifest_segment_urls(m3u8_url, m3u8_content):
+        if original_ts_url is None:
+            if line.startswith("#EXTINF:"):
+                durations.append(float(line[len("#EXTINF:"):].split(",", 1)[0] or 0))
+            elif line.startswith("#EXT-X-TARGETDURATION:"):
+                target_duration = int(line.split(":", 1)[1])
+            lines.append(line)
+            continue
+        segment_filename = segment_filename_for(original_ts_url)
+        segments.append((segment_filename, original_ts_url))
+        # Rewrite the segment URL in the playlist to point back to our Flask app
+        lines.append(f"{MANIFEST_HOST}/song/{id}/segment/{segment_filename}")
+    return {
+        "template": "\n".join(lines),
+        "segments": segments,
+        "durations": durations,
+        "target_duration": target_duration,
+        "expires": stream_url_expiry(m3u8_url),
+    }
+
+
+def cached_manifest(id, count=True):
+    """The song's manifest_cache entry, or None if there's none that's still valid."""
+    with manifest_cache_lock:
+        entry = manifest_cache.get(id)
+    valid = entry is not None and entry["expires"] > time.time()
+    if count:
+        cache_requests_total.inc(cache="manifest", result="hit" if valid else "miss")
+    return entry if valid else None
+
 
+def store_manifest(id, entry):
+    if entry["segments"]: # Never cache a manifest we can't play
+        with manifest_cache_lock:
+            manifest_cache[id] = entry
 
-            # Rewrite the segment URL in the playlist to point back to our Flask app
-            # Use request.url_root to get the correct base URL (e.g., https://your-railway-app.railway.app/)
-            new_segment_url = f"{request.url_root.rstrip('/')}/song/{id}/segment/{segment_filename}"
-            new_m3u8_lines.append(new_segment_url)
 
-            # Add to list for background downloading
-            segments_to_download.append((segment_filename, original_ts_url, temp_path))
+def invalidate_stream(id):
+    """Forgets a song's resolved URL and manifest, e.g. when googlevideo stopped honoring them."""
+    with stream_url_cache_lock:
+        stream_url_cache.pop(id, None)
+    with manifest_cache_lock:
+        manifest_cache.pop(id, None)
 
+
+@app.route("/song/<id>/streamHLS.m3u8")
+def getstream_experimental(id):
+    """Fetches the m3u8 playlist for a song and rewrites segment URLs."""
+    record_access(f"song/{id}")
+    manifest = cached_manifest(id)
+    if manifest is None:
+        with manifest_load_locks[hash(id) % len(manifest_load_locks)]:
+            manifest = cached_manifest(id, count=False) or load_manifest_uncached(id) # Loaded while we waited?
+        if not isinstance(manifest, dict) or "template" not in manifest:
+            return manifest # Error response
+
+    # (Re-)register the segments: they may have been purged, or have failed, since the manifest was cached
+    segments_to_download = register_segments(id, manifest["segments"])
     # Start downloading the segments in the background
     # The frontend player will request them when needed, and serve_segment will wait if necessary
     if segments_to_download:
-         print(f"Starting background downloads for {len(segments_to_download)} segments.")
+         logger.debug("Starting background downloads for %s segments.", len(segments_to_download))
          start_segment_downloads(segments_to_download)
-    else:
-        print("No segments found in the m3u8 playlist.")
-        # This might indicate an invalid playlist was returned by YouTube/yt-dlp
-        return {"error": "No playable segments found in the streaming playlist."}, 500
-
 
     # Return the modified m3u8 playlist to the frontend
+    # Use the URL the client used (e.g., https://your-railway-app.railway.app/), which in a
+    # cluster may be another node's; see public_url_root
     # Use the correct MIME type for M3U8 playlists
-    print(f"Returning modified m3u8 playlist for {id}.")
-    return Response("\n".join(new_m3u8_lines), 200, {"Content-Type": "application/x-mpegURL"})
+    logger.debug("Returning modified m3u8 playlist for %s.", id)
+    body = manifest["template"].replace(MANIFEST_HOST, public_url_root())
+    return Response(body, 200, {"Content-Type": "application/x-mpegURL"})
+
+
+def load_manifest_uncached(id):
+    """Resolves and fetches a song's manifest and caches it; returns the entry or an error response."""
+    try:
+        m3u8_url = resolve_stream_url(id)
+    except subprocess.CalledProcessError as e:
+         error_output = e.stderr or e.stdout or "Unknown yt-dlp error getting stream URL"
+         logger.warning(f"yt-dlp failed with exit code {e.returncode} for stream URL of {id}: {error_output}")
+         return {"error": f"Failed to get streaming URL for song (yt-dlp error): {error_output[:300]}..."}, 500
+    except subprocess.TimeoutExpired:
+         logger.warning(f"yt-dlp timed out getting stream URL for {id}.")
+         return {"error": "Timed out getting streaming URL."}, 504 # Gateway Timeout
+    except UpstreamUnavailableError as e:
+        return upstream_unavailable_response(e)
+    except Exception as e:
+         logger.exception(f"Unexpected error running yt-dlp for stream URL of {id}: {str(e)}")
+         return {"error": f"Internal server error getting streaming URL: {str(e)}"}, 500
+
+    if not m3u8_url.startswith("http"):
+         logger.warning(f"yt-dlp returned non-http URL: {m3u8_url}")
+         return {"error": "Failed to get a valid streaming URL from YouTube."}, 500
+
+    try:
+        m3u8_content = fetch_manifest(id, m3u8_url)
+        logger.debug("Successfully fetched m3u8 playlist for %s.", id)
+
+    # --- Specific exception handling for Timeout ---
+    except requests.exceptions.Timeout:
+        logger.warning(f"Timeout while fetching m3u8 playlist from {m3u8_url}")
+        # Return a Gateway Timeout error as the external service (YouTube) didn't respond in time
+        return {"error": "Request to fetch streaming playlist timed out."}, 504
+
+    except requests.exceptions.RequestException as e:
+        # This handles other requests errors like HTTPError, ConnectionError etc.
+        logger.warning(f"Failed to download m3u8 playlist from {m3u8_url}: {str(e)}")
+        return {"error": f"Failed to download streaming playlist: {str(e)}"}, 500
+
+    except Exception as e:
+        # Catch any other unexpected errors during the fetch or initial processing
+        logger.exception(f"Unexpected error processing m3u8 for {id}: {str(e)}")
+        return {"error": f"Internal server error processing playlist: {str(e)}"}, 500
+
+    # --- Parse and rewrite the playlist ---
+    manifest = build_manifest(id, m3u8_url, m3u8_content)
+    if not manifest["segments"]:
+        logger.warning("No segments found in the m3u8 playlist.")
+        # This might indicate an invalid playlist was returned by YouTube/yt-dlp
+        return {"error": "No playable segments found in the streaming playlist."}, 500
+    store_manifest(id, manifest)
+    return manifest
 
 @app.route("/song/<id>/segment/<segment_filename>")
 def serve_segment(id, segment_filename):
     """Serves a cached HLS segment, waiting for download if necessary."""
-    # print(f"Received request for segment {segment_filename} (song {id})") # Uncomment for verbose segment logging
+    log_sampled(logging.DEBUG, "Received request for segment %s (song %s)", segment_filename, id)
     wait_start_time = time.time()
     wait_timeout = 45 # Max seconds to wait for a segment to download
 
@@ -521,22 +2392,24 @@ def serve_segment(id, segment_filename):
             segment_info = segment_cache.get(segment_filename)
 
         if not segment_info:
-             print(f"Segment {segment_filename} not found in cache.")
+             logger.debug("Segment %s not found in cache.", segment_filename)
              return "Segment Not Found", 404
 
         status = segment_info['status']
-        # print(f"Segment {segment_filename} status: {status}") # Uncomment for verbose segment logging
 
         if status == 'downloaded':
             # Found it and it's ready!
+            observe_stage("segment_wait", time.time() - wait_start_time)
             break
         elif status == 'failed':
-            print(f"Segment {segment_filename} download previously failed.")
+            logger.warning(f"Segment {segment_filename} download previously failed.")
+            # Likely an expired or revoked URL: make the player's next manifest reload resolve a fresh one
+            invalidate_stream(id)
             return "Segment Download Failed", 500
         elif status == 'pending': # 'downloading' status could also be pending for this logic
             # Still waiting, check timeout
             if (time.time() - wait_start_time) > wait_timeout:
-                print(f"Timeout waiting for segment {segment_filename} download.")
+                logger.warning(f"Timeout waiting for segment {segment_filename} download.")
                 # Mark as failed on timeout
                 with segment_cache_lock:
                     if segment_filename in segment_cache: # Check again before modifying
@@ -549,7 +2422,7 @@ def serve_segment(id, segment_filename):
 
         else:
             # Unknown status
-            print(f"Segment {segment_filename} has unknown status: {status}")
+            logger.error(f"Segment {segment_filename} has unknown status: {status}")
             return "Internal Segment Error", 500
 
     # --- Serve the downloaded file ---
@@ -562,16 +2435,30 @@ def serve_segment(id, segment_filename):
              if current_info and current_info['status'] == 'downloaded':
                 current_info['timestamp'] = time.time()
                 segment_file_path = current_info['temp_path']
+                packed_song = current_info['song'] if current_info.get('packed') else None
              else:
                  # Status changed or removed while we were out of the lock?
-                 print(f"Segment {segment_filename} state changed unexpectedly before serving.")
+                 logger.error(f"Segment {segment_filename} state changed unexpectedly before serving.")
                  # This could happen if the purge thread ran just before acquiring the lock
                  return "Segment State Changed or Removed", 404
 
 
-        if not os.path.exists(segment_file_path):
+        if packed_song:
+            with segment_packs_lock:
+                pack = segment_packs.get(packed_song)
+            segment = pack.open(segment_filename) if pack else None
+            if segment is None: # Pack evicted while we were waiting
+                return "Segment State Changed or Removed", 404
+            # Like send_file: the server streams the file object (sendfile under gunicorn)
+            response = Response(wrap_file(request.environ, segment), mimetype="video/mp2t", direct_passthrough=True)
+            response.content_length = segment.length
+            return response.make_conditional(request, accept_ranges=True, complete_length=segment.length)
+
+        try:
+            os.utime(segment_file_path) # The mtime tells every worker's purge the file is in use
+        except FileNotFoundError:
              # File disappeared between check and send_file
-             print(f"error: segment file {segment_file_path} disappeared before sending.")
+             logger.error(f"segment file {segment_file_path} disappeared before sending.")
              # Mark as failed if file is gone
              with segment_cache_lock:
                   if segment_filename in segment_cache:
@@ -580,93 +2467,80 @@ def serve_segment(id, segment_filename):
              return "Segment File Not Found On Disk", 404
 
 
-        # print(f"Serving segment file: {segment_file_path}") # Uncomment for verbose segment logging
+        log_sampled(logging.DEBUG, "Serving segment file: %s", segment_file_path)
         # Use mimetype video/mp2t for MPEG-2 Transport Stream segments
         return send_file(segment_file_path, mimetype="video/mp2t")
 
     except FileNotFoundError:
         # This should ideally be caught by the os.path.exists check, but as a fallback
-        print(f"error: send_file reported FileNotFoundError for {segment_file_path}")
+        logger.error(f"send_file reported FileNotFoundError for {segment_file_path}")
         return "Segment File Not Found (send_file)", 404
     except Exception as e:
-        print(f"Unexpected error serving segment {segment_filename}: {str(e)}")
+        logger.exception(f"Unexpected error serving segment {segment_filename}: {str(e)}")
         return {"error": f"Internal error serving segment: {str(e)}"}, 500
 
 
-# Note: The /song/<id>/stream route uses yt-dlp for a single download
-# and is unlikely to be used by the HLS-based frontend player.
-# Keeping it for completeness.
-@cache.cached(timeout=14400) # Longer cache for the single file download
+# /song/<id>/stream serves the whole audio file: from the cache when it's there, otherwise
+# streamed while the parallel ranged download (see PARALLEL AUDIO DOWNLOAD) fills the cache,
+# with a single yt-dlp download (get_audio) as the fallback. Prefetch jobs fill the same cache.
 @app.route("/song/<id>/stream")
 def getAudio(id):
-    """Provides a direct audio file download/stream (opus/m4a/mp3) using yt-dlp."""
-    print(f"Request for single audio stream for song ID: {id}")
+    """Serves a song's audio file (opus/m4a/mp3), streaming it while it downloads if it isn't cached yet."""
+    logger.debug("Request for single audio stream for song ID: %s", id)
+    record_access(f"song/{id}")
     try:
-        # Check for existing cached files with common extensions
-        cache_dir = os.path.join(os.getcwd(), "cache")
-        # List files starting with the ID and ending with common audio extensions
-        potential_files = [f for f in os.listdir(cache_dir) if f.startswith(f"{id}.") and (f.endswith('.opus') or f.endswith('.m4a') or f.endswith('.mp3') or f.endswith('.aac') or f.endswith('.webm') or f.endswith('.ogg'))]
-
-        if potential_files:
-            # Found an existing cached file, pick the first one (could add logic to pick best extension, e.g., opus)
-            cached_file_path = os.path.join(cache_dir, potential_files[0])
-            print(f"Serving cached audio file: {cached_file_path}")
-            # Guess mimetype based on extension
-            mimetype = "audio/mpeg" # Default
-            if cached_file_path.endswith('.opus'): mimetype = 'audio/opus'
-            elif cached_file_path.endswith('.m4a'): mimetype = 'audio/mp4' # Or audio/aac
-            elif cached_file_path.endswith('.mp3'): mimetype = 'audio/mpeg'
-            elif cached_file_path.endswith('.aac'): mimetype = 'audio/aac'
-            elif cached_file_path.endswith('.webm'): mimetype = 'audio/webm'
-            elif cached_file_path.endswith('.ogg'): mimetype = 'audio/ogg'
-
-            return send_file(cached_file_path, mimetype=mimetype)
+        # Check for an existing cached file with one of the audio extensions
+        cached_file_path = cached_audio_path(id)
+        if cached_file_path:
+            logger.debug("Serving cached audio file: %s", cached_file_path)
+            return send_file(cached_file_path, mimetype=audio_mimetype(cached_file_path))
         else:
-            print(f"Cached audio file not found for ID {id}, downloading...")
+            logger.debug("Cached audio file not found for ID %s, downloading...", id)
+            if AUDIO_DOWNLOAD_CONCURRENCY > 0:
+                response = stream_audio_download(audio_download(id))
+                if response is not None:
+                    return response
+                logger.info(f"Falling back to yt-dlp download for {id}")
             # Download the audio file using the get_audio helper
             # The helper function handles potential errors internally and raises exceptions
             downloaded_file_path = get_audio(f"https://youtube.com/watch?v={id}", id=id)
 
             # After get_audio runs, check again if a file exists (it should now)
             if os.path.exists(downloaded_file_path):
-                 print(f"Downloaded audio file: {downloaded_file_path}, serving...")
-                 mimetype = "audio/mpeg" # Default, or guess again
-                 if downloaded_file_path.endswith('.opus'): mimetype = 'audio/opus'
-                 elif downloaded_file_path.endswith('.m4a'): mimetype = 'audio/mp4'
-                 elif downloaded_file_path.endswith('.mp3'): mimetype = 'audio/mpeg'
-                 elif downloaded_file_path.endswith('.aac'): mimetype = 'audio/aac'
-                 elif downloaded_file_path.endswith('.webm'): mimetype = 'audio/webm'
-                 elif downloaded_file_path.endswith('.ogg'): mimetype = 'audio/ogg'
-                 return send_file(downloaded_file_path, mimetype=mimetype)
+                 logger.debug("Downloaded audio file: %s, serving...", downloaded_file_path)
+                 return send_file(downloaded_file_path, mimetype=audio_mimetype(downloaded_file_path))
             else:
                  # This case indicates an issue with get_audio not saving the file correctly
                  raise Exception("get_audio function failed to create the output file.")
 
     except FileNotFoundError:
-        print(f"Error: Audio file not found after download attempt for ID {id}.")
+        logger.warning(f"Audio file not found after download attempt for ID {id}.")
         return {"error": "Audio file not found after processing."}, 500
     except subprocess.TimeoutExpired:
-        print(f"yt-dlp download timed out for ID {id}.")
+        logger.warning(f"yt-dlp download timed out for ID {id}.")
         return {"error": "Audio download timed out."}, 504
+    except UpstreamUnavailableError as e:
+        return upstream_unavailable_response(e)
     except Exception as e:
-        print(f"Error getting or serving audio stream for ID {id}: {str(e)}")
+        logger.warning(f"Error getting or serving audio stream for ID {id}: {str(e)}")
         # Include the exception type for better debugging
         return {"error": f"Could not get audio stream: {type(e).__name__}: {str(e)}"}, 500
 
 
-@cache.cached(timeout=300)
 @app.route("/song/<id>/lyrics")
+@cached_json(timeout=300)
+@background_priority
 def getLyrics(id):
-    # Fetches song details first (might already be cached by getSong route)
-    # Use the getSong function to benefit from its error handling and potential caching
-    song_details_response = getSong(id)
+    # Fetches song details first (usually already cached by the getSong route)
+    # Falls back to the getSong function on a miss, to benefit from its error handling
+    song_details_response = cached_song_or_error(id)
     # Check if getSong returned an error response dictionary
     if isinstance(song_details_response, tuple) and song_details_response[1] != 200:
         # Return the error response from getSong
         return song_details_response
     elif not isinstance(song_details_response, dict):
          # getSong returned something unexpected
-         print(f"Error: getSong returned unexpected type: {type(song_details_response)}")
+         logger.warning(f"getSong returned unexpected type: {type(song_details_response)}")
          return {"error": "Failed to get song details for lyrics."}, 500
 
 
@@ -675,7 +2549,7 @@ def getLyrics(id):
         artist_name = songDetails.get("author", "Unknown Artist")
         track_name = songDetails.get("title", "Unknown Title")
 
-        print(f"Fetching lyrics from lrclib for song '{track_name}' by '{artist_name}' (ID: {id})")
+        logger.debug("Fetching lyrics from lrclib for song '%s' by '%s' (ID: %s)", track_name, artist_name, id)
 
         # Use parameters in requests.get
         lyrics_params = {
@@ -688,77 +2562,81 @@ def getLyrics(id):
         lyrics_params = {k: v for k, v in lyrics_params.items() if v}
 
         # Add timeout to the external lyrics request
-        lyrics_response = requests.get("https://lrclib.net/api/get", params=lyrics_params, timeout=10)
-        lyrics_response.raise_for_status() # Raise HTTPError for bad responses (4xx or 5xx)
+        lyrics_response = lrclib_upstream.call(fetch_checked, "https://lrclib.net/api/get", params=lyrics_params, timeout=10)
 
         lyrics_data = lyrics_response.json()
 
         # lrclib returns { "lyrics": "", "syncedLyrics": "", ...} for no lyrics found,
         # or a dictionary with data if found. Check if syncedLyrics is present and not empty.
         if lyrics_data and lyrics_data.get("syncedLyrics"):
-            print(f"Synced lyrics found for '{track_name}'")
+            logger.debug("Synced lyrics found for '%s'", track_name)
             return lyrics_data
         else:
             # Lyrics not found or lrclib returned a structure indicating no lyrics
-            print(f"Synced lyrics not found on lrclib for '{track_name}'")
+            logger.warning(f"Synced lyrics not found on lrclib for '{track_name}'")
             # Return 404 specifically if lrclib says no lyrics
             return {"error": "Synced lyrics not found for this song on lrclib."}, 404
 
+    except UpstreamUnavailableError as e:
+        return upstream_unavailable_response(e)
     except requests.exceptions.Timeout:
-         print(f"Timeout while fetching lyrics from lrclib for '{track_name}'")
+         logger.warning(f"Timeout while fetching lyrics from lrclib for '{track_name}'")
          return {"error": "Request to fetch lyrics timed out."}, 504
 
     except requests.exceptions.RequestException as e:
-        print(f"Error fetching lyrics from lrclib: {str(e)}")
+        logger.warning(f"Error fetching lyrics from lrclib: {str(e)}")
         # Check for specific HTTP errors from lrclib if needed, but 502 is good generic proxy error
         return {"error": f"Failed to fetch lyrics from external service: {str(e)}"}, 502
 
     except Exception as e:
-        print(f"Unexpected error fetching lyrics for {id}: {str(e)}")
+        logger.exception(f"Unexpected error fetching lyrics for {id}: {str(e)}")
         return {"error":"Internal Server Error fetching lyrics","errorDetails":str(e)}, 500
 
-@cache.cached(timeout=300)
 @app.route("/song/<id>/ytmLyrics")
+@cached_json(timeout=300)
+@background_priority
 def getYTMLyrics(id):
-     # Fetches song details first (might already be cached)
-    song_details_response = getSong(id)
+     # Fetches song details first (usually already cached by the getSong route)
+    song_details_response = cached_song_or_error(id)
     # Check if getSong returned an error response dictionary
     if isinstance(song_details_response, tuple) and song_details_response[1] != 200:
         # Return the error response from getSong
         return song_details_response
     elif not isinstance(song_details_response, dict):
          # getSong returned something unexpected
-         print(f"Error: getSong returned unexpected type: {type(song_details_response)}")
+         logger.warning(f"getSong returned unexpected type: {type(song_details_response)}")
          return {"error": "Failed to get song details for YTM lyrics."}, 500
 
 
     try:
         # Get the watch playlist first to find the lyrics browseId
-        print(f"Attempting to get watch playlist for lyrics browseId for {id}")
+        logger.debug("Attempting to get watch playlist for lyrics browseId for %s", id)
         # Use radio=False and limit=1 as we only need the lyrics id
-        watch_playlist = ytmusic.get_watch_playlist(videoId=id, radio=False, limit=1)
+        watch_playlist = ytmusic_upstream.call(ytmusic.get_watch_playlist, videoId=id, radio=False, limit=1)
 
         lyrics_browse_id = watch_playlist.get("lyrics")
         if not lyrics_browse_id:
-            print(f"No lyrics browse ID found in watch playlist for {id}")
+            logger.warning(f"No lyrics browse ID found in watch playlist for {id}")
             return {"error":"Could not find official YouTube Music lyrics browse ID for this song."}, 404
 
-        print(f"Found lyrics browse ID: {lyrics_browse_id}. Fetching lyrics...")
+        logger.debug("Found lyrics browse ID: %s. Fetching lyrics...", lyrics_browse_id)
         # Fetch lyrics using the browseId
-        lyrics_data = ytmusic.get_lyrics(browseId=lyrics_browse_id, timestamps=True)
+        lyrics_data = ytmusic_upstream.call(ytmusic.get_lyrics, browseId=lyrics_browse_id, timestamps=True)
 
         # ytmusicapi get_lyrics returns a dict like {'lyrics': '...', 'source': '...'}
         # or possibly just {'lyrics': None, 'source': None} if not found.
         # Check if 'lyrics' key exists and is not None/empty string
         if lyrics_data and lyrics_data.get("lyrics"):
-             print(f"Successfully fetched YTM lyrics for {id}.")
+             logger.debug("Successfully fetched YTM lyrics for %s.", id)
              return lyrics_data
         else:
-            print(f"YTMusic API returned no lyrics data for browse ID {lyrics_browse_id}")
+            logger.warning(f"YTMusic API returned no lyrics data for browse ID {lyrics_browse_id}")
             return {"error":"Could not retrieve official YouTube Music lyrics data."}, 404
 
+    except UpstreamUnavailableError as e:
+        return upstream_unavailable_response(e)
     except Exception as e:
-        print(f"Error fetching YTM lyrics for {id}: {str(e)}")
+        logger.warning(f"Error fetching YTM lyrics for {id}: {str(e)}")
         # Check for specific errors indicating no lyrics are available from ytmusicapi
         error_str = str(e)
         if "No lyrics found" in error_str or "could not find lyrics" in error_str: # Example specific error strings
@@ -770,29 +2648,192 @@ def getYTMLyrics(id):
              return {"error":"Internal Server Error fetching YouTube Music lyrics","errorDetails":str(e)}, 500
 
 
-@cache.cached(timeout=300)
+# --- LYRICS ---
+# /song/<id>/bestLyrics asks lrclib and YouTube Music at the same time and answers with the
+# first synced lyrics either returns (plain lyrics only if neither has synced ones), in one
+# format: {"videoId", "provider", "synced", "syncedLyrics" (LRC), "plainLyrics", "source"}.
+# Results, including "no lyrics anywhere", are kept in an SQLite file (LYRICS_DB) that
+# survives restarts and is shared by all workers: found lyrics for LYRICS_TTL, misses for
+# LYRICS_MISS_TTL, so a song's lyrics are looked up upstream about once a month.
+LYRICS_DB = os.environ.get('LYRICS_DB', os.path.join(os.getcwd(), "cache", "lyrics.sqlite3"))
+LYRICS_TTL = int(os.environ.get('LYRICS_TTL', 60 * 60 * 24 * 30))
+LYRICS_MISS_TTL = int(os.environ.get('LYRICS_MISS_TTL', 60 * 60 * 24 * 7))
+LYRICS_LOOKUP_TIMEOUT = 20
+
+lyrics_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="lyrics")
+lyrics_db_connection = None
+lyrics_db_lock = threading.Lock()
+
+def lyrics_db():
+    """The lyrics store's connection, opened on first use (callers hold lyrics_db_lock)."""
+    global lyrics_db_connection
+    if lyrics_db_connection is None:
+        os.makedirs(os.path.dirname(LYRICS_DB), exist_ok=True)
+        connection = sqlite3.connect(LYRICS_DB, timeout=10, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL") # Workers read while another one writes
+        connection.execute("CREATE TABLE IF NOT EXISTS lyrics (video_id TEXT PRIMARY KEY, result TEXT, expires REAL)")
+        lyrics_db_connection = connection
+    return lyrics_db_connection
+
+
+def stored_lyrics(id):
+    """(found, result): found is False when there's no fresh entry; result is None for a stored miss."""
+    with lyrics_db_lock:
+        row = lyrics_db().execute("SELECT result, expires FROM lyrics WHERE video_id = ?", (id,)).fetchone()
+    if row is None or row[1] <= time.time():
+        return False, None
+    return True, json.loads(row[0]) if row[0] else None
+
+
+def store_lyrics(id, result):
+    ttl = LYRICS_TTL if result else LYRICS_MISS_TTL
+    with lyrics_db_lock, lyrics_db():
+        lyrics_db().execute("INSERT OR REPLACE INTO lyrics VALUES (?, ?, ?)",
+                            (id, json.dumps(result) if result else None, time.time() + ttl))
+
+
+def lrc_timestamp(milliseconds):
+    minutes, seconds = divmod(milliseconds / 1000, 60)
+    return f"[{int(minutes):02d}:{seconds:05.2f}]"
+
+
+def lrclib_lyrics(id):
+    """lrclib's lyrics for the song, normalized, or None if it has none."""
+    details = song_details(id) or {} # Cached by getSong when the player has loaded the song
+    if not details.get("title"):
+        return None
+    params = {"artist_name": details.get("author", ""), "track_name": details["title"]}
+    if details.get("lengthSeconds"):
+        params["duration"] = details["lengthSeconds"] # Lets lrclib pick the right version
+    try:
+        data = lrclib_upstream.call(fetch_checked, "https://lrclib.net/api/get", params=params, timeout=10).json()
+    except requests.exceptions.HTTPError as e:
+        if e.response is not None and e.response.status_code == 404:
+            return None # lrclib's "no lyrics for this track"
+        raise
+    if not data or not (data.get("syncedLyrics") or data.get("plainLyrics")):
+        return None
+    return {
+        "videoId": id,
+        "provider": "lrclib",
+        "synced": bool(data.get("syncedLyrics")),
+        "syncedLyrics": data.get("syncedLyrics") or None,
+        "plainLyrics": data.get("plainLyrics") or None,
+        "source": "LRCLIB",
+    }
+
+
+def ytmusic_lyrics(id):
+    """YouTube Music's lyrics for the song, normalized (timed lines as LRC), or None if it has none."""
+    watch_playlist = ytmusic_upstream.call(ytmusic.get_watch_playlist, videoId=id, radio=False, limit=1)
+    browse_id = (watch_playlist or {}).get("lyrics")
+    if not browse_id:
+        return None
+    data = ytmusic_upstream.call(ytmusic.get_lyrics, browseId=browse_id, timestamps=True)
+    if not data or not data.get("lyrics"):
+        return None
+    lines = data["lyrics"]
+    if data.get("hasTimestamps") and isinstance(lines, list):
+        # ytmusicapi gives LyricLine objects (dicts in older versions) with times in milliseconds
+        def field(line, name):
+            return line.get(name) if isinstance(line, dict) else getattr(line, name)
+        synced = "\n".join(f"{lrc_timestamp(field(line, 'start_time'))}{field(line, 'text')}" for line in lines)
+        plain = "\n".join(field(line, "text") for line in lines)
+    else:
+        synced, plain = None, lines
+    return {
+        "videoId": id,
+        "provider": "ytmusic",
+        "synced": synced is not None,
+        "syncedLyrics": synced,
+        "plainLyrics": plain,
+        "source": data.get("source"),
+    }
+
+
+def run_lyrics_provider(provider, id, deadline):
+    priority_context.value = BACKGROUND # Lyrics wait behind playback-critical calls, like the other lyrics routes
+    wait_deadline_context.value = deadline # Don't hold limiter capacity after the lookup has given up
+    try:
+        return provider(id)
+    finally:
+        wait_deadline_context.value = None
+
+
+def lookup_lyrics(id):
+    """
+    Queries all providers in parallel: the first synced result wins; otherwise the first plain
+    one; None if nobody has lyrics. Raises if every provider failed.
+    """
+    deadline = time.monotonic() + LYRICS_LOOKUP_TIMEOUT
+    futures = [lyrics_executor.submit(run_lyrics_provider, provider, id, deadline) for provider in (lrclib_lyrics, ytmusic_lyrics)]
+    best, errors = None, []
+    try:
+        for future in concurrent.futures.as_completed(futures, timeout=LYRICS_LOOKUP_TIMEOUT):
+            try:
+                result = future.result()
+            except Exception as e:
+                errors.append(e)
+                continue
+            if result and result["synced"]:
+                return result # A provider that's already running finishes by the deadline; its result is dropped
+            best = best or result
+    except concurrent.futures.TimeoutError as e:
+        errors.append(e)
+    finally:
+        for future in futures:
+            future.cancel() # Providers still queued behind other lookups never start
+    if best is None and errors:
+        raise errors[0] # Not a real miss, so it mustn't be stored as one
+    return best
+
+
+@app.route("/song/<id>/bestLyrics")
+def getBestLyrics(id):
+    """The best lyrics for a song (synced if any provider has them), from the lyrics store when possible."""
+    found, result = stored_lyrics(id)
+    if found:
+        cache_requests_total.inc(cache="lyrics", result="hit")
+    else:
+        cache_requests_total.inc(cache="lyrics", result="miss")
+        try:
+            result = lookup_lyrics(id)
+        except UpstreamUnavailableError as e:
+            return upstream_unavailable_response(e)
+        except Exception as e:
+            logger.warning(f"Error looking up lyrics for {id}: {str(e)}")
+            return {"error": f"Failed to fetch lyrics: {str(e)}"}, 502
+        store_lyrics(id, result)
+    if result is None:
+        return {"error": "No lyrics found for this song."}, 404
+    return result
+# --- END LYRICS ---
+
+
 @app.route("/song/<id>/radio")
+@cached_json(timeout=300, compact_fields=RADIO_COMPACT_FIELDS)
+@background_priority
 def getRadio(id):
-    # Fetches song details first (might already be cached)
-    song_details_response = getSong(id)
+    # Fetches song details first (usually already cached by the getSong route)
+    song_details_response = cached_song_or_error(id)
     # Check if getSong returned an error response dictionary
     if isinstance(song_details_response, tuple) and song_details_response[1] != 200:
         # Return the error response from getSong
         return song_details_response
     elif not isinstance(song_details_response, dict):
          # getSong returned something unexpected
-         print(f"Error: getSong returned unexpected type: {type(song_details_response)}")
+         logger.warning(f"getSong returned unexpected type: {type(song_details_response)}")
          return {"error": "Failed to get song details for radio."}, 500
 
 
     try:
-        print(f"Fetching radio playlist for song {id}")
+        logger.debug("Fetching radio playlist for song %s", id)
         # The radio=True parameter is key here
-        radio = ytmusic.get_watch_playlist(videoId=id, radio=True, limit=50)
+        radio = ytmusic_upstream.call(ytmusic.get_watch_playlist, videoId=id, radio=True, limit=50)
         # ytmusicapi get_watch_playlist returns a dict containing playlist info and tracks
         # Check if 'playlistId' and 'tracks' are present and tracks list is not empty
         if radio and radio.get("playlistId") and radio.get("tracks"):
-             print(f"Successfully fetched radio playlist for {id}. Playlist ID: {radio['playlistId']} with {len(radio['tracks'])} tracks.")
+             logger.debug("Successfully fetched radio playlist for %s. Playlist ID: %s with %s tracks.", id, radio['playlistId'], len(radio['tracks']))
              # Optional: Proxy thumbnails in the radio response as well
              if radio.get("tracks"):
                  for track in radio["tracks"]:
@@ -808,11 +2849,13 @@ def getRadio(id):
 
              return radio
         else:
-            print(f"YTMusic API returned no radio playlist or no tracks for {id}. Response keys: {radio.keys() if radio else 'None'}")
+            logger.warning(f"YTMusic API returned no radio playlist or no tracks for {id}. Response keys: {radio.keys() if radio else 'None'}")
             return {"error":"Could not generate a radio playlist for this song."}, 404
 
+    except UpstreamUnavailableError as e:
+        return upstream_unavailable_response(e)
     except Exception as e:
-        print(f"Error fetching radio playlist for {id}: {str(e)}")
+        logger.warning(f"Error fetching radio playlist for {id}: {str(e)}")
         # Check if it looks like a private/deleted video issue
         error_str = str(e).lower()
         if "private or does not exist" in error_str or "invalid video id" in error_str:
@@ -822,20 +2865,20 @@ def getRadio(id):
 
 @app.route("/search/<q>")
 @app.route("/search/<q>/songs")
-@cache.cached(timeout=300)
+@cached_json(timeout=300, compact_fields=SEARCH_COMPACT_FIELDS)
 def search(q):
-    print(f"Performing search for query: '{q}'")
+    logger.debug("Performing search for query: '%s'", q)
     try:
         # Use a timeout for the search request as well
         # ytmusicapi doesn't have a built-in timeout for search, so this is a limitation
         # You might need to implement a separate thread/timeout mechanism if ytmusicapi.search itself hangs
         # For now, relying on potential underlying network timeouts from requests within ytmusicapi
         # and the Gunicorn worker timeout as a last resort.
-        results = ytmusic.search(query=q, filter="songs", limit=32)
+        results = ytmusic_upstream.call(ytmusic.search, query=q, filter="songs", limit=32)
 
         # ytmusicapi search returns a list directly, no need to check for KeyError like get_song
         if results is not None and isinstance(results, list):
-             print(f"Search for '{q}' returned {len(results)} results.")
+             logger.debug("Search for '%s' returned %s results.", q, len(results))
              # Optional: Proxy thumbnails in search results
              for result in results:
                   if result.get("thumbnail", {}).get("thumbnails"):
@@ -850,11 +2893,13 @@ def search(q):
 
              return results
         else:
-             print(f"Search for '{q}' returned unexpected data type: {type(results)}. Data: {results}")
+             logger.warning(f"Search for '{q}' returned unexpected data type: {type(results)}. Data: {results}")
              return {"error": "Search returned results in an unexpected format."}, 500
 
+    except UpstreamUnavailableError as e:
+        return upstream_unavailable_response(e)
     except Exception as e:
-        print(f"Error during search for '{q}': {str(e)}")
+        logger.warning(f"Error during search for '{q}': {str(e)}")
         # Check for common ytmusicapi errors during search if needed
         return {"error":"Internal Server Error during search","errorDetails":str(e)}, 500
 
@@ -864,6 +2909,711 @@ def health_check():
     # Could add checks for ytmusicapi/yt-dlp responsiveness if needed
     return {"status": "ok", "message": "API is running"}
 
+# --- CLUSTER ---
+# With several nodes behind a load balancer, each song (and each proxied image) is owned by
+# one node, picked by consistent hashing over CLUSTER_NODES, so its stream URL, manifest and
+# segments are resolved and downloaded exactly once in the cluster. Stream, segment, audio
+# and image requests that land on another node are forwarded to the owner
+# (CLUSTER_MODE=forward, the default; the client only ever talks to the load balancer) or
+# redirected to it (CLUSTER_MODE=redirect; nodes must be reachable by clients). Adding or
+# removing a node only moves the keys of its neighbours on the ring. A node that doesn't
+# answer is skipped for CLUSTER_NODE_RETRY seconds and its keys go to the next node on the ring.
+#
+# Locally: CLUSTER_NODES=http://127.0.0.1:5001,http://127.0.0.1:5002 and, per process,
+# CLUSTER_SELF=http://127.0.0.1:500N PORT=500N python app.py (bench/cluster.py does this).
+CLUSTER_NODES = [node.strip().rstrip('/') for node in os.environ.get('CLUSTER_NODES', '').split(',') if node.strip()]
+CLUSTER_SELF = os.environ.get('CLUSTER_SELF', '').rstrip('/')
+CLUSTER_MODE = os.environ.get('CLUSTER_MODE', 'forward')
+CLUSTER_SECRET = os.environ.get('CLUSTER_SECRET', '') # Sent between nodes; set it when nodes are publicly reachable
+CLUSTER_VNODES = int(os.environ.get('CLUSTER_VNODES', 128)) # Points per node on the ring
+CLUSTER_NODE_RETRY = float(os.environ.get('CLUSTER_NODE_RETRY', 30))
+
+FORWARDED_BY_HEADER = "X-Libytm-Forwarded-By"
+PUBLIC_ROOT_HEADER = "X-Libytm-Public-Root"
+CLUSTER_SECRET_HEADER = "X-Libytm-Cluster-Secret"
+# Request headers passed on to the owner, and response headers passed back (hop-by-hop ones aren't)
+FORWARDED_REQUEST_HEADERS = ("Range", "If-Range", "If-None-Match", "If-Modified-Since", "Accept", "Accept-Encoding", "X-Request-ID")
+HOP_BY_HOP_HEADERS = {"connection", "keep-alive", "transfer-encoding", "te", "trailer", "upgrade", "proxy-authenticate", "proxy-authorization"}
+
+def ring_hash(value):
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """Consistent hash ring with CLUSTER_VNODES virtual nodes per node."""
+    def __init__(self, nodes, vnodes=CLUSTER_VNODES):
+        self.nodes = list(nodes)
+        points = sorted((ring_hash(f"{node}#{i}"), node) for node in self.nodes for i in range(vnodes))
+        self.hashes = [h for h, _ in points]
+        self.owners = [node for _, node in points]
+
+    def owner(self, key, skip=()):
+        """The node owning `key`, walking clockwise past nodes in `skip`. None if there are none left."""
+        if not self.hashes:
+            return None
+        start = bisect.bisect(self.hashes, ring_hash(key))
+        for i in range(len(self.hashes)):
+            node = self.owners[(start + i) % len(self.hashes)]
+            if node not in skip:
+                return node
+        return None
+
+
+cluster_ring = HashRing(CLUSTER_NODES)
+cluster_session = requests.Session() # Keeps connections to peers open
+down_nodes = {} # {node: retry_at}
+down_nodes_lock = threading.Lock()
+
+def cluster_enabled():
+    return len(cluster_ring.nodes) > 1 and CLUSTER_SELF in cluster_ring.nodes
+
+
+def from_cluster_peer():
+    """True for requests another node forwarded to us (and signed, when CLUSTER_SECRET is set)."""
+    if FORWARDED_BY_HEADER not in request.headers:
+        return False
+    return not CLUSTER_SECRET or hmac.compare_digest(request.headers.get(CLUSTER_SECRET_HEADER, ""), CLUSTER_SECRET)
+
+
+def public_url_root():
+    """The root URL the client used, without trailing slash; for forwarded requests, the forwarding node's."""
+    if from_cluster_peer() and PUBLIC_ROOT_HEADER in request.headers:
+        return request.headers[PUBLIC_ROOT_HEADER].rstrip('/')
+    return request.url_root.rstrip('/')
+
+
+def shard_key():
+    """The key that decides which node serves this request, or None if any node can."""
+    if request.endpoint in ("getstream_experimental", "serve_segment", "getAudio"):
+        return f"song/{request.view_args['id']}"
+    if request.endpoint == "lh3":
+        return f"image/{urllib.parse.unquote(request.view_args['url'])}"
+    return None
+
+
+def live_owner(key):
+    now = time.time()
+    with down_nodes_lock:
+        skip = {node for node, retry_at in down_nodes.items() if retry_at > now}
+    return cluster_ring.owner(key, skip=skip - {CLUSTER_SELF})
+
+
+def forward_to(node):
+    """Proxies the current request to `node`, streaming the response back."""
+    headers = {name: request.headers[name] for name in FORWARDED_REQUEST_HEADERS if name in request.headers}
+    headers.update({FORWARDED_BY_HEADER: CLUSTER_SELF, PUBLIC_ROOT_HEADER: public_url_root()})
+    if CLUSTER_SECRET:
+        headers[CLUSTER_SECRET_HEADER] = CLUSTER_SECRET
+    upstream = cluster_session.get(node + request.full_path.rstrip('?'), headers=headers, stream=True,
+                                   timeout=(2, 60), allow_redirects=False)
+    response_headers = [(k, v) for k, v in upstream.headers.items() if k.lower() not in HOP_BY_HOP_HEADERS]
+    def body():
+        try:
+            # Undecoded, so the owner's Content-Encoding and Content-Length still hold
+            yield from upstream.raw.stream(64 * 1024, decode_content=False)
+        finally:
+            upstream.close()
+    return Response(body(), upstream.status_code, response_headers, direct_passthrough=True)
+
+
+@app.before_request
+def ensure_worker_started():
+    # Registered ahead of route_to_owner (hooks run in registration order), so a worker whose
+    # first requests are all forwarded or redirected still starts its services (see WORKER LIFECYCLE)
+    start_worker_services()
+
+
+@app.before_request
+def route_to_owner():
+    if not cluster_enabled() or from_cluster_peer():
+        return None # A forwarded request is always served where it lands, so it can't loop
+    key = shard_key()
+    if not key:
+        return None
+    owner = live_owner(key)
+    if owner in (None, CLUSTER_SELF):
+        cluster_requests_total.inc(action="local")
+        return None
+    if CLUSTER_MODE == "redirect":
+        cluster_requests_total.inc(action="redirected")
+        return Response(status=307, headers={"Location": owner + request.full_path.rstrip('?')})
+    try:
+        response = forward_to(owner)
+    except requests.exceptions.RequestException as e:
+        logger.warning(f"cluster node {owner} unreachable, serving locally for {CLUSTER_NODE_RETRY:.0f}s: {str(e)}")
+        with down_nodes_lock:
+            down_nodes[owner] = time.time() + CLUSTER_NODE_RETRY
+        cluster_requests_total.inc(action="fallback")
+        return None
+    cluster_requests_total.inc(action="forwarded")
+    return response
+
+
+@app.route("/admin/cluster", methods=["GET", "POST"])
+@require_admin
+def cluster_config():
+    """GET shows the ring; POST {"nodes": [...]} replaces the node list (per worker, until restart)."""
+    global cluster_ring
+    if request.method == "POST":
+        nodes = (request.get_json(silent=True) or {}).get("nodes")
+        if not isinstance(nodes, list) or not all(isinstance(node, str) for node in nodes):
+            return {"error": "expected {\"nodes\": [\"http://node:port\", ...]}"}, 400
+        cluster_ring = HashRing([node.rstrip('/') for node in nodes])
+        logger.info(f"cluster nodes set to {cluster_ring.nodes}")
+    with down_nodes_lock:
+        down = sorted(node for node, retry_at in down_nodes.items() if retry_at > time.time())
+    return {"pid": os.getpid(), "self": CLUSTER_SELF, "enabled": cluster_enabled(), "mode": CLUSTER_MODE,
+            "nodes": cluster_ring.nodes, "down": down}
+# --- END CLUSTER ---
+
+# --- WARM-UP ---
+# Every WARMUP_INTERVAL seconds, pre-resolves the stream URL, manifest and first
+# WARMUP_SEGMENTS segments of the WARMUP_TOP_N most streamed songs (and of the top
+# WARMUP_TOP_N chart songs when WARMUP_CHARTS_COUNTRY is set), so popular songs never
+# wait on yt-dlp. Stream URLs about to expire are re-resolved ahead of time.
+ENABLE_WARMUP = os.environ.get('ENABLE_WARMUP', '1') != '0'
+WARMUP_INTERVAL = int(os.environ.get('WARMUP_INTERVAL', 60 * 10))
+WARMUP_TOP_N = int(os.environ.get('WARMUP_TOP_N', 20))
+WARMUP_SEGMENTS = int(os.environ.get('WARMUP_SEGMENTS', 3))
+WARMUP_CHARTS_COUNTRY = os.environ.get('WARMUP_CHARTS_COUNTRY', '') # e.g. "US", or "ZZ" for global; empty disables
+
+def chart_video_ids(country, limit):
+    """Returns up to `limit` video ids from the YouTube Music charts, in chart order."""
+    charts = ytmusic_upstream.call(ytmusic.get_charts, country=country)
+    # The layout of get_charts differs between ytmusicapi versions, so just collect videoIds
+    video_ids = []
+    def collect(node):
+        if len(video_ids) >= limit:
+            return
+        if isinstance(node, dict):
+            video_id = node.get("videoId")
+            if video_id and video_id not in video_ids:
+                video_ids.append(video_id)
+            for value in node.values():
+                collect(value)
+        elif isinstance(node, list):
+            for value in node:
+                collect(value)
+    collect(charts)
+    return video_ids
+
+
+def warm_song(id):
+    """Resolves a song's stream and starts downloading its first segments."""
+    with stream_url_cache_lock:
+        cached = stream_url_cache.get(id)
+    if cached and cached[1] < time.time() + WARMUP_INTERVAL:
+        # Would expire before the next warm-up run, resolve a fresh one (and manifest) now
+        invalidate_stream(id)
+    manifest = cached_manifest(id)
+    if manifest is None:
+        m3u8_url = resolve_stream_url(id)
+        if not m3u8_url.startswith("http"):
+            return
+        manifest = build_manifest(id, m3u8_url, fetch_manifest(id, m3u8_url))
+        store_manifest(id, manifest)
+    start_segment_downloads(register_segments(id, manifest["segments"][:WARMUP_SEGMENTS]))
+
+
+def warm_up_popular_songs():
+    """Background task that keeps popular songs warm and ages the hit counters."""
+    logger.info("Starting warm-up thread...")
+    priority_context.value = BACKGROUND
+    while True:
+        time.sleep(WARMUP_INTERVAL)
+        song_ids = [key.split("/", 1)[1] for key in hottest_keys("song/", WARMUP_TOP_N)]
+        decay_access_counts()
+        if not ENABLE_WARMUP:
+            continue
+        if WARMUP_CHARTS_COUNTRY:
+            try:
+                song_ids += [v for v in chart_video_ids(WARMUP_CHARTS_COUNTRY, WARMUP_TOP_N) if v not in song_ids]
+            except Exception as e:
+                logger.warning(f"error fetching charts for warm-up: {str(e)}")
+        for song_id in song_ids:
+            try:
+                warm_song(song_id)
+            except Exception as e:
+                logger.warning(f"error warming up song {song_id}: {str(e)}")
+        logger.info(f"Warm-up pass done for {len(song_ids)} songs.")
+# --- END WARM-UP ---
+
+# --- PREFETCH ---
+# POST /prefetch {"playlistId": ...} | {"radio": videoId} | {"videoIds": [...]}, with an
+# optional "limit", downloads the next tracks of a queue into the audio cache ahead of
+# time, so /song/<id>/stream serves them from disk when the player gets there. Tracks are
+# downloaded in queue order by PREFETCH_WORKERS background workers through the same
+# AudioDownload a listener would join. A track is skipped once cached audio takes
+# PREFETCH_DISK_BUDGET bytes, or once prefetches downloaded PREFETCH_HOURLY_BYTES in the
+# last hour. In a cluster, each owner node gets its tracks as a prefetch job of its own.
+# A job runs in the worker that accepted it; its progress lives in an SQLite file (PREFETCH_DB)
+# so that any worker of the node answers GET and DELETE /prefetch/<job_id>.
+PREFETCH_WORKERS = int(os.environ.get('PREFETCH_WORKERS', 2))
+PREFETCH_DEFAULT_TRACKS = 10
+PREFETCH_MAX_TRACKS = int(os.environ.get('PREFETCH_MAX_TRACKS', 50))
+PREFETCH_DISK_BUDGET = int(os.environ.get('PREFETCH_DISK_BUDGET', 2 * 1024 ** 3))
+PREFETCH_HOURLY_BYTES = int(os.environ.get('PREFETCH_HOURLY_BYTES', 1024 ** 3)) # 0 = no limit
+PREFETCH_DB = os.environ.get('PREFETCH_DB', os.path.join(os.getcwd(), "cache", "prefetch.sqlite3"))
+PREFETCH_JOBS_KEPT = 50
+PREFETCH_FINAL_STATES = ("done", "cached", "failed", "skipped", "delegated", "cancelled")
+
+prefetch_executor = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="prefetch") # Threads start lazily
+prefetch_lock = threading.Lock()
+prefetch_transfers = collections.deque() # (time, bytes) of prefetch downloads in the last hour
+prefetch_db_connection = None
+prefetch_db_lock = threading.Lock()
+
+def prefetch_db():
+    """The prefetch job store's connection, opened on first use (callers hold prefetch_db_lock)."""
+    global prefetch_db_connection
+    if prefetch_db_connection is None:
+        os.makedirs(os.path.dirname(PREFETCH_DB), exist_ok=True)
+        connection = sqlite3.connect(PREFETCH_DB, timeout=10, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL") # Workers read while another one writes
+        connection.execute("CREATE TABLE IF NOT EXISTS jobs (job_id TEXT PRIMARY KEY, pid INTEGER, source TEXT, created REAL,"
+                           " resolved INTEGER, cancelled INTEGER, error TEXT, tracks TEXT)")
+        prefetch_db_connection = connection
+    return prefetch_db_connection
+
+
+class PrefetchJob:
+    """A prefetch job as run by the worker that accepted it; every change is written to PREFETCH_DB."""
+    def __init__(self, source, limit, local=False):
+        self.id = uuid.uuid4().hex[:12]
+        self.source = source
+        self.limit = limit
+        self.local = local # Forwarded by another node: don't delegate again
+        self.tracks = collections.OrderedDict() # {video_id: {"state": ..., ...}}
+        with prefetch_db_lock, prefetch_db():
+            prefetch_db().execute("INSERT INTO jobs VALUES (?, ?, ?, ?, 0, 0, NULL, '[]')",
+                                  (self.id, os.getpid(), json.dumps(source), time.time()))
+            prefetch_db().execute("DELETE FROM jobs WHERE job_id NOT IN (SELECT job_id FROM jobs ORDER BY created DESC LIMIT ?)",
+                                  (PREFETCH_JOBS_KEPT,))
+
+    def update(self, column, value):
+        with prefetch_db_lock, prefetch_db():
+            prefetch_db().execute(f"UPDATE jobs SET {column} = ? WHERE job_id = ?", (value, self.id))
+
+    def set(self, video_id, state, **details):
+        with prefetch_lock: # Held while writing, so an older track list never overwrites a newer one
+            self.tracks[video_id] = {"state": state, **details}
+            self.update("tracks", json.dumps([{"videoId": video_id, **track} for video_id, track in self.tracks.items()]))
+        if state in PREFETCH_FINAL_STATES:
+            prefetch_tracks_total.inc(result=state)
+
+    @property
+    def cancelled(self):
+        """Whether a DELETE, answered by any worker, cancelled the job."""
+        with prefetch_db_lock:
+            row = prefetch_db().execute("SELECT cancelled FROM jobs WHERE job_id = ?", (self.id,)).fetchone()
+        return bool(row and row[0])
+
+
+def prefetch_job_snapshot(job_id):
+    """The job's progress as stored in PREFETCH_DB, or None if there's no such job."""
+    with prefetch_db_lock:
+        row = prefetch_db().execute("SELECT job_id, pid, source, created, resolved, cancelled, error, tracks FROM jobs"
+                                    " WHERE job_id = ?", (job_id,)).fetchone()
+    return prefetch_row_snapshot(row) if row else None
+
+
+def prefetch_row_snapshot(row):
+    job_id, pid, source, created, resolved, cancelled, error, tracks = row
+    tracks = json.loads(tracks)
+    counts = collections.Counter(track["state"] for track in tracks)
+    if error:
+        status = "failed"
+    elif resolved and all(track["state"] in PREFETCH_FINAL_STATES for track in tracks):
+        status = "cancelled" if cancelled else "done"
+    elif pid != os.getpid() and not process_alive(pid):
+        status = "interrupted" # Its worker exited before finishing
+    else:
+        status = "running" if resolved else "resolving"
+    return {"jobId": job_id, "pid": pid, "source": json.loads(source), "status": status, "error": error,
+            "created": created, "counts": dict(counts), "tracks": tracks}
+
+
+def prefetch_video_ids(source, limit):
+    """The first `limit` distinct video ids of the job's playlist, radio or id list."""
+    if "playlistId" in source:
+        tracks = ytmusic_upstream.call(ytmusic.get_playlist, playlistId=source["playlistId"], limit=limit)["tracks"]
+    elif "radio" in source:
+        tracks = ytmusic_upstream.call(ytmusic.get_watch_playlist, videoId=source["radio"], radio=True, limit=limit)["tracks"]
+    else:
+        tracks = [{"videoId": video_id} for video_id in source["videoIds"]]
+    video_ids = []
+    for track in tracks:
+        video_id = track.get("videoId")
+        if video_id and video_id not in video_ids:
+            video_ids.append(video_id)
+    return video_ids[:limit]
+
+
+def audio_cache_bytes():
+    total = 0
+    with os.scandir(AUDIO_CACHE_DIR) as entries:
+        for entry in entries:
+            if os.path.splitext(entry.name)[1] in AUDIO_MIMETYPES:
+                try:
+                    total += entry.stat().st_size
+                except FileNotFoundError:
+                    pass # Deleted while we were scanning
+    return total
+
+
+def prefetch_bytes_last_hour():
+    with prefetch_lock:
+        while prefetch_transfers and prefetch_transfers[0][0] < time.time() - 3600:
+            prefetch_transfers.popleft()
+        return sum(size for _, size in prefetch_transfers)
+
+
+def prefetch_track(job, video_id):
+    priority_context.value = BACKGROUND
+    if job.cancelled:
+        return job.set(video_id, "cancelled")
+    if cached_audio_path(video_id):
+        return job.set(video_id, "cached")
+    if audio_cache_bytes() >= PREFETCH_DISK_BUDGET:
+        return job.set(video_id, "skipped", reason="disk budget")
+    if PREFETCH_HOURLY_BYTES and prefetch_bytes_last_hour() >= PREFETCH_HOURLY_BYTES:
+        return job.set(video_id, "skipped", reason="bandwidth budget")
+    job.set(video_id, "downloading")
+    try:
+        path = None
+        if AUDIO_DOWNLOAD_CONCURRENCY > 0:
+            download = audio_download(video_id, BACKGROUND)
+            while not download.wait_finished():
+                if download.error is not None:
+                    break # Failed: fall back below. Merely slow: keep waiting, don't download it twice
+            else:
+                path = download.path
+        if path is None:
+            path = get_audio(f"https://youtube.com/watch?v={video_id}", id=video_id) # Same fallback as getAudio
+        size = os.path.getsize(path)
+    except Exception as e:
+        logger.warning(f"prefetch of {video_id} failed: {str(e)}")
+        return job.set(video_id, "failed", error=str(e))
+    with prefetch_lock:
+        prefetch_transfers.append((time.time(), size))
+    job.set(video_id, "done", bytes=size)
+
+
+def delegate_prefetch(node, video_ids):
+    """Hands `video_ids` to their owner node as a prefetch job there; returns its job id."""
+    headers = {FORWARDED_BY_HEADER: CLUSTER_SELF}
+    if CLUSTER_SECRET:
+        headers[CLUSTER_SECRET_HEADER] = CLUSTER_SECRET
+    response = cluster_session.post(f"{node}/prefetch", json={"videoIds": video_ids, "limit": len(video_ids)},
+                                    headers=headers, timeout=(2, 10))
+    response.raise_for_status()
+    return response.json()["jobId"]
+
+
+def run_prefetch_job(job):
+    priority_context.value = BACKGROUND
+    try:
+        video_ids = prefetch_video_ids(job.source, job.limit)
+    except Exception as e:
+        logger.warning(f"prefetch job {job.id} could not list its tracks: {str(e)}")
+        job.update("error", str(e))
+        return
+    delegated = collections.defaultdict(list)
+    for video_id in video_ids:
+        owner = live_owner(f"song/{video_id}") if cluster_enabled() and not job.local else None
+        if owner not in (None, CLUSTER_SELF):
+            delegated[owner].append(video_id) # The owner serves the song, so it should hold the file
+            continue
+        job.set(video_id, "queued")
+        prefetch_executor.submit(prefetch_track, job, video_id)
+    for node, node_video_ids in delegated.items():
+        try:
+            remote_job_id = delegate_prefetch(node, node_video_ids)
+            for video_id in node_video_ids:
+                job.set(video_id, "delegated", node=node, jobId=remote_job_id)
+        except (requests.exceptions.RequestException, KeyError, ValueError) as e:
+            logger.warning(f"could not hand prefetch of {len(node_video_ids)} tracks to {node}: {str(e)}")
+            for video_id in node_video_ids:
+                job.set(video_id, "failed", error=f"owner {node} unreachable")
+    job.update("resolved", 1)
+
+
+@app.route("/prefetch", methods=["POST"])
+def queuePrefetch():
+    """Starts a prefetch job; answers 202 with its status right away."""
+    body = request.get_json(silent=True) or {}
+    sources = [key for key in ("playlistId", "radio", "videoIds") if body.get(key)]
+    if len(sources) != 1 or ("videoIds" in sources and not (isinstance(body["videoIds"], list)
+                                                           and all(isinstance(v, str) for v in body["videoIds"]))):
+        return {"error": "expected one of {\"playlistId\": ...}, {\"radio\": videoId} or {\"videoIds\": [...]}"}, 400
+    try:
+        limit = max(1, min(int(body.get("limit", PREFETCH_DEFAULT_TRACKS)), PREFETCH_MAX_TRACKS))
+    except (TypeError, ValueError):
+        return {"error": "limit must be a number"}, 400
+    job = PrefetchJob({sources[0]: body[sources[0]]}, limit, local=from_cluster_peer())
+    threading.Thread(target=run_prefetch_job, args=(job,), name=f"prefetch-{job.id}", daemon=True).start()
+    return prefetch_job_snapshot(job.id), 202, {"Location": f"{public_url_root()}/prefetch/{job.id}"}
+
+
+@app.route("/prefetch", methods=["GET"])
+def listPrefetchJobs():
+    with prefetch_db_lock:
+        rows = prefetch_db().execute("SELECT job_id, pid, source, created, resolved, cancelled, error, tracks FROM jobs"
+                                     " ORDER BY created DESC").fetchall()
+    return {"pid": os.getpid(), "jobs": [prefetch_row_snapshot(row) for row in rows]}
+
+
+@app.route("/prefetch/<job_id>", methods=["GET", "DELETE"])
+def prefetchJob(job_id):
+    """A job's progress; DELETE cancels the tracks that haven't started downloading."""
+    if request.method == "DELETE":
+        with prefetch_db_lock, prefetch_db():
+            prefetch_db().execute("UPDATE jobs SET cancelled = 1 WHERE job_id = ?", (job_id,))
+    snapshot = prefetch_job_snapshot(job_id)
+    if snapshot is None:
+        return {"error": "no such prefetch job"}, 404
+    return snapshot
+# --- END PREFETCH ---
+
+# --- CACHE SNAPSHOTS ---
+# Each worker writes its in-memory cache state to cache/state/worker-<pid>.pickle every
+# CACHE_SNAPSHOT_INTERVAL seconds and when it exits: metadata responses, resolved stream
+# URLs and manifests still within their expiry, the index of downloaded segments (and of
+# segment packs), and the hit counters warm-up works from. A starting worker merges every
+# recent snapshot into its own caches, so after a restart or deploy the new workers begin
+# warm instead of all asking YouTube for the same songs at once. Packs of workers that have
+# exited are adopted by the first new worker to rename them to its pid; packs of running
+# workers are left alone, so every pack keeps exactly one writer. Full audio
+# files need no index: they're found on disk by name. CACHE_SNAPSHOT_INTERVAL=0 disables this.
+CACHE_SNAPSHOT_INTERVAL = int(os.environ.get('CACHE_SNAPSHOT_INTERVAL', 300))
+CACHE_SNAPSHOT_DIR = os.path.join(os.getcwd(), "cache", "state")
+CACHE_SNAPSHOT_MAX_AGE = 60 * 60 * 6 # Stream URLs, the longest-lived entries, last about this long
+
+def snapshot_path(pid):
+    return os.path.join(CACHE_SNAPSHOT_DIR, f"worker-{pid}.pickle")
+
+
+def metadata_cache_backend():
+    """The metadata cache's SimpleCache, whose {key: (expires, serialized value)} dict is snapshotted; None for other backends."""
+    backend = getattr(cache, "cache", None)
+    return backend if isinstance(getattr(backend, "_cache", None), dict) else None
+
+
+def save_cache_snapshot():
+    """Writes this worker's cache state (atomically, so a crash mid-write leaves the last snapshot intact)."""
+    now = time.time()
+    state = {"saved": now, "pid": os.getpid()}
+    backend = metadata_cache_backend()
+    if backend is not None:
+        with backend._lock:
+            state["metadata"] = {k: v for k, v in backend._cache.items() if v[0] == 0 or v[0] > now}
+    with stream_url_cache_lock:
+        state["stream_urls"] = {id: v for id, v in stream_url_cache.items() if v[1] > now}
+    with manifest_cache_lock:
+        state["manifests"] = {id: entry for id, entry in manifest_cache.items() if entry["expires"] > now}
+    with segment_cache_lock:
+        state["segments"] = {f: dict(info) for f, info in segment_cache.items() if info['status'] == 'downloaded'}
+    with segment_packs_lock:
+        packs = dict(segment_packs)
+    state["packs"] = {}
+    for song_id, pack in packs.items():
+        with pack.lock:
+            if not pack.deleted:
+                state["packs"][song_id] = {"path": pack.path, "index": dict(pack.index), "last_access": pack.last_access}
+    with access_counts_lock:
+        state["access_counts"] = dict(access_counts)
+    os.makedirs(CACHE_SNAPSHOT_DIR, exist_ok=True)
+    path = snapshot_path(os.getpid())
+    with open(path + ".tmp", "wb") as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + ".tmp", path)
+    logger.debug("cache snapshot saved: %s responses, %s manifests, %s segments in %.2fs",
+                 len(state.get('metadata', ())), len(state['manifests']), len(state['segments']), time.time() - now)
+
+
+def read_cache_snapshots():
+    """The recent snapshots of all workers, deleting ones too old to hold anything valid."""
+    states = []
+    try:
+        entries = list(os.scandir(CACHE_SNAPSHOT_DIR))
+    except FileNotFoundError:
+        return states
+    for entry in entries:
+        if not entry.name.endswith(".pickle"):
+            continue
+        try:
+            if entry.stat().st_mtime < time.time() - CACHE_SNAPSHOT_MAX_AGE:
+                os.remove(entry.path)
+                continue
+            with open(entry.path, "rb") as f:
+                states.append(pickle.load(f))
+        except Exception as e:
+            logger.warning(f"skipping cache snapshot {entry.name}: {str(e)}")
+    return states
+
+
+def process_alive(pid):
+    """True if `pid` is another running process (our own pid means a dead predecessor reused it)."""
+    if pid is None or pid == os.getpid():
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True # Exists, owned by someone else
+    return True
+
+
+def adopt_segment_pack(song_id, saved):
+    """Takes over a previous worker's pack by renaming it to our pid; None if another worker got it first."""
+    path = os.path.join(PACK_DIR, f"{song_id}-{os.getpid()}.pack")
+    try:
+        os.rename(saved["path"], path)
+    except FileNotFoundError:
+        return None
+    pack = SegmentPack(path)
+    pack.index = saved["index"]
+    pack.last_access = saved["last_access"]
+    return pack
+
+
+def restore_cache_snapshots():
+    """Merges all recent worker snapshots into this worker's caches, keeping the longest-lived entry of each."""
+    start = time.time()
+    states = read_cache_snapshots()
+    if not states:
+        return
+    metadata, stream_urls, manifests, segments, counts = {}, {}, {}, {}, {}
+    referenced = set() # Segment files some snapshot knows about
+    for state in states:
+        for key, value in state.get("metadata", {}).items():
+            if key not in metadata or value[0] == 0 or 0 < metadata[key][0] < value[0]:
+                metadata[key] = value
+        for id, value in state.get("stream_urls", {}).items():
+            if value[1] > start and (id not in stream_urls or stream_urls[id][1] < value[1]):
+                stream_urls[id] = value
+        for id, entry in state.get("manifests", {}).items():
+            if entry["expires"] > start and (id not in manifests or manifests[id]["expires"] < entry["expires"]):
+                manifests[id] = entry
+        for segment_filename, info in state.get("segments", {}).items():
+            if info.get('packed'):
+                continue # Restored with their pack below
+            referenced.add(info['temp_path'])
+            if os.path.exists(info['temp_path']) and info['timestamp'] > segments.get(segment_filename, {}).get('timestamp', 0):
+                segments[segment_filename] = info
+        for key, count in state.get("access_counts", {}).items():
+            counts[key] = max(count, counts.get(key, 0))
+        if process_alive(state.get("pid")):
+            continue # A sibling worker still appends to its packs; they stay its own
+        for song_id, saved in state.get("packs", {}).items():
+            with segment_packs_lock:
+                if song_id in segment_packs:
+                    continue
+            pack = adopt_segment_pack(song_id, saved)
+            if pack is None:
+                continue
+            with segment_packs_lock:
+                segment_packs[song_id] = pack
+            for segment_filename, info in state.get("segments", {}).items():
+                if info.get('packed') and info['song'] == song_id and segment_filename in pack.index:
+                    segments[segment_filename] = info
+
+    backend = metadata_cache_backend()
+    if backend is not None:
+        with backend._lock:
+            for key, value in metadata.items():
+                if len(backend._cache) >= backend._threshold:
+                    break
+                backend._cache.setdefault(key, value)
+    with stream_url_cache_lock:
+        for id, value in stream_urls.items():
+            stream_url_cache.setdefault(id, value)
+    with manifest_cache_lock:
+        for id, entry in manifests.items():
+            manifest_cache.setdefault(id, entry)
+    with segment_cache_lock:
+        for segment_filename, info in segments.items():
+            segment_cache.setdefault(segment_filename, info)
+    with access_counts_lock:
+        for key, count in counts.items():
+            access_counts.setdefault(key, count)
+    remove_orphaned_segments(referenced)
+    logger.info(f"Restored cache state from {len(states)} snapshots: {len(metadata)} responses, {len(stream_urls)} stream URLs, "
+                f"{len(manifests)} manifests, {len(segments)} segments in {time.time() - start:.2f}s")
+
+
+def remove_orphaned_segments(referenced):
+    """Deletes old segment files no snapshot knows about (left by a worker that died without saving)."""
+    cutoff = time.time() - SEGMENT_LIFETIME
+    try:
+        entries = list(os.scandir(TEMP_SEGMENT_DIR))
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        try:
+            if entry.path not in referenced and entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+        except OSError:
+            pass # Another worker removed it first
+
+
+def save_cache_snapshots_periodically():
+    while True:
+        time.sleep(CACHE_SNAPSHOT_INTERVAL)
+        try:
+            save_cache_snapshot()
+        except Exception as e:
+            logger.warning(f"error saving cache snapshot: {str(e)}")
+
+
+def save_cache_snapshot_at_exit():
+    if worker_pid != os.getpid():
+        return # Only the process that ran start_worker_services has state worth keeping
+    try:
+        save_cache_snapshot()
+    except Exception as e:
+        logger.warning(f"error saving cache snapshot at exit: {str(e)}")
+# --- END CACHE SNAPSHOTS ---
+
+# --- WORKER LIFECYCLE ---
+# Importing this module has no side effects beyond setting up logging, whose writer thread
+# (see LOGGING) is the one thread started at import and is restarted in each forked child.
+# No cache directories, no clients, no other background threads: those belong to the process
+# that serves requests, so they're started by start_worker_services, once per process: from
+# gunicorn's post_worker_init hook (gunicorn.conf.py), or else on the first request (the
+# ensure_worker_started hook, registered ahead of the cluster routing hook). Under --preload
+# the master imports the app and each forked worker still starts its own threads.
+worker_pid = None
+worker_lock = threading.Lock()
+
+def start_worker_services():
+    """Creates the cache directories and starts this process's background threads. Idempotent per process."""
+    global worker_pid
+    if worker_pid == os.getpid():
+        return
+    with worker_lock:
+        if worker_pid == os.getpid():
+            return
+        os.makedirs(TEMP_SEGMENT_DIR, exist_ok=True) # Also creates cache/
+        if CACHE_SNAPSHOT_INTERVAL > 0:
+            try:
+                restore_cache_snapshots() # Before the threads below, so warm-up sees the restored counters
+            except Exception as e:
+                logger.warning(f"error restoring cache snapshots: {str(e)}")
+            threading.Thread(target=save_cache_snapshots_periodically, name="cache-snapshot", daemon=True).start()
+            atexit.register(save_cache_snapshot_at_exit)
+        threading.Thread(target=purge_old_segments, name="segment-purge", daemon=True).start()
+        threading.Thread(target=warm_up_popular_songs, name="warm-up", daemon=True).start()
+        set_slow_request_threshold(SLOW_REQUEST_THRESHOLD)
+        worker_pid = os.getpid()
+    logger.info(f"Worker {worker_pid} started background services.")
+
+
+app_import_seconds = time.perf_counter() - import_started
+logger.info(f"app.py imported in {app_import_seconds * 1000:.0f} ms")
+# --- END WORKER LIFECYCLE ---
+
 if __name__ == '__main__':
     # Consider using a production WSGI server like Gunicorn in production
     # For local testing:
@@ -871,5 +3621,5 @@ if __name__ == '__main__':
     # app.run(debug=True, port=5000)
     # To match railway behavior more closely for local testing, run with gunicorn:
     # gunicorn -w 4 -b 0.0.0.0:5000 app:app --timeout 60
-    print("Warning: Running with Flask development server. Use a WSGI server like Gunicorn for production.")
+    logger.warning("Running with Flask development server. Use a WSGI server like Gunicorn for production.")
     app.run(debug=True, host='0.0.0.0', port=os.environ.get('PORT', 5000)) # Use PORT env var if available
\ No newline at end of file
@@ -0,0 +1,151 @@
+"""
+Runs a local cluster of app.py processes against one fake origin and checks the sharding:
+
+    python bench/cluster.py --nodes 3 --songs 6 --listeners 4
+
+Every listener loads a song's manifest from a random node and fetches each segment from a
+random node, like clients behind a load balancer. With sharding working, the origin serves
+each segment exactly once for the whole cluster. Also reports how many ring keys move when a
+node is added. Prints JSON results.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import socket
+import sys
+import tempfile
+import time
+import types
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def run_node(port, nodes, mode, origin_url, api_latency):
+    """Child process: one app.py node wired to the fake upstreams."""
+    os.chdir(tempfile.mkdtemp(prefix=f"libytm-node{port}-"))
+    os.environ.update(CLUSTER_NODES=",".join(nodes), CLUSTER_SELF=f"http://127.0.0.1:{port}",
+                      CLUSTER_MODE=mode, ENABLE_WARMUP="0", LOG_LEVEL="WARNING")
+    sys.path.insert(0, REPO_DIR)
+    sys.path.insert(0, BENCH_DIR)
+    import fake_upstream
+    import app as app_module
+    fake_upstream.install(app_module, types.SimpleNamespace(base_url=origin_url), api_latency=api_latency)
+
+    import logging
+    from werkzeug.serving import make_server
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    make_server("127.0.0.1", port, app_module.app, threaded=True).serve_forever()
+
+
+def wait_ready(nodes, timeout=30):
+    deadline = time.time() + timeout
+    for node in nodes:
+        while True:
+            try:
+                if requests.get(f"{node}/health", timeout=1).ok:
+                    break
+            except requests.RequestException:
+                pass
+            if time.time() > deadline:
+                raise RuntimeError(f"{node} didn't come up")
+            time.sleep(0.1)
+
+
+def listen(nodes, song, seed):
+    """Plays one song, picking a random node for every request. Returns the number of errors."""
+    rng = random.Random(seed)
+    session = requests.Session()
+    response = session.get(f"{rng.choice(nodes)}/song/{song}/streamHLS.m3u8", timeout=60)
+    if not response.ok:
+        return 1
+    errors = 0
+    for url in [l for l in response.text.splitlines() if l and not l.startswith("#")]:
+        # Segment URLs point at the node the client used; send each to a random node instead
+        path = url.split("/", 3)[3]
+        if not session.get(f"{rng.choice(nodes)}/{path}", timeout=60).ok:
+            errors += 1
+    return errors
+
+
+def cluster_actions(nodes):
+    actions = {}
+    for node in nodes:
+        for line in requests.get(f"{node}/metrics", timeout=5).text.splitlines():
+            if line.startswith("libytm_cluster_requests_total{"):
+                action = line.split('action="', 1)[1].split('"', 1)[0]
+                actions[action] = actions.get(action, 0) + float(line.rsplit(" ", 1)[1])
+    return actions
+
+
+def keys_moved_on_add(nodes, keys=10000):
+    """Share of song keys that change owner when one node joins the ring."""
+    sys.path.insert(0, REPO_DIR)
+    os.environ["LOG_LEVEL"] = "WARNING" # Keep stdout for the results
+    from app import HashRing
+    before, after = HashRing(nodes), HashRing(nodes + ["http://127.0.0.1:1"])
+    moved = sum(before.owner(f"song/{n}") != after.owner(f"song/{n}") for n in range(keys))
+    return moved / keys
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--nodes", type=int, default=3, help="app.py processes in the cluster")
+    parser.add_argument("--mode", choices=("forward", "redirect"), default="forward", help="CLUSTER_MODE for the nodes")
+    parser.add_argument("--songs", type=int, default=6, help="distinct songs")
+    parser.add_argument("--listeners", type=int, default=3, help="listeners per song")
+    parser.add_argument("--segments", type=int, default=10, help="segments per fake manifest")
+    parser.add_argument("--latency", type=float, default=0.01, help="fake origin latency per request (s)")
+    parser.add_argument("--api-latency", type=float, default=0.02, help="fake ytmusicapi / yt-dlp latency per call (s)")
+    args = parser.parse_args()
+
+    sys.path.insert(0, BENCH_DIR)
+    import fake_upstream
+    origin = fake_upstream.FakeOrigin(latency=args.latency, segments=args.segments).start()
+    ports = [free_port() for _ in range(args.nodes)]
+    nodes = [f"http://127.0.0.1:{port}" for port in ports]
+    context = multiprocessing.get_context("spawn") # Fresh interpreter per node, like separate machines
+    processes = [context.Process(target=run_node, args=(port, nodes, args.mode, origin.base_url, args.api_latency), daemon=True)
+                 for port in ports]
+    for process in processes:
+        process.start()
+    try:
+        wait_ready(nodes)
+        start = time.perf_counter()
+        jobs = [(f"cluster{song}", song * 1000 + n) for song in range(args.songs) for n in range(args.listeners)]
+        with ThreadPoolExecutor(max_workers=len(jobs)) as pool:
+            errors = sum(pool.map(lambda job: listen(nodes, *job), jobs))
+        wall = time.perf_counter() - start
+        unique_segments = args.songs * args.segments
+        results = {
+            "nodes": args.nodes,
+            "mode": args.mode,
+            "errors": errors,
+            "wall_s": wall,
+            "origin_requests": dict(origin.request_counts),
+            "unique_segments": unique_segments,
+            "duplicate_segment_downloads": origin.request_counts["segment"] - unique_segments,
+            "cluster_actions": cluster_actions(nodes),
+            "keys_moved_on_add": keys_moved_on_add(nodes),
+            "ideal_keys_moved_on_add": 1 / (args.nodes + 1),
+        }
+    finally:
+        for process in processes:
+            process.terminate()
+        origin.shutdown()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
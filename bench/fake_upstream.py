@@ -0,0 +1,190 @@
+"""
+Local stand-ins for everything app.py talks to, so benchmarks run offline and repeatably:
+a fake googlevideo HLS origin serving synthetic .ts segments and rangeable audio files, a
+fake image host, a fake ytmusicapi client and a fake `yt-dlp -g` / `--print url`. Latency
+and bandwidth are configurable.
+"""
+import subprocess
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Image hosts app.py's lh3 proxy accepts; requests to them get rerouted to the fake origin
+FAKE_IMAGE_DOMAINS = ("ytimg.com", "googleusercontent.com")
+
+
+class FakeOrigin(ThreadingHTTPServer):
+    """
+    Serves /hls/<id>/index.m3u8, /hls/<id>/seg<n>.ts, /audio/<id>.m4a (honoring Range) and /img/<name>.
+    Every response waits `latency` seconds first, then is sent at `bandwidth` bytes/s (0 = unthrottled).
+    """
+    daemon_threads = True
+
+    def __init__(self, latency=0.02, bandwidth=0, segments=30, segment_size=64 * 1024,
+                 segment_duration=5, image_size=20 * 1024, audio_size=4 * 1024 * 1024):
+        super().__init__(("127.0.0.1", 0), FakeOriginHandler)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.segments = segments
+        self.segment_size = segment_size
+        self.segment_duration = segment_duration
+        self.image_size = image_size
+        self.audio_size = audio_size
+        self.request_counts = {"manifest": 0, "segment": 0, "image": 0, "audio": 0}
+        self.bytes_sent = 0
+        self.counts_lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def manifest(self):
+        lines = ["#EXTM3U", "#EXT-X-VERSION:3", f"#EXT-X-TARGETDURATION:{self.segment_duration}", "#EXT-X-MEDIA-SEQUENCE:0"]
+        for n in range(self.segments):
+            lines += [f"#EXTINF:{self.segment_duration}.0,", f"seg{n}.ts"]
+        lines.append("#EXT-X-ENDLIST")
+        return "\n".join(lines).encode()
+
+    def count(self, kind, size):
+        with self.counts_lock:
+            self.request_counts[kind] += 1
+            self.bytes_sent += size
+
+
+class FakeOriginHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        origin = self.server
+        path = urllib.parse.urlparse(self.path).path
+        if path.endswith(".m3u8"):
+            kind, body, content_type = "manifest", origin.manifest(), "application/x-mpegURL"
+        elif path.endswith(".ts"):
+            # Synthetic but deterministic payload, so identical segments are byte-identical
+            kind, body, content_type = "segment", (path.encode() * (origin.segment_size // len(path) + 1))[:origin.segment_size], "video/mp2t"
+        elif path.startswith("/img/"):
+            kind, body, content_type = "image", b"\xff\xd8\xff" + b"\0" * (origin.image_size - 3), "image/jpeg"
+        elif path.startswith("/audio/"):
+            kind, body, content_type = "audio", (path.encode() * (origin.audio_size // len(path) + 1))[:origin.audio_size], "audio/mp4"
+        else:
+            self.send_error(404)
+            return
+        status, total = 200, len(body)
+        byte_range = self.headers.get("Range", "")
+        if kind == "audio" and byte_range.startswith("bytes="):
+            start, _, end = byte_range[len("bytes="):].partition("-")
+            start, end = int(start), min(int(end) if end else total - 1, total - 1)
+            status, body = 206, body[start:end + 1]
+        time.sleep(origin.latency)
+        self.send_response(status)
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{total}")
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        chunk_size = 16 * 1024
+        for start in range(0, len(body), chunk_size):
+            chunk = body[start:start + chunk_size]
+            self.wfile.write(chunk)
+            if origin.bandwidth:
+                time.sleep(len(chunk) / origin.bandwidth)
+        origin.count(kind, len(body))
+
+    def log_message(self, format, *args):
+        pass # Keep benchmark output clean
+
+
+class FakeYTMusic:
+    """Answers the ytmusicapi calls app.py makes with plausible, deterministic structures."""
+    def __init__(self, latency=0.05):
+        self.latency = latency
+
+    def _thumbnail(self, id):
+        return {"thumbnails": [{"url": f"https://i.ytimg.com/vi/{id}/default.jpg"},
+                               {"url": f"https://i.ytimg.com/vi/{id}/hqdefault.jpg"}]}
+
+    def _track(self, id):
+        return {"videoId": id, "title": f"Track {id}", "artists": [{"name": "Artist", "id": "UCartist"}],
+                "album": {"name": "Album", "id": "MPREalbum"}, "duration": "3:30", "duration_seconds": 210,
+                "length": "3:30", "thumbnail": self._thumbnail(id), "likeStatus": "INDIFFERENT",
+                "isAvailable": True, "isExplicit": False, "feedbackTokens": {"add": "x" * 64, "remove": "y" * 64}}
+
+    def get_song(self, videoId, signatureTimestamp=None):
+        time.sleep(self.latency)
+        return {"videoDetails": {"videoId": videoId, "title": f"Track {videoId}", "author": "Artist",
+                                 "channelId": "UCartist", "lengthSeconds": "210", "viewCount": "1000",
+                                 "keywords": ["benchmark"] * 20, "shortDescription": "d" * 2000,
+                                 "thumbnail": self._thumbnail(videoId)}}
+
+    def get_playlist(self, playlistId, limit=100, **kwargs):
+        time.sleep(self.latency)
+        return {"id": playlistId, "title": f"Playlist {playlistId}", "author": {"name": "Curator"},
+                "trackCount": 200, "duration": "11 hours", "thumbnails": self._thumbnail(playlistId)["thumbnails"],
+                "tracks": [self._track(f"{playlistId}-{n}") for n in range(200)]}
+
+    def get_watch_playlist(self, videoId=None, radio=False, limit=25, **kwargs):
+        time.sleep(self.latency)
+        return {"playlistId": f"RDAMVM{videoId}", "lyrics": f"MPLY{videoId}", "related": None,
+                "tracks": [self._track(f"{videoId}-r{n}") for n in range(limit)]}
+
+    def get_lyrics(self, browseId, timestamps=False):
+        time.sleep(self.latency)
+        return {"lyrics": "la la la\n" * 40, "source": "Source: Benchmark", "hasTimestamps": False}
+
+    def search(self, query, filter=None, limit=20, **kwargs):
+        time.sleep(self.latency)
+        return [self._track(f"s{n}") for n in range(limit)]
+
+    def get_charts(self, country="ZZ"):
+        time.sleep(self.latency)
+        return {"videos": [{"title": "Top", "items": [self._track(f"c{n}") for n in range(20)]}]}
+
+
+class RerouteAdapter(HTTPAdapter):
+    """Sends requests for FAKE_IMAGE_DOMAINS to the fake origin's /img/ path instead."""
+    def __init__(self, origin):
+        super().__init__()
+        self.origin = origin
+
+    def send(self, request, **kwargs):
+        parsed = urllib.parse.urlparse(request.url)
+        request.url = f"{self.origin.base_url}/img/{parsed.hostname}{parsed.path}"
+        return super().send(request, **kwargs)
+
+
+def install(app_module, origin, api_latency=0.05):
+    """Points a freshly imported app module at the fake upstreams."""
+    app_module.ytmusic = FakeYTMusic(api_latency)
+
+    real_run = subprocess.run
+    def fake_run(cmd, *args, **kwargs):
+        # `yt-dlp ... -g` resolves the HLS stream URL, `--print ext --print url` the audio file;
+        # anything else is a real subprocess
+        if "yt_dlp" in cmd and ("-g" in cmd or "--print" in cmd):
+            time.sleep(api_latency)
+            id = urllib.parse.parse_qs(urllib.parse.urlparse(cmd[cmd.index("yt_dlp") + 1]).query)["v"][0]
+            expire = int(time.time()) + 6 * 3600
+            if "-g" in cmd:
+                stdout = f"{origin.base_url}/hls/{id}/index.m3u8?expire={expire}\n"
+            else:
+                stdout = f"m4a\n{origin.base_url}/audio/{id}.m4a?expire={expire}\n"
+            return subprocess.CompletedProcess(cmd, 0, stdout=stdout, stderr="")
+        return real_run(cmd, *args, **kwargs)
+    app_module.subprocess.run = fake_run
+
+    adapter = RerouteAdapter(origin)
+    real_get_adapter = requests.Session.get_adapter
+    def get_adapter(self, url):
+        hostname = urllib.parse.urlparse(url).hostname or ""
+        if hostname.endswith(FAKE_IMAGE_DOMAINS):
+            return adapter
+        return real_get_adapter(self, url)
+    requests.Session.get_adapter = get_adapter
@@ -0,0 +1,278 @@
+"""
+Offline benchmark for app.py against the fake upstreams in fake_upstream.py.
+
+    python bench/run.py --listeners 8 --output before.json
+    # ...change something...
+    python bench/run.py --listeners 8 --output after.json
+    python bench/run.py --compare before.json after.json
+
+Measures per-endpoint latency (p50/p99), time-to-first-segment and segment throughput for
+N concurrent simulated HLS listeners, plus memory and cache-dir growth. The app runs
+in-process under a threaded werkzeug server, in a scratch directory so its cache/ is
+thrown away afterwards.
+"""
+import argparse
+import contextlib
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+def summarize(latencies, errors):
+    """Latency stats in milliseconds."""
+    ms = [l * 1000 for l in latencies]
+    return {
+        "count": len(ms),
+        "errors": errors,
+        "p50_ms": percentile(ms, 50),
+        "p99_ms": percentile(ms, 99),
+        "mean_ms": statistics.fmean(ms) if ms else None,
+        "max_ms": max(ms) if ms else None,
+    }
+
+
+def rss_bytes():
+    """Current resident set size (falls back to the peak where /proc isn't available)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass # Purged while we were walking
+    return total
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "-C", REPO_DIR, "rev-parse", "--short", "HEAD"],
+                              capture_output=True, text=True, timeout=5).stdout.strip()
+    except Exception:
+        return None
+
+
+def timed_get(session, url, **kwargs):
+    start = time.perf_counter()
+    response = session.get(url, timeout=60, **kwargs)
+    body = response.content
+    return time.perf_counter() - start, response, body
+
+
+def bench_endpoint(base_url, paths, requests_total, concurrency):
+    """Spreads requests_total GETs over `paths` with `concurrency` workers."""
+    latencies, errors = [], 0
+    lock = threading.Lock()
+    def worker(n):
+        nonlocal errors
+        session = requests.Session()
+        for i in range(n, requests_total, concurrency):
+            try:
+                elapsed, response, _ = timed_get(session, base_url + paths[i % len(paths)])
+                ok = response.ok
+            except requests.RequestException:
+                elapsed, ok = None, False
+            with lock:
+                if ok:
+                    latencies.append(elapsed)
+                else:
+                    errors += 1
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(worker, range(concurrency)))
+    return summarize(latencies, errors)
+
+
+def bench_listeners(base_url, listeners, songs):
+    """Each listener loads a manifest and plays it through, fetching segments back to back."""
+    ttfs, segment_latencies, errors = [], [], 0
+    segments_served = 0
+    lock = threading.Lock()
+    def listen(n):
+        nonlocal errors, segments_served
+        session = requests.Session()
+        start = time.perf_counter()
+        try:
+            _, response, body = timed_get(session, f"{base_url}/song/bench{n % songs}/streamHLS.m3u8")
+            response.raise_for_status()
+            segment_urls = [l for l in body.decode().splitlines() if l and not l.startswith("#")]
+            for i, url in enumerate(segment_urls):
+                elapsed, response, _ = timed_get(session, url)
+                response.raise_for_status()
+                with lock:
+                    if i == 0:
+                        ttfs.append(time.perf_counter() - start)
+                    segment_latencies.append(elapsed)
+                    segments_served += 1
+        except requests.RequestException:
+            with lock:
+                errors += 1
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=listeners) as pool:
+        list(pool.map(listen, range(listeners)))
+    wall = time.perf_counter() - start
+    return {
+        "listeners": listeners,
+        "songs": songs,
+        "errors": errors,
+        "wall_s": wall,
+        "segments_served": segments_served,
+        "segments_per_s": segments_served / wall if wall else None,
+        "time_to_first_segment": summarize(ttfs, errors),
+        "segment": summarize(segment_latencies, 0),
+    }
+
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix="libytm-bench-")
+    os.chdir(workdir) # app.py keeps its cache/ relative to the cwd
+    # Keep background work from skewing the numbers
+    os.environ.setdefault("ENABLE_WARMUP", "0")
+    sys.path.insert(0, REPO_DIR)
+    sys.path.insert(0, BENCH_DIR)
+    import fake_upstream
+
+    origin = fake_upstream.FakeOrigin(latency=args.latency, bandwidth=args.bandwidth,
+                                      segments=args.segments, segment_size=args.segment_size,
+                                      audio_size=args.audio_size).start()
+    rss_before_import = rss_bytes()
+    import_start = time.perf_counter()
+    import app as app_module
+    import_s = time.perf_counter() - import_start
+    fake_upstream.install(app_module, origin, api_latency=args.api_latency)
+
+    from werkzeug.serving import make_server
+    logging.getLogger("werkzeug").setLevel(logging.WARNING) # No per-request access log
+    server = make_server("127.0.0.1", 0, app_module.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    cache_dir = os.path.join(workdir, "cache")
+    rss_start, disk_start = rss_bytes(), dir_size(cache_dir)
+
+    ids = [f"bench{n}" for n in range(args.songs)]
+    image = urllib.parse.quote_plus("https://i.ytimg.com/vi/bench0/hqdefault.jpg")
+    endpoints = {
+        "song": [f"/song/{id}" for id in ids],
+        "playlist": ["/playlist/PLbench"],
+        "radio": [f"/song/{id}/radio" for id in ids],
+        "search": ["/search/benchmark"],
+        "lh3": [f"/lh3Proxy/{image}"],
+        "audio": [f"/song/{id}/stream" for id in ids],
+        "health": ["/health"],
+    }
+    results = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": time.time(),
+            "python": platform.python_version(),
+            "args": vars(args),
+        },
+        "startup": {"import_s": import_s, "import_rss_bytes": rss_start - rss_before_import},
+        "endpoints": {},
+    }
+    for name, paths in endpoints.items():
+        results["endpoints"][name] = bench_endpoint(base_url, paths, args.requests, args.concurrency)
+    results["streaming"] = bench_listeners(base_url, args.listeners, args.songs)
+    results["resources"] = {
+        "rss_start_bytes": rss_start,
+        "rss_end_bytes": rss_bytes(),
+        "rss_growth_bytes": rss_bytes() - rss_start,
+        "disk_growth_bytes": dir_size(cache_dir) - disk_start,
+    }
+    results["upstream"] = {"requests": dict(origin.request_counts), "bytes_sent": origin.bytes_sent}
+
+    server.shutdown()
+    origin.shutdown()
+    os.chdir(REPO_DIR)
+    shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def flatten(d, prefix=""):
+    for key, value in d.items():
+        if key == "meta":
+            continue
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            yield from flatten(value, name + ".")
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield name, value
+
+
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = dict(flatten(json.load(f)))
+    with open(new_path) as f:
+        new = dict(flatten(json.load(f)))
+    width = max(len(k) for k in old.keys() | new.keys())
+    for key in sorted(old.keys() | new.keys()):
+        a, b = old.get(key), new.get(key)
+        if a is None or b is None:
+            print(f"{key:<{width}}  {a if a is not None else '-':>14}  {b if b is not None else '-':>14}")
+            continue
+        change = f"{(b - a) / a * 100:+.1f}%" if a else ""
+        print(f"{key:<{width}}  {a:>14.6g}  {b:>14.6g}  {change}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--listeners", type=int, default=8, help="concurrent simulated HLS listeners")
+    parser.add_argument("--songs", type=int, default=4, help="distinct songs the listeners and metadata requests spread over")
+    parser.add_argument("--requests", type=int, default=200, help="requests per metadata endpoint")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent clients per metadata endpoint")
+    parser.add_argument("--segments", type=int, default=30, help="segments per fake manifest")
+    parser.add_argument("--segment-size", type=int, default=64 * 1024, help="bytes per fake segment")
+    parser.add_argument("--latency", type=float, default=0.02, help="fake origin latency per request (s)")
+    parser.add_argument("--bandwidth", type=int, default=0, help="fake origin bandwidth per connection (bytes/s, 0 = unlimited)")
+    parser.add_argument("--audio-size", type=int, default=4 * 1024 * 1024, help="bytes per fake audio file")
+    parser.add_argument("--api-latency", type=float, default=0.05, help="fake ytmusicapi / yt-dlp latency per call (s)")
+    parser.add_argument("--output", help="write the JSON results here instead of stdout")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two result files and exit")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    output = args.output
+    del args.output, args.compare # Not part of the recorded configuration
+    with contextlib.redirect_stdout(sys.stderr): # app.py prints its progress; keep stdout for the results
+        results = run(args)
+    text = json.dumps(results, indent=2)
+    if output:
+        with open(output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
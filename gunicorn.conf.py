@@ -0,0 +1,7 @@
+# Picked up automatically by `gunicorn app:app` (see Procfile).
+
+def post_worker_init(worker):
+    # Start the segment janitor, warm-up and other background threads as soon as the worker
+    # has loaded the app (after fork), instead of waiting for its first request.
+    import app
+    app.start_worker_services()
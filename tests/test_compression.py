@@ -0,0 +1,41 @@
+import gzip
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "bench"))
+
+import pytest
+
+import app
+import fake_upstream
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(app, "worker_pid", os.getpid()) # No snapshot, purge or warm-up threads
+    monkeypatch.setattr(app, "start_segment_downloads", lambda segments: None) # Only the manifest is under test
+    # install() patches these in place; monkeypatch puts them back afterwards
+    monkeypatch.setattr(app, "ytmusic", app.ytmusic)
+    monkeypatch.setattr(app.subprocess, "run", app.subprocess.run)
+    monkeypatch.setattr(fake_upstream.requests.Session, "get_adapter", fake_upstream.requests.Session.get_adapter)
+    origin = fake_upstream.FakeOrigin(latency=0).start()
+    fake_upstream.install(app, origin, api_latency=0)
+    yield app.app.test_client()
+    origin.shutdown()
+
+
+def test_manifest_is_compressed(client):
+    response = client.get("/song/manifest/streamHLS.m3u8", headers={"Accept-Encoding": "gzip"})
+    assert response.status_code == 200
+    assert response.mimetype == "application/x-mpegURL"
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert gzip.decompress(response.data).startswith(b"#EXTM3U")
+
+
+def test_manifest_without_accept_encoding(client):
+    response = client.get("/song/manifest/streamHLS.m3u8", headers={"Accept-Encoding": "identity"})
+    assert response.status_code == 200
+    assert "Content-Encoding" not in response.headers
+    assert response.data.startswith(b"#EXTM3U")